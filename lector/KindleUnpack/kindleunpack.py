@@ -4,6 +4,7 @@
 
 from __future__ import unicode_literals, division, absolute_import, print_function
 
+import logging
 import os
 
 __path__ = ["lib", os.path.dirname(os.path.realpath(__file__)), "kindleunpack"]
@@ -18,7 +19,6 @@ from .compatibility_utils import hexlify
 
 add_cp65001_codec()
 
-from .unipath import pathof
 
 if PY2:
     range = xrange
@@ -143,15 +143,6 @@ if PY2:
 #  0.81   various fixes
 #  0.82   Handle calibre-generated mobis that can have skeletons with no fragments
 
-DUMP = False
-""" Set to True to dump all possible information. """
-
-WRITE_RAW_DATA = False
-""" Set to True to create additional files with raw data for debugging/reverse engineering. """
-
-SPLIT_COMBO_MOBIS = False
-""" Set to True to split combination mobis into mobi7 and mobi8 pieces. """
-
 CREATE_COVER_PAGE = True  # XXX experimental
 """ Create and insert a cover xhtml page. """
 
@@ -197,13 +188,14 @@ from .mobi_cover import CoverProcessor, get_image_type
 from .mobi_pagemap import PageMapProcessor
 from .mobi_dict import dictSupport
 
+logger = logging.getLogger(__name__)
+
 
 def processSRCS(i, files, rscnames, sect, data):
     # extract the source zip archive and save it.
-    print("File contains kindlegen source archive, extracting as %s" % KINDLEGENSRC_FILENAME)
+    logger.info("File contains kindlegen source archive, extracting as %s" % KINDLEGENSRC_FILENAME)
     srcname = os.path.join(files.outdir, KINDLEGENSRC_FILENAME)
-    with open(pathof(srcname), 'wb') as f:
-        f.write(data[16:])
+    files.write(srcname, data[16:])
     rscnames.append(None)
     sect.setsectiondescription(i,"Zipped Source Files")
     return rscnames
@@ -230,17 +222,15 @@ def processPAGE(i, files, rscnames, sect, data, mh, pagemapproc):
         outname = os.path.join(files.outdir, 'mobi8-'+files.getInputFileBasename() + '.apnx')
     else:
         outname = os.path.join(files.outdir, 'mobi7-'+files.getInputFileBasename() + '.apnx')
-    with open(pathof(outname), 'wb') as f:
-        f.write(apnx_data)
+    files.write(outname, apnx_data)
     return rscnames, pagemapproc
 
 
 def processCMET(i, files, rscnames, sect, data):
     # extract the build log
-    print("File contains kindlegen build log, extracting as %s" % KINDLEGENLOG_FILENAME)
+    logger.info("File contains kindlegen build log, extracting as %s" % KINDLEGENLOG_FILENAME)
     srcname = os.path.join(files.outdir, KINDLEGENLOG_FILENAME)
-    with open(pathof(srcname), 'wb') as f:
-        f.write(data[10:])
+    files.write(srcname, data[10:])
     rscnames.append(None)
     sect.setsectiondescription(i,"Kindlegen log")
     return rscnames
@@ -263,12 +253,12 @@ def processFONT(i, files, rscnames, sect, data, obfuscate_data, beg, rsc_ptr):
     try:
         usize, fflags, dstart, xor_len, xor_start = struct.unpack_from(b'>LLLLL',data,4)
     except:
-        print("Failed to extract font: {0:s} from section {1:d}".format(fontname,i))
+        logger.info("Failed to extract font: {0:s} from section {1:d}".format(fontname,i))
         font_error = True
         ext = '.failed'
         pass
     if not font_error:
-        print("Extracting font:", fontname)
+        logger.info("Extracting font: %s", fontname)
         font_data = data[dstart:]
         extent = len(font_data)
         extent = min(extent, 1040)
@@ -288,13 +278,12 @@ def processFONT(i, files, rscnames, sect, data, obfuscate_data, beg, rsc_ptr):
         elif hdr == b'OTTO':
             ext = '.otf'
         else:
-            print("Warning: unknown font header %s" % hexlify(hdr))
+            logger.warning("Warning: unknown font header %s" % hexlify(hdr))
         if (ext == '.ttf' or ext == '.otf') and (fflags & 0x0002):
             obfuscate_data.append(fontname + ext)
         fontname += ext
         outfnt = os.path.join(files.imgdir, fontname)
-        with open(pathof(outfnt), 'wb') as f:
-            f.write(font_data)
+        files.write(outfnt, font_data)
         rscnames.append(fontname)
         sect.setsectiondescription(i,"Font {0:s}".format(fontname))
         if rsc_ptr == -1:
@@ -304,19 +293,17 @@ def processFONT(i, files, rscnames, sect, data, obfuscate_data, beg, rsc_ptr):
 
 def processCRES(i, files, rscnames, sect, data, beg, rsc_ptr, use_hd):
     # extract an HDImage
-    global DUMP
     data = data[12:]
     imgtype = get_image_type(None, data)
 
     if imgtype is None:
-        print("Warning: CRES Section %s does not contain a recognised resource" % i)
+        logger.warning("Warning: CRES Section %s does not contain a recognised resource" % i)
         rscnames.append(None)
         sect.setsectiondescription(i,"Mysterious CRES data, first four bytes %s" % describe(data[0:4]))
-        if DUMP:
+        if files.dump:
             fname = "unknown%05d.dat" % i
             outname= os.path.join(files.outdir, fname)
-            with open(pathof(outname), 'wb') as f:
-                f.write(data)
+            files.write(outname, data)
             sect.setsectiondescription(i,"Mysterious CRES data, first four bytes %s extracting as %s" % (describe(data[0:4]), fname))
         rsc_ptr += 1
         return rscnames, rsc_ptr
@@ -328,10 +315,9 @@ def processCRES(i, files, rscnames, sect, data, beg, rsc_ptr, use_hd):
     else:
         imgname = "HDimage%05d.%s" % (i, imgtype)
         imgdest = files.hdimgdir
-    print("Extracting HD image: {0:s} from section {1:d}".format(imgname,i))
+    logger.info("Extracting HD image: {0:s} from section {1:d}".format(imgname,i))
     outimg = os.path.join(imgdest, imgname)
-    with open(pathof(outimg), 'wb') as f:
-        f.write(data)
+    files.write(outimg, data)
     rscnames.append(None)
     sect.setsectiondescription(i,"Optional HD Image {0:s}".format(imgname))
     rsc_ptr += 1
@@ -339,7 +325,6 @@ def processCRES(i, files, rscnames, sect, data, beg, rsc_ptr, use_hd):
 
 
 def processCONT(i, files, rscnames, sect, data):
-    global DUMP
     # process a container header, most of this is unknown
     # right now only extract its EXTH
     dt = data[0:12]
@@ -349,25 +334,23 @@ def processCONT(i, files, rscnames, sect, data):
     else:
         sect.setsectiondescription(i,"CONT Header")
         rscnames.append(None)
-        if DUMP:
+        if files.dump:
             cpage, = struct.unpack_from(b'>L', data, 12)
             contexth = data[48:]
-            print("\n\nContainer EXTH Dump")
+            logger.info("\n\nContainer EXTH Dump")
             dump_contexth(cpage, contexth)
             fname = "CONT_Header%05d.dat" % i
             outname= os.path.join(files.outdir, fname)
-            with open(pathof(outname), 'wb') as f:
-                f.write(data)
+            files.write(outname, data)
     return rscnames
 
 
 def processkind(i, files, rscnames, sect, data):
-    global DUMP
     dt = data[0:12]
     if dt == b"kindle:embed":
-        if DUMP:
-            print("\n\nHD Image Container Description String")
-            print(data)
+        if files.dump:
+            logger.info("\n\nHD Image Container Description String")
+            logger.info(data)
         sect.setsectiondescription(i,"HD Image Container Description String")
         rscnames.append(None)
     return rscnames
@@ -375,18 +358,16 @@ def processkind(i, files, rscnames, sect, data):
 
 # spine information from the original content.opf
 def processRESC(i, files, rscnames, sect, data, k8resc):
-    global DUMP
-    if DUMP:
+    if files.dump:
         rescname = "RESC%05d.dat" % i
-        print("Extracting Resource: ", rescname)
+        logger.info("Extracting Resource:  %s", rescname)
         outrsc = os.path.join(files.outdir, rescname)
-        with open(pathof(outrsc), 'wb') as f:
-            f.write(data)
+        files.write(outrsc, data)
     if True:  # try:
         # parse the spine and metadata from RESC
-        k8resc = K8RESCProcessor(data[16:], DUMP)
+        k8resc = K8RESCProcessor(data[16:], files.dump)
     else:  # except:
-        print("Warning: cannot extract information from RESC.")
+        logger.warning("Warning: cannot extract information from RESC.")
         k8resc = None
     rscnames.append(None)
     sect.setsectiondescription(i,"K8 RESC section")
@@ -394,28 +375,25 @@ def processRESC(i, files, rscnames, sect, data, k8resc):
 
 
 def processImage(i, files, rscnames, sect, data, beg, rsc_ptr, cover_offset):
-    global DUMP
     # Extract an Image
     imgtype = get_image_type(None, data)
     if imgtype is None:
-        print("Warning: Section %s does not contain a recognised resource" % i)
+        logger.warning("Warning: Section %s does not contain a recognised resource" % i)
         rscnames.append(None)
         sect.setsectiondescription(i,"Mysterious Section, first four bytes %s" % describe(data[0:4]))
-        if DUMP:
+        if files.dump:
             fname = "unknown%05d.dat" % i
             outname= os.path.join(files.outdir, fname)
-            with open(pathof(outname), 'wb') as f:
-                f.write(data)
+            files.write(outname, data)
             sect.setsectiondescription(i,"Mysterious Section, first four bytes %s extracting as %s" % (describe(data[0:4]), fname))
         return rscnames, rsc_ptr
 
     imgname = "image%05d.%s" % (i, imgtype)
     if cover_offset is not None and i == beg + cover_offset:
         imgname = "cover%05d.%s" % (i, imgtype)
-    print("Extracting image: {0:s} from section {1:d}".format(imgname,i))
+    logger.info("Extracting image: {0:s} from section {1:d}".format(imgname,i))
     outimg = os.path.join(files.imgdir, imgname)
-    with open(pathof(outimg), 'wb') as f:
-        f.write(data)
+    files.write(outimg, data)
     rscnames.append(imgname)
     sect.setsectiondescription(i,"Image {0:s}".format(imgname))
     if rsc_ptr == -1:
@@ -423,17 +401,14 @@ def processImage(i, files, rscnames, sect, data, beg, rsc_ptr, cover_offset):
     return rscnames, rsc_ptr
 
 
-def processPrintReplica(metadata, files, rscnames, mh):
-    global DUMP
-    global WRITE_RAW_DATA
-    rawML = mh.getRawML()
-    if DUMP or WRITE_RAW_DATA:
+def processPrintReplica(metadata, files, rscnames, mh, processes=1, getpool=None):
+    rawML = mh.getRawML(processes, getpool)
+    if files.dump or files.writeraw:
         outraw = os.path.join(files.outdir,files.getInputFileBasename() + '.rawpr')
-        with open(pathof(outraw),'wb') as f:
-            f.write(rawML)
+        files.write(outraw, rawML)
 
     fileinfo = []
-    print("Print Replica ebook detected")
+    logger.info("Print Replica ebook detected")
     try:
         numTables, = struct.unpack_from(b'>L', rawML, 0x04)
         tableIndexOffset = 8 + 4*numTables
@@ -448,10 +423,9 @@ def processPrintReplica(metadata, files, rscnames, mh):
                     entryName = os.path.join(files.outdir, files.getInputFileBasename() + ('.%03d.pdf' % (i+1)))
                 else:
                     entryName = os.path.join(files.outdir, files.getInputFileBasename() + ('.%03d.%03d.data' % ((i+1),j)))
-                with open(pathof(entryName), 'wb') as f:
-                    f.write(rawML[sectionOffset:(sectionOffset+sectionLength)])
+                files.write(entryName, rawML[sectionOffset:(sectionOffset+sectionLength)])
     except Exception as e:
-        print('Error processing Print Replica: ' + str(e))
+        logger.error('Error processing Print Replica: ' + str(e))
 
     fileinfo.append([None,'', files.getInputFileBasename() + '.pdf'])
     usedmap = {}
@@ -462,20 +436,17 @@ def processPrintReplica(metadata, files, rscnames, mh):
     opf.writeOPF()
 
 
-def processMobi8(mh, metadata, sect, files, rscnames, pagemapproc, k8resc, obfuscate_data, apnxfile=None, epubver='2'):
-    global DUMP
-    global WRITE_RAW_DATA
+def processMobi8(mh, metadata, sect, files, rscnames, pagemapproc, k8resc, obfuscate_data, apnxfile=None, epubver='2', processes=1, getpool=None):
 
     # extract raw markup langauge
-    rawML = mh.getRawML()
-    if DUMP or WRITE_RAW_DATA:
+    rawML = mh.getRawML(processes, getpool)
+    if files.dump or files.writeraw:
         outraw = os.path.join(files.k8dir,files.getInputFileBasename() + '.rawml')
-        with open(pathof(outraw),'wb') as f:
-            f.write(rawML)
+        files.write(outraw, rawML)
 
     # KF8 require other indexes which contain parsing information and the FDST info
     # to process the rawml back into the xhtml files, css files, svg image files, etc
-    k8proc = K8Processor(mh, sect, files, DUMP)
+    k8proc = K8Processor(mh, sect, files, files.dump)
     k8proc.buildParts(rawML)
 
     # collect information for the guide first
@@ -511,17 +482,16 @@ def processMobi8(mh, metadata, sect, files, rscnames, pagemapproc, k8resc, obfus
     if pagemapproc is not None:
         pagemapxml = pagemapproc.generateKF8PageMapXML(k8proc)
         outpm = os.path.join(files.k8oebps,'page-map.xml')
-        with open(pathof(outpm),'wb') as f:
-            f.write(pagemapxml.encode('utf-8'))
-        if DUMP:
-            print(pagemapproc.getNames())
-            print(pagemapproc.getOffsets())
-            print("\n\nPage Map")
-            print(pagemapxml)
+        files.write(outpm, pagemapxml.encode('utf-8'))
+        if files.dump:
+            logger.info(pagemapproc.getNames())
+            logger.info(pagemapproc.getOffsets())
+            logger.info("\n\nPage Map")
+            logger.info(pagemapxml)
 
     # process the toc ncx
     # ncx map keys: name, pos, len, noffs, text, hlvl, kind, pos_fid, parent, child1, childn, num
-    print("Processing ncx / toc")
+    logger.info("Processing ncx / toc")
     ncx = ncxExtract(mh, files)
     ncx_data = ncx.parseNCX()
     # extend the ncx data with filenames and proper internal idtags
@@ -534,7 +504,7 @@ def processMobi8(mh, metadata, sect, files, rscnames, pagemapproc, k8resc, obfus
         ncx_data[i] = ncxmap
 
     # convert the rawML to a set of xhtml files
-    print("Building an epub-like structure")
+    logger.info("Building an epub-like structure")
     htmlproc = XHTMLK8Processor(rscnames, k8proc)
     usedmap = htmlproc.buildXHTML()
 
@@ -570,8 +540,7 @@ def processMobi8(mh, metadata, sect, files, rscnames, pagemapproc, k8resc, obfus
         [skelnum, dir, filename, beg, end, aidtext] = k8proc.getPartInfo(i)
         fileinfo.append([str(skelnum), dir, filename])
         fname = os.path.join(files.k8oebps,dir,filename)
-        with open(pathof(fname),'wb') as f:
-            f.write(part)
+        files.write(fname, part)
     n = k8proc.getNumberOfFlows()
     for i in range(1, n):
         [ptype, pformat, pdir, filename] = k8proc.getFlowInfo(i)
@@ -579,8 +548,7 @@ def processMobi8(mh, metadata, sect, files, rscnames, pagemapproc, k8resc, obfus
         if pformat == b'file':
             fileinfo.append([None, pdir, filename])
             fname = os.path.join(files.k8oebps,pdir,filename)
-            with open(pathof(fname),'wb') as f:
-                f.write(flowpart)
+            files.write(fname, flowpart)
 
     # create the opf
     opf = OPFProcessor(files, metadata.copy(), fileinfo, rscnames, True, mh, usedmap,
@@ -596,19 +564,16 @@ def processMobi8(mh, metadata, sect, files, rscnames, pagemapproc, k8resc, obfus
         nav.writeNAV(ncx_data, guidetext, metadata)
 
     # make an epub-like structure of it all
-    print("Creating an epub-like file")
+    logger.info("Creating an epub-like file")
     files.makeEPUB(usedmap, obfuscate_data, uuid)
 
 
-def processMobi7(mh, metadata, sect, files, rscnames):
-    global DUMP
-    global WRITE_RAW_DATA
+def processMobi7(mh, metadata, sect, files, rscnames, processes=1, getpool=None):
     # An original Mobi
-    rawML = mh.getRawML()
-    if DUMP or WRITE_RAW_DATA:
+    rawML = mh.getRawML(processes, getpool)
+    if files.dump or files.writeraw:
         outraw = os.path.join(files.mobi7dir,files.getInputFileBasename() + '.rawml')
-        with open(pathof(outraw),'wb') as f:
-            f.write(rawML)
+        files.write(outraw, rawML)
 
     # process the toc ncx
     # ncx map keys: name, pos, len, noffs, text, hlvl, kind, pos_fid, parent, child1, childn, num
@@ -624,7 +589,9 @@ def processMobi7(mh, metadata, sect, files, rscnames):
             metadata['DictInLanguage'] = [mh.DictInLanguage()]
         if mh.DictOutLanguage():
             metadata['DictOutLanguage'] = [mh.DictOutLanguage()]
-        positionMap = dictSupport(mh, sect).getPositionMap()
+        # the orthographic and inflection indexes are only decoded on request
+        if files.dictionary:
+            positionMap = dictSupport(mh, sect).getPositionMap()
 
     # convert the rawml back to Mobi ml
     proc = HTMLProcessor(files, metadata, rscnames)
@@ -637,8 +604,7 @@ def processMobi7(mh, metadata, sect, files, rscnames):
     fname = 'book.html'
     fileinfo.append([None,'', fname])
     outhtml = os.path.join(files.mobi7dir, fname)
-    with open(pathof(outhtml), 'wb') as f:
-        f.write(srctext)
+    files.write(outhtml, srctext)
 
     # extract guidetext from srctext
     guidetext =b''
@@ -688,12 +654,11 @@ def processMobi7(mh, metadata, sect, files, rscnames):
 
 
 def processUnknownSections(mh, sect, files, K8Boundary):
-    global DUMP
     global TERMINATION_INDICATOR1
     global TERMINATION_INDICATOR2
     global TERMINATION_INDICATOR3
-    if DUMP:
-        print("Unpacking any remaining unknown records")
+    if files.dump:
+        logger.info("Unpacking any remaining unknown records")
     beg = mh.start
     end = sect.num_sections
     if beg < K8Boundary:
@@ -712,27 +677,23 @@ def processUnknownSections(mh, sect, files, K8Boundary):
             elif type == "INDX":
                 fname = "Unknown%05d_INDX.dat" % i
                 description = "Unknown INDX section"
-                if DUMP:
+                if files.dump:
                     outname= os.path.join(files.outdir, fname)
-                    with open(pathof(outname), 'wb') as f:
-                        f.write(data)
-                    print("Extracting %s: %s from section %d" % (description, fname, i))
+                    files.write(outname, data)
+                    logger.info("Extracting %s: %s from section %d" % (description, fname, i))
                     description = description + ", extracting as %s" % fname
             else:
                 fname = "unknown%05d.dat" % i
                 description = "Mysterious Section, first four bytes %s" % describe(data[0:4])
-                if DUMP:
+                if files.dump:
                     outname= os.path.join(files.outdir, fname)
-                    with open(pathof(outname), 'wb') as f:
-                        f.write(data)
-                    print("Extracting %s: %s from section %d" % (description, fname, i))
+                    files.write(outname, data)
+                    logger.info("Extracting %s: %s from section %d" % (description, fname, i))
                     description = description + ", extracting as %s" % fname
             sect.setsectiondescription(i, description)
 
 
-def process_all_mobi_headers(files, apnxfile, sect, mhlst, K8Boundary, k8only=False, epubver='2', use_hd=False):
-    global DUMP
-    global WRITE_RAW_DATA
+def process_all_mobi_headers(files, apnxfile, sect, mhlst, K8Boundary, k8only=False, epubver='2', use_hd=False, processes=1, getpool=None):
     rscnames = []
     rsc_ptr = -1
     k8resc = None
@@ -742,27 +703,26 @@ def process_all_mobi_headers(files, apnxfile, sect, mhlst, K8Boundary, k8only=Fa
         if mh.isK8():
             sect.setsectiondescription(mh.start,"KF8 Header")
             mhname = os.path.join(files.outdir,"header_K8.dat")
-            print("Processing K8 section of book...")
+            logger.info("Processing K8 section of book...")
         elif mh.isPrintReplica():
             sect.setsectiondescription(mh.start,"Print Replica Header")
             mhname = os.path.join(files.outdir,"header_PR.dat")
-            print("Processing PrintReplica section of book...")
+            logger.info("Processing PrintReplica section of book...")
         else:
             if mh.version == 0:
                 sect.setsectiondescription(mh.start, "PalmDoc Header".format(mh.version))
             else:
                 sect.setsectiondescription(mh.start,"Mobipocket {0:d} Header".format(mh.version))
             mhname = os.path.join(files.outdir,"header.dat")
-            print("Processing Mobipocket {0:d} section of book...".format(mh.version))
+            logger.info("Processing Mobipocket {0:d} section of book...".format(mh.version))
 
-        if DUMP:
+        if files.dump:
             # write out raw mobi header data
-            with open(pathof(mhname), 'wb') as f:
-                f.write(mh.header)
+            files.write(mhname, mh.header)
 
         # process each mobi header
         metadata = mh.getMetaData()
-        mh.describeHeader(DUMP)
+        mh.describeHeader(files.dump)
         if mh.isEncrypted():
             raise unpackException('Book is encrypted')
 
@@ -771,7 +731,7 @@ def process_all_mobi_headers(files, apnxfile, sect, mhlst, K8Boundary, k8only=Fa
         # first handle all of the different resource sections:  images, resources, fonts, and etc
         # build up a list of image names to use to postprocess the ebook
 
-        print("Unpacking images, resources, fonts, etc")
+        logger.info("Unpacking images, resources, fonts, etc")
         beg = mh.firstresource
         end = sect.num_sections
         if beg < K8Boundary:
@@ -783,20 +743,23 @@ def process_all_mobi_headers(files, apnxfile, sect, mhlst, K8Boundary, k8only=Fa
             cover_offset = None
 
         for i in range(beg, end):
-            data = sect.loadSection(i)
-            type = data[0:4]
+            # images, fonts and HD images are written straight from the
+            # mapped file, everything else gets its own copy
+            data = sect.loadSectionView(i)
+            type = data[0:4].tobytes()
+            if type not in [b"FONT", b"CRES"] and get_image_type(None, data) is None:
+                data = data.tobytes()
 
             # handle the basics first
             if type in [b"FLIS", b"FCIS", b"FDST", b"DATP"]:
-                if DUMP:
+                if files.dump:
                     fname = unicode_str(type) + "%05d" % i
                     if mh.isK8():
                         fname += "_K8"
                     fname += '.dat'
                     outname= os.path.join(files.outdir, fname)
-                    with open(pathof(outname), 'wb') as f:
-                        f.write(data)
-                    print("Dumping section {0:d} type {1:s} to file {2:s} ".format(i,unicode_str(type),outname))
+                    files.write(outname, data)
+                    logger.info("Dumping section {0:d} type {1:s} to file {2:s} ".format(i,unicode_str(type),outname))
                 sect.setsectiondescription(i,"Type {0:s}".format(unicode_str(type)))
                 rscnames.append(None)
             elif type == b"SRCS":
@@ -832,16 +795,16 @@ def process_all_mobi_headers(files, apnxfile, sect, mhlst, K8Boundary, k8only=Fa
 
         # Print Replica
         if mh.isPrintReplica() and not k8only:
-            processPrintReplica(metadata, files, rscnames, mh)
+            processPrintReplica(metadata, files, rscnames, mh, processes, getpool)
             continue
 
         # KF8 (Mobi 8)
         if mh.isK8():
-            processMobi8(mh, metadata, sect, files, rscnames, pagemapproc, k8resc, obfuscate_data, apnxfile, epubver)
+            processMobi8(mh, metadata, sect, files, rscnames, pagemapproc, k8resc, obfuscate_data, apnxfile, epubver, processes, getpool)
 
         # Old Mobi (Mobi 7)
         elif not k8only:
-            processMobi7(mh, metadata, sect, files, rscnames)
+            processMobi7(mh, metadata, sect, files, rscnames, processes, getpool)
 
         # process any remaining unknown sections of the palm file
         processUnknownSections(mh, sect, files, K8Boundary)
@@ -849,82 +812,130 @@ def process_all_mobi_headers(files, apnxfile, sect, mhlst, K8Boundary, k8only=Fa
     return
 
 
-def unpackBook(infile, outdir, apnxfile=None, epubver='2', use_hd=False, dodump=False, dowriteraw=False, dosplitcombos=False):
-    global DUMP
-    global WRITE_RAW_DATA
-    global SPLIT_COMBO_MOBIS
-    if DUMP or dodump:
-        DUMP = True
-    if WRITE_RAW_DATA or dowriteraw:
-        WRITE_RAW_DATA = True
-    if SPLIT_COMBO_MOBIS or dosplitcombos:
-        SPLIT_COMBO_MOBIS = True
-
+def unpackBook(infile, outdir, apnxfile=None, epubver='2', use_hd=False, dodump=False, dowriteraw=False, dosplitcombos=False, processes=1, inmemory=False, k8only=False, dodictionary=False, getpool=None):
+    # every option is kept on the files object of this unpack only, so
+    # several books can be unpacked at the same time from different threads
+    # large books are decompressed with the pool returned by getpool() if
+    # it is given, or with a pool of processes started for this book alone
+    # getpool is only called for books that are large enough to need it
     infile = unicode_str(infile)
     outdir = unicode_str(outdir)
     if apnxfile is not None:
         apnxfile = unicode_str(apnxfile)
 
-    files = fileNames(infile, outdir)
+    files = fileNames(infile, outdir, inmemory, dodump, dowriteraw, dodictionary)
 
     # process the PalmDoc database header and verify it is a mobi
     sect = Sectionizer(infile)
-    if sect.ident != b'BOOKMOBI' and sect.ident != b'TEXtREAd':
-        raise unpackException('Invalid file format')
-    if DUMP:
-        sect.dumppalmheader()
-    else:
-        print("Palm DB type: %s, %d sections." % (sect.ident.decode('utf-8'),sect.num_sections))
+    try:
+        if sect.ident != b'BOOKMOBI' and sect.ident != b'TEXtREAd':
+            raise unpackException('Invalid file format')
+        if files.dump:
+            sect.dumppalmheader()
+        else:
+            logger.info("Palm DB type: %s, %d sections." % (sect.ident.decode('utf-8'),sect.num_sections))
 
-    # scan sections to see if this is a compound mobi file (K8 format)
-    # and build a list of all mobi headers to process.
-    mhlst = []
-    mh = MobiHeader(sect,0)
-    # if this is a mobi8-only file hasK8 here will be true
-    mhlst.append(mh)
-    K8Boundary = -1
+        # scan sections to see if this is a compound mobi file (K8 format)
+        # and build a list of all mobi headers to process.
+        mhlst = []
+        mh = MobiHeader(sect,0)
+        # if this is a mobi8-only file hasK8 here will be true
+        mhlst.append(mh)
+        K8Boundary = -1
 
-    if mh.isK8():
-        print("Unpacking a KF8 book...")
-        hasK8 = True
-    else:
-        # This is either a Mobipocket 7 or earlier, or a combi M7/KF8
-        # Find out which
-        hasK8 = False
-        for i in range(len(sect.sectionoffsets)-1):
-            before, after = sect.sectionoffsets[i:i+2]
-            if (after - before) == 8:
-                data = sect.loadSection(i)
-                if data == K8_BOUNDARY:
-                    sect.setsectiondescription(i,"Mobi/KF8 Boundary Section")
-                    mh = MobiHeader(sect,i+1)
-                    hasK8 = True
-                    mhlst.append(mh)
-                    K8Boundary = i
-                    break
-        if hasK8:
-            print("Unpacking a Combination M{0:d}/KF8 book...".format(mh.version))
-            if SPLIT_COMBO_MOBIS:
-                # if this is a combination mobi7-mobi8 file split them up
-                mobisplit = mobi_split(infile)
-                if mobisplit.combo:
-                    outmobi7 = os.path.join(files.outdir, 'mobi7-'+files.getInputFileBasename() + '.mobi')
-                    outmobi8 = os.path.join(files.outdir, 'mobi8-'+files.getInputFileBasename() + '.azw3')
-                    with open(pathof(outmobi7), 'wb') as f:
-                        f.write(mobisplit.getResult7())
-                    with open(pathof(outmobi8), 'wb') as f:
-                        f.write(mobisplit.getResult8())
+        if mh.isK8():
+            logger.info("Unpacking a KF8 book...")
+            hasK8 = True
         else:
-            print("Unpacking a Mobipocket {0:d} book...".format(mh.version))
+            # This is either a Mobipocket 7 or earlier, or a combi M7/KF8
+            # Find out which
+            hasK8 = False
+            for i in range(len(sect.sectionoffsets)-1):
+                before, after = sect.sectionoffsets[i:i+2]
+                if (after - before) == 8:
+                    data = sect.loadSection(i)
+                    if data == K8_BOUNDARY:
+                        sect.setsectiondescription(i,"Mobi/KF8 Boundary Section")
+                        mh = MobiHeader(sect,i+1)
+                        hasK8 = True
+                        mhlst.append(mh)
+                        K8Boundary = i
+                        break
+            if hasK8:
+                logger.info("Unpacking a Combination M{0:d}/KF8 book...".format(mh.version))
+                if dosplitcombos:
+                    # if this is a combination mobi7-mobi8 file split them up
+                    mobisplit = mobi_split(infile)
+                    if mobisplit.combo:
+                        outmobi7 = os.path.join(files.outdir, 'mobi7-'+files.getInputFileBasename() + '.mobi')
+                        outmobi8 = os.path.join(files.outdir, 'mobi8-'+files.getInputFileBasename() + '.azw3')
+                        files.write(outmobi7, mobisplit.getResult7())
+                        files.write(outmobi8, mobisplit.getResult8())
+            else:
+                logger.info("Unpacking a Mobipocket {0:d} book...".format(mh.version))
 
-    if hasK8:
-        files.makeK8Struct()
+        if hasK8:
+            files.makeK8Struct()
 
-    process_all_mobi_headers(files, apnxfile, sect, mhlst, K8Boundary, False, epubver, use_hd)
+        # with k8only the text of the mobi7 part of a combination file is never decoded
+        process_all_mobi_headers(files, apnxfile, sect, mhlst, K8Boundary, k8only and hasK8, epubver, use_hd, processes, getpool)
 
-    if DUMP:
-        sect.dumpsectionsinfo()
-    return
+        if files.dump:
+            sect.dumpsectionsinfo()
+    finally:
+        sect.close()
+    # with inmemory the unpacked book is only available from here
+    return files
+
+
+def unpackMetadata(infile):
+    """
+    Return the EXTH metadata dictionary and the raw cover image of a book
+    without unpacking it. Only the mobi header and the cover (or thumbnail)
+    image sections are read. The cover is None if none can be found.
+    """
+    infile = unicode_str(infile)
+    sect = Sectionizer(infile)
+    try:
+        if sect.ident != b'BOOKMOBI' and sect.ident != b'TEXtREAd':
+            raise unpackException('Invalid file format')
+
+        # The first header carries the same EXTH as the KF8 half of a
+        # combination file, and the images are in its resource sections
+        mh = MobiHeader(sect, 0)
+        if mh.isEncrypted():
+            raise unpackException('Book is encrypted')
+        metadata = mh.getMetaData()
+
+        def loadImage(i):
+            if i < mh.firstresource or i >= sect.num_sections:
+                return None
+            data = sect.loadSectionView(i)
+            if get_image_type(None, data) is None:
+                return None
+            return data.tobytes()
+
+        cover = None
+        for key in ('CoverOffset', 'ThumbOffset'):
+            if key in metadata:
+                cover = loadImage(mh.firstresource + int(metadata[key][0]))
+                if cover is not None:
+                    break
+
+        # Fall back to the largest image in the resource sections
+        # Sizes come from the section table, so only candidates are read
+        if cover is None:
+            candidates = sorted(
+                range(mh.firstresource, sect.num_sections),
+                key=lambda i: sect.sectionoffsets[i+1] - sect.sectionoffsets[i],
+                reverse=True)
+            for i in candidates[:8]:
+                cover = loadImage(i)
+                if cover is not None:
+                    break
+    finally:
+        sect.close()
+    return metadata, cover
 
 
 def usage(progname):
@@ -934,7 +945,7 @@ def usage(progname):
     print("  or an unencrypted Kindle/Print Replica ebook to PDF and images")
     print("  into the specified output folder.")
     print("Usage:")
-    print("  %s -r -s -p apnxfile -d -h --epub_version= infile [outdir]" % progname)
+    print("  %s -r -s -p apnxfile -d -h -j processes --epub_version= --dictionary infile [outdir]" % progname)
     print("Options:")
     print("    -h                 print this help message")
     print("    -i                 use HD Images, if present, to overwrite reduced resolution images")
@@ -942,14 +953,14 @@ def usage(progname):
     print("    -p APNXFILE        path to an .apnx file associated with the azw3 input (optional)")
     print("    --epub_version=    specify epub version to unpack to: 2, 3, A (for automatic) or ")
     print("                         F (force to fit to epub2 definitions), default is 2")
+    print("    --dictionary       decode dictionary orthography and inflection indexes")
     print("    -d                 dump headers and other info to output and extra files")
     print("    -r                 write raw data to the output folder")
+    print("    -j PROCESSES       decompress the text of large books with this many processes")
 
 
 def main(argv=unicode_argv()):
-    global DUMP
-    global WRITE_RAW_DATA
-    global SPLIT_COMBO_MOBIS
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
 
     print("KindleUnpack v0.82")
     print("   Based on initial mobipocket version Copyright © 2009 Charles M. Hannum <root@ihack.net>")
@@ -961,7 +972,7 @@ def main(argv=unicode_argv()):
 
     progname = os.path.basename(argv[0])
     try:
-        opts, args = getopt.getopt(argv[1:], "dhirsp:", ['epub_version='])
+        opts, args = getopt.getopt(argv[1:], "dhirsp:j:", ['epub_version=', 'dictionary'])
     except getopt.GetoptError as err:
         print(str(err))
         usage(progname)
@@ -974,6 +985,11 @@ def main(argv=unicode_argv()):
     apnxfile = None
     epubver = '2'
     use_hd = False
+    dodump = False
+    dowriteraw = False
+    dosplitcombos = False
+    dodictionary = False
+    processes = 1
 
     for o, a in opts:
         if o == "-h":
@@ -982,15 +998,19 @@ def main(argv=unicode_argv()):
         if o == "-i":
             use_hd = True
         if o == "-d":
-            DUMP = True
+            dodump = True
         if o == "-r":
-            WRITE_RAW_DATA = True
+            dowriteraw = True
         if o == "-s":
-            SPLIT_COMBO_MOBIS = True
+            dosplitcombos = True
         if o == "-p":
             apnxfile = a
+        if o == "-j":
+            processes = int(a)
         if o == "--epub_version":
             epubver = a
+        if o == "--dictionary":
+            dodictionary = True
 
     if len(args) > 1:
         infile, outdir = args
@@ -1000,17 +1020,17 @@ def main(argv=unicode_argv()):
 
     infileext = os.path.splitext(infile)[1].upper()
     if infileext not in ['.MOBI', '.PRC', '.AZW', '.AZW3', '.AZW4']:
-        print("Error: first parameter must be a Kindle/Mobipocket ebook or a Kindle/Print Replica ebook.")
+        logger.error("Error: first parameter must be a Kindle/Mobipocket ebook or a Kindle/Print Replica ebook.")
         return 1
 
     try:
-        print('Unpacking Book...')
-        unpackBook(infile, outdir, apnxfile, epubver, use_hd)
-        print('Completed')
+        logger.info('Unpacking Book...')
+        unpackBook(infile, outdir, apnxfile, epubver, use_hd, dodump, dowriteraw, dosplitcombos, processes, dodictionary=dodictionary)
+        logger.info('Completed')
 
     except ValueError as e:
-        print("Error: %s" % e)
-        print(traceback.format_exc())
+        logger.error("Error: %s" % e)
+        logger.info(traceback.format_exc())
         return 1
 
     return 0
@@ -0,0 +1,539 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# vim:ts=4:sw=4:softtabstop=4:smarttab:expandtab
+
+"""
+Decompression and KF8 assembly benchmarks for KindleUnpack.
+
+Usage:
+  python -m lector.KindleUnpack.mobi_benchmark [-n repeat] [book.mobi ...]
+
+Text records are taken from the given books. Without books synthetic
+PalmDOC and HUFF/CDIC records and a synthetic heavily fragmented KF8 text
+are generated. Every decoder is checked against the reference
+implementation it replaced before being timed.
+"""
+
+from __future__ import unicode_literals, division, absolute_import, print_function
+
+from .compatibility_utils import PY2, bchr, lmap, bstr, unicode_argv
+
+if PY2:
+    range = xrange
+
+import os
+import re
+import sys
+import time
+import heapq
+import getopt
+import random
+import struct
+
+from .mobi_sectioner import Sectionizer
+from .mobi_header import MobiHeader
+from .mobi_uncompress import PalmdocReader, HuffcdicReader
+from .mobi_k8proc import assembleParts, locate_beg_end_of_tag
+
+
+class ReferencePalmdocReader:
+    # the original byte at a time decoder, kept to verify and time against
+
+    def unpack(self, i):
+        o, p = b'', 0
+        while p < len(i):
+            c = ord(i[p:p+1])
+            p += 1
+            if (c >= 1 and c <= 8):
+                o += i[p:p+c]
+                p += c
+            elif (c < 128):
+                o += bchr(c)
+            elif (c >= 192):
+                o += b' ' + bchr(c ^ 128)
+            else:
+                if p < len(i):
+                    c = (c << 8) | ord(i[p:p+1])
+                    p += 1
+                    m = (c >> 3) & 0x07ff
+                    n = (c & 7) + 3
+                    if (m > n):
+                        o += o[-m:n-m]
+                    else:
+                        for _ in range(n):
+                            if m == 1:
+                                o += o[-m:]
+                            else:
+                                o += o[-m:-m+1]
+        return o
+
+
+class ReferenceHuffcdicReader:
+    # the original decoder, kept to verify and time against
+    q = struct.Struct(b'>Q').unpack_from
+
+    def loadHuff(self, huff):
+        off1, off2 = struct.unpack_from(b'>LL', huff, 8)
+
+        def dict1_unpack(v):
+            codelen, term, maxcode = v&0x1f, v&0x80, v>>8
+            maxcode = ((maxcode + 1) << (32 - codelen)) - 1
+            return (codelen, term, maxcode)
+        self.dict1 = lmap(dict1_unpack, struct.unpack_from(b'>256L', huff, off1))
+
+        dict2 = struct.unpack_from(b'>64L', huff, off2)
+        self.mincode, self.maxcode = (), ()
+        for codelen, mincode in enumerate((0,) + dict2[0::2]):
+            self.mincode += (mincode << (32 - codelen), )
+        for codelen, maxcode in enumerate((0,) + dict2[1::2]):
+            self.maxcode += (((maxcode + 1) << (32 - codelen)) - 1, )
+
+        self.dictionary = []
+
+    def loadCdic(self, cdic):
+        phrases, bits = struct.unpack_from(b'>LL', cdic, 8)
+        n = min(1<<bits, phrases-len(self.dictionary))
+        h = struct.Struct(b'>H').unpack_from
+        def getslice(off):
+            blen, = h(cdic, 16+off)
+            slice = cdic[18+off:18+off+(blen&0x7fff)]
+            return (slice, blen&0x8000)
+        self.dictionary += lmap(getslice, struct.unpack_from(bstr('>%dH' % n), cdic, 16))
+
+    def unpack(self, data):
+        q = ReferenceHuffcdicReader.q
+
+        bitsleft = len(data) * 8
+        data += b"\x00\x00\x00\x00\x00\x00\x00\x00"
+        pos = 0
+        x, = q(data, pos)
+        n = 32
+
+        s = b''
+        while True:
+            if n <= 0:
+                pos += 4
+                x, = q(data, pos)
+                n += 32
+            code = (x >> n) & ((1 << 32) - 1)
+
+            codelen, term, maxcode = self.dict1[code >> 24]
+            if not term:
+                while code < self.mincode[codelen]:
+                    codelen += 1
+                maxcode = self.maxcode[codelen]
+
+            n -= codelen
+            bitsleft -= codelen
+            if bitsleft < 0:
+                break
+
+            r = (maxcode - code) >> (32 - codelen)
+            slice, flag = self.dictionary[r]
+            if not flag:
+                self.dictionary[r] = None
+                slice = self.unpack(slice)
+                self.dictionary[r] = (slice, 1)
+            s += slice
+        return s
+
+
+def referenceAssembleParts(text, skeltbl, fragtbl):
+    # the original assembly, copying the skeleton for every fragment
+    parts = []
+    partinfo = []
+    fragptr = 0
+    baseptr = 0
+    cnt = 0
+    filename = 'part%04d.xhtml' % cnt
+    for [skelnum, skelname, fragcnt, skelpos, skellen] in skeltbl:
+        baseptr = skelpos + skellen
+        skeleton = text[skelpos: baseptr]
+        aidtext = "0"
+        for i in range(fragcnt):
+            [insertpos, idtext, filenum, seqnum, startpos, length] = fragtbl[fragptr]
+            aidtext = idtext[12:-2]
+            if i == 0:
+                filename = 'part%04d.xhtml' % filenum
+            slice = text[baseptr: baseptr + length]
+            insertpos = insertpos - skelpos
+            head = skeleton[:insertpos]
+            tail = skeleton[insertpos:]
+            actual_inspos = insertpos
+            if (tail.find(b'>') < tail.find(b'<') or head.rfind(b'>') < head.rfind(b'<')):
+                bp, ep = locate_beg_end_of_tag(skeleton, aidtext)
+                if bp != ep:
+                    actual_inspos = ep + 1 + startpos
+            if insertpos != actual_inspos:
+                insertpos = actual_inspos
+                fragtbl[fragptr][0] = actual_inspos + skelpos
+            skeleton = skeleton[0:insertpos] + slice + skeleton[insertpos:]
+            baseptr = baseptr + length
+            fragptr += 1
+        cnt += 1
+        parts.append(skeleton)
+        partinfo.append([skelnum, 'Text', filename, skelpos, baseptr, aidtext])
+    return parts, partinfo
+
+
+def palmdoc_compress(data):
+    # greedy PalmDOC compressor used to build synthetic records
+    out = bytearray()
+    p, end = 0, len(data)
+    while p < end:
+        best_len, best_dist = 0, 0
+        for dist in range(1, min(p, 2047) + 1):
+            length = 0
+            while length < 10 and p + length < end and data[p + length - dist] == data[p + length]:
+                length += 1
+            if length > best_len:
+                best_len, best_dist = length, dist
+                if length == 10:
+                    break
+        c = data[p]
+        if best_len >= 3:
+            code = 0x8000 | (best_dist << 3) | (best_len - 3)
+            out.append(code >> 8)
+            out.append(code & 0xff)
+            p += best_len
+        elif c == 32 and p + 1 < end and 0x40 <= data[p + 1] < 0x80:
+            out.append(data[p + 1] ^ 0x80)
+            p += 2
+        elif c == 0 or 0x09 <= c < 0x80:
+            out.append(c)
+            p += 1
+        else:
+            out.append(1)
+            out.append(c)
+            p += 1
+    return bytes(out)
+
+
+class HuffcdicWriter:
+    # builds HUFF and CDIC sections for a phrase dictionary and encodes text
+    # with them, using the canonical code layout the decoder expects
+
+    def __init__(self, text, phrase_count=2048, pair_count=512):
+        words = re.findall(br'[^ ]+ ', text)
+        counts = {}
+        for w in words:
+            counts[w] = counts.get(w, 0) + 1
+        common = sorted(counts, key=lambda w: (-counts[w], w))
+        self.literals = [bchr(c) for c in range(256)] + common[:phrase_count]
+        pairs = {}
+        for a, b in zip(words, words[1:]):
+            if a + b not in counts:
+                pairs[a + b] = pairs.get(a + b, 0) + 1
+        self.pairs = sorted(pairs, key=lambda w: (-pairs[w], w))[:pair_count]
+        self.symbols = self.literals + self.pairs
+        self.index = dict((p, i) for i, p in enumerate(self.symbols))
+        self.tokenizer = self.compileTokenizer(self.symbols)
+
+        # code lengths follow the symbol frequencies of the text itself
+        freq = [1] * len(self.symbols)
+        for token in self.tokens(text):
+            freq[token] += 1
+        self.lengths = self.codeLengths(freq)
+        self.assignCodes()
+        # pairs are stored compressed in terms of the literal phrases
+        literals = self.compileTokenizer(self.literals)
+        self.bodies = list(self.literals)
+        self.bodies += [self.encode(self.tokens(p, literals)) for p in self.pairs]
+
+    def compileTokenizer(self, phrases):
+        alternatives = sorted(phrases, key=len, reverse=True)
+        return re.compile(b'|'.join(re.escape(a) for a in alternatives), re.S)
+
+    def tokens(self, text, tokenizer=None):
+        tokenizer = tokenizer or self.tokenizer
+        return [self.index[m.group()] for m in tokenizer.finditer(text)]
+
+    def codeLengths(self, freq):
+        heap = [(f, i, None) for i, f in enumerate(freq)]
+        heapq.heapify(heap)
+        uid = len(heap)
+        while len(heap) > 1:
+            a = heapq.heappop(heap)
+            b = heapq.heappop(heap)
+            heapq.heappush(heap, (a[0] + b[0], uid, (a, b)))
+            uid += 1
+        lengths = [0] * len(freq)
+        stack = [(heap[0], 0)]
+        while stack:
+            (f, i, children), depth = stack.pop()
+            if children is None:
+                lengths[i] = max(depth, 1)
+            else:
+                stack.append((children[0], depth + 1))
+                stack.append((children[1], depth + 1))
+        return lengths
+
+    def assignCodes(self):
+        # longer codes take the numerically smallest values, symbols of the
+        # same length are numbered down from the largest code
+        count = [0] * 33
+        for l in self.lengths:
+            count[l] += 1
+        self.start = [0] * 34
+        for l in range(32, 0, -1):
+            self.start[l] = (self.start[l + 1] + count[l + 1] + 1) >> 1 if l < 32 else 0
+        self.first = [0] * 33
+        nextindex = 0
+        for l in range(1, 33):
+            self.first[l] = nextindex
+            nextindex += count[l]
+        order = sorted(range(len(self.lengths)), key=lambda i: (self.lengths[i], i))
+        self.position = [0] * len(self.symbols)
+        self.codes = [0] * len(self.symbols)
+        seen = [0] * 33
+        for i in order:
+            l = self.lengths[i]
+            self.position[i] = self.first[l] + seen[l]
+            self.codes[i] = self.start[l] + count[l] - 1 - seen[l]
+            seen[l] += 1
+        self.count = count
+        # dictionary index order follows the code layout
+        self.order = sorted(range(len(self.symbols)), key=lambda i: self.position[i])
+
+    def maxcode(self, l):
+        return max(0, self.start[l] + self.count[l] - 1 + self.first[l])
+
+    def encode(self, tokens):
+        acc, nbits = 0, 0
+        for t in tokens:
+            acc = (acc << self.lengths[t]) | self.codes[t]
+            nbits += self.lengths[t]
+        pad = -nbits % 8
+        return (acc << pad).to_bytes((nbits + pad) // 8, 'big')
+
+    def huffSection(self):
+        dict1 = []
+        for prefix in range(256):
+            for l in range(1, 9):
+                if (prefix >> (8 - l)) >= self.start[l] and self.count[l]:
+                    dict1.append(l | 0x80 | (self.maxcode(l) << 8))
+                    break
+            else:
+                dict1.append(9)
+        dict2 = []
+        for l in range(1, 33):
+            dict2 += [self.start[l], self.maxcode(l)]
+        return (b'HUFF\x00\x00\x00\x18' + struct.pack(b'>LL8x', 24, 24 + 1024) +
+                struct.pack(b'>256L', *dict1) + struct.pack(b'>64L', *dict2))
+
+    def cdicSections(self, bits=10):
+        sections = []
+        total = len(self.order)
+        for base in range(0, total, 1 << bits):
+            chunk = self.order[base:base + (1 << bits)]
+            offsets, body = [], b''
+            for i in chunk:
+                offsets.append(2 * len(chunk) + len(body))
+                flag = 0x8000 if i < len(self.literals) else 0
+                body += struct.pack(b'>H', len(self.bodies[i]) | flag) + self.bodies[i]
+            sections.append(b'CDIC\x00\x00\x00\x10' + struct.pack(b'>LL', total, bits) +
+                            struct.pack(bstr('>%dH' % len(chunk)), *offsets) + body)
+        return sections
+
+    def record(self, text):
+        return self.encode(self.tokens(text))
+
+
+def syntheticText(size, seed=0):
+    # prose-like markup built from a few thousand made up words
+    rng = random.Random(seed)
+    syllables = ['ka', 'lo', 'mi', 'ne', 'ru', 'sa', 'to', 'vi', 'an', 'er',
+                 'in', 'or', 'th', 'st', 'ch', 'ou', 'ea', 'ly', 'ing', 'ed',
+                 'ti', 'on', 'es', 'ar', 'caf\xe9', 'na\xef', '\u2014']
+    words = [''.join(rng.choice(syllables) for _ in range(rng.randint(1, 4)))
+             for _ in range(3000)]
+    out = []
+    length = 0
+    while length < size:
+        paragraph = ' '.join(rng.choice(words) for _ in range(rng.randint(20, 80)))
+        chunk = ('<p>' + paragraph.capitalize() + '.</p>\n').encode('utf-8')
+        out.append(chunk)
+        length += len(chunk)
+    return b''.join(out)[:size]
+
+
+def syntheticRecords(count=64, size=4096):
+    text = syntheticText(count * size)
+    return [palmdoc_compress(text[i:i+size]) for i in range(0, len(text), size)]
+
+
+def syntheticHuffcdic(count=64, size=4096):
+    text = syntheticText(count * size, seed=1)
+    writer = HuffcdicWriter(text)
+    records = [writer.record(text[i:i+size]) for i in range(0, len(text), size)]
+    return records, [writer.huffSection()] + writer.cdicSections()
+
+
+def syntheticKF8(skeletons=8, fragments=4000, seed=0):
+    # rawML text with skeleton and fragment tables, fragments are appended
+    # to the body or nested in the previous fragment like kindlegen does
+    rng = random.Random(seed)
+    words = syntheticText(1 << 16, seed).split(b' ')
+    text = []
+    skeltbl = []
+    fragtbl = []
+    pos = 0
+    for skelnum in range(skeletons):
+        skeleton = b'<html><head><title>part</title></head><body aid="0"></body></html>'
+        skeltbl.append([skelnum, b'SKEL%07d' % skelnum, fragments, pos, len(skeleton)])
+        text.append(skeleton)
+        pos += len(skeleton)
+        insertpos = skeleton.find(b'</body>')
+        for seqnum in range(fragments):
+            aid = bstr('%d' % (len(fragtbl) + 1))
+            paragraph = b' '.join(rng.choice(words) for _ in range(rng.randint(5, 40)))
+            fragment = b'<div aid="' + aid + b'"><p>' + paragraph + b'</p></div>'
+            idtext = b'kindle:pos:fid:' + aid + b':off:0000000000'
+            fragtbl.append([skeltbl[-1][3] + insertpos, idtext, skelnum, seqnum, 0, len(fragment)])
+            text.append(fragment)
+            pos += len(fragment)
+            if rng.random() < 0.3:
+                # the next fragment goes inside this one
+                insertpos += len(fragment) - len(b'</div>')
+            else:
+                insertpos += len(fragment)
+    return b''.join(text), skeltbl, fragtbl
+
+
+def bookRecords(infile):
+    # collect the trimmed text records of every mobi header in a book
+    # as (compression, records, huff and cdic sections) tuples
+    books = []
+    sect = Sectionizer(infile)
+    try:
+        mhlst = [MobiHeader(sect, 0)]
+        for i in range(len(sect.sectionoffsets) - 1):
+            before, after = sect.sectionoffsets[i:i+2]
+            if (after - before) == 8 and sect.loadSection(i) == b'BOUNDARY':
+                mhlst.append(MobiHeader(sect, i + 1))
+                break
+        for mh in mhlst:
+            if mh.isEncrypted():
+                continue
+            records = [mh.getTextRecord(i).tobytes() for i in range(1, mh.records + 1)]
+            tables = []
+            if mh.compression == 0x4448:
+                huffoff, huffnum = struct.unpack_from(b'>LL', mh.header, 0x70)
+                huffoff = huffoff + mh.start
+                tables = [sect.loadSection(huffoff + i) for i in range(huffnum)]
+            books.append((mh.compression, records, tables))
+    finally:
+        sect.close()
+    return books
+
+
+def timeDecoder(unpack, records, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for record in records:
+            unpack(record)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def compareDecoders(label, decoders, records, repeat):
+    # decoders is a list of (name, unpack) pairs, the first is the reference
+    expected = [bytes(decoders[0][1](r)) for r in records]
+    size = sum(len(e) for e in expected)
+    print("%s: %d records, %d bytes decompressed" % (label, len(records), size))
+    baseline = None
+    for name, unpack in decoders:
+        if [bytes(unpack(r)) for r in records] != expected:
+            print("    %-12s OUTPUT DIFFERS FROM REFERENCE" % name)
+            continue
+        elapsed = timeDecoder(unpack, records, repeat)
+        baseline = baseline or elapsed
+        print("    %-12s %8.2f ms %8.2f MB/s %6.1fx" % (
+            name, elapsed * 1000, size / elapsed / 1e6, baseline / elapsed))
+
+
+def benchmarkPalmdoc(records, repeat, label="PalmDOC"):
+    decoders = [('reference', ReferencePalmdocReader().unpack),
+                ('current', PalmdocReader().unpack)]
+    compareDecoders(label, decoders, records, repeat)
+
+
+def benchmarkHuffcdic(records, tables, repeat, label="HUFF/CDIC"):
+    decoders = []
+    for name, reader in (('reference', ReferenceHuffcdicReader()),
+                         ('current', HuffcdicReader())):
+        reader.loadHuff(tables[0])
+        for cdic in tables[1:]:
+            reader.loadCdic(cdic)
+        decoders.append((name, reader.unpack))
+    compareDecoders(label, decoders, records, repeat)
+
+
+def benchmarkAssembly(text, skeltbl, fragtbl, repeat, label="KF8 assembly"):
+    # every run repairs its own copy of the fragment table
+    builders = [('reference', referenceAssembleParts), ('current', assembleParts)]
+    expected = referenceAssembleParts(text, skeltbl, [f[:] for f in fragtbl])
+    size = sum(len(part) for part in expected[0])
+    print("%s: %d skeletons, %d fragments, %d bytes assembled" % (label, len(skeltbl), len(fragtbl), size))
+    baseline = None
+    for name, build in builders:
+        if build(text, skeltbl, [f[:] for f in fragtbl]) != expected:
+            print("    %-12s OUTPUT DIFFERS FROM REFERENCE" % name)
+            continue
+        best = None
+        for _ in range(repeat):
+            fragcopy = [f[:] for f in fragtbl]
+            start = time.perf_counter()
+            build(text, skeltbl, fragcopy)
+            elapsed = time.perf_counter() - start
+            if best is None or elapsed < best:
+                best = elapsed
+        baseline = baseline or best
+        print("    %-12s %8.2f ms %8.2f MB/s %6.1fx" % (
+            name, best * 1000, size / best / 1e6, baseline / best))
+
+
+def usage(progname):
+    print("Usage:")
+    print("  %s [-n repeat] [book.mobi ...]" % progname)
+
+
+def main(argv=unicode_argv()):
+    progname = os.path.basename(argv[0])
+    try:
+        opts, args = getopt.getopt(argv[1:], "hn:")
+    except getopt.GetoptError as err:
+        print(str(err))
+        usage(progname)
+        return 2
+
+    repeat = 3
+    for o, a in opts:
+        if o == "-h":
+            usage(progname)
+            return 0
+        if o == "-n":
+            repeat = int(a)
+
+    if not args:
+        benchmarkPalmdoc(syntheticRecords(), repeat, "PalmDOC (synthetic)")
+        records, tables = syntheticHuffcdic()
+        benchmarkHuffcdic(records, tables, repeat, "HUFF/CDIC (synthetic)")
+        text, skeltbl, fragtbl = syntheticKF8()
+        benchmarkAssembly(text, skeltbl, fragtbl, repeat, "KF8 assembly (synthetic)")
+        return 0
+
+    for infile in args:
+        name = os.path.basename(infile)
+        for compression, records, tables in bookRecords(infile):
+            if compression == 2:
+                benchmarkPalmdoc(records, repeat, "PalmDOC (%s)" % name)
+            elif compression == 0x4448:
+                benchmarkHuffcdic(records, tables, repeat, "HUFF/CDIC (%s)" % name)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -4,6 +4,7 @@
 
 from __future__ import unicode_literals, division, absolute_import, print_function
 
+import logging
 from .compatibility_utils import unicode_str
 
 from .unipath import pathof
@@ -11,6 +12,8 @@ import os
 import imghdr
 
 import struct
+
+logger = logging.getLogger(__name__)
 # note:  struct pack, unpack, unpack_from all require bytestring format
 # data all the way up to at least python 2.7.5, python 3 okay with bytestring
 
@@ -34,7 +37,11 @@ MAX_HEIGHT = 4096
 
 
 def get_image_type(imgname, imgdata=None):
-    imgtype = unicode_str(imghdr.what(pathof(imgname), imgdata))
+    imghead = imgdata
+    if isinstance(imgdata, memoryview):
+        # imghdr needs bytes and only looks at the first few of them
+        imghead = imgdata[:32].tobytes()
+    imgtype = unicode_str(imghdr.what(pathof(imgname), imghead))
 
     # imghdr only checks for JFIF or Exif JPEG files. Apparently, there are some
     # with only the magic JPEG bytes out there...
@@ -148,14 +155,13 @@ class CoverProcessor(object):
             if cover_image is not None:
                 self.cover_image = cover_image
             else:
-                print('Warning: Cannot identify the cover image.')
+                logger.warning('Warning: Cannot identify the cover image.')
         if self.use_svg:
             try:
                 if imgdata is None:
                     fname = os.path.join(files.imgdir, self.cover_image)
-                    [self.width, self.height] = get_image_size(fname)
-                else:
-                    [self.width, self.height] = get_image_size(None, imgdata)
+                    imgdata = files.read(fname)
+                [self.width, self.height] = get_image_size(None, imgdata)
             except:
                 self.use_svg = False
             width = self.width
@@ -171,7 +177,7 @@ class CoverProcessor(object):
         return self.cover_page
 
     def buildXHTML(self):
-        print('Building a cover page.')
+        logger.info('Building a cover page.')
         files = self.files
         cover_image = self.cover_image
         title = self.title
@@ -223,11 +229,10 @@ class CoverProcessor(object):
         data = self.buildXHTML()
 
         outfile = os.path.join(files.k8text, cover_page)
-        if os.path.exists(pathof(outfile)):
-            print('Warning: {:s} already exists.'.format(cover_page))
-            os.remove(pathof(outfile))
-        with open(pathof(outfile), 'wb') as f:
-            f.write(data.encode('utf-8'))
+        if files.exists(outfile):
+            logger.info('Warning: {:s} already exists.'.format(cover_page))
+            files.remove(outfile)
+        files.write(outfile, data.encode('utf-8'))
         return
 
     def guide_toxml(self):
@@ -4,6 +4,7 @@
 
 from __future__ import unicode_literals, division, absolute_import, print_function
 
+import logging
 from .compatibility_utils import PY2, PY3, utf8_str, bstr, bchr
 
 if PY2:
@@ -22,6 +23,8 @@ import struct
 from .mobi_index import getVariableWidthValue, readTagSection, getTagMap
 from .mobi_utils import toHex
 
+logger = logging.getLogger(__name__)
+
 DEBUG_DICT = False
 
 class InflectionData(object):
@@ -43,7 +46,7 @@ class InflectionData(object):
             rvalue = rvalue - self.counts[i]
             i += 1
             if i == len(self.counts):
-                print("Error: Problem with multiple inflections data sections")
+                logger.error("Error: Problem with multiple inflections data sections")
                 return lookupvalue, self.starts[0], self.counts[0], self.infldatas[0]
         return rvalue, self.starts[i], self.counts[i], self.infldatas[i]
 
@@ -69,7 +72,7 @@ class dictSupport(object):
     def parseHeader(self, data):
         "read INDX header"
         if not data[:4] == b'INDX':
-            print("Warning: index section is not INDX")
+            logger.warning("Warning: index section is not INDX")
             return False
         words = (
                 'len', 'nul1', 'type', 'gen', 'start', 'count', 'code',
@@ -89,7 +92,7 @@ class dictSupport(object):
         header['oentries'] = oentries
 
         if DEBUG_DICT:
-            print("otype %d, oentries %d, op1 %d, op2 %d, otagx %d" % (otype, oentries, op1, op2, otagx))
+            logger.info("otype %d, oentries %d, op1 %d, op2 %d, otagx %d" % (otype, oentries, op1, op2, otagx))
 
         if header['code'] == 0xfdea or oentries > 0:
             # some dictionaries seem to be codepage 65002 (0xFDEA) which seems
@@ -107,10 +110,10 @@ class dictSupport(object):
             ordt2 = struct.unpack_from(bstr('>%dH' % oentries), data, op2+4)
 
         if DEBUG_DICT:
-            print("parsed INDX header:")
+            logger.info("parsed INDX header:")
             for key in header:
-                print(key, "%x" % header[key],)
-            print("\n")
+                logger.info('%s %s', key, "%x" % header[key])
+            logger.info("\n")
         return header, ordt1, ordt2
 
     def getPositionMap(self):
@@ -123,13 +126,13 @@ class dictSupport(object):
 
         decodeInflection = True
         if metaOrthIndex != 0xFFFFFFFF:
-            print("Info: Document contains orthographic index, handle as dictionary")
+            logger.info("Info: Document contains orthographic index, handle as dictionary")
             if metaInflIndex == 0xFFFFFFFF:
                 decodeInflection = False
             else:
                 metaInflIndexData = sect.loadSection(metaInflIndex)
 
-                print("\nParsing metaInflIndexData")
+                logger.info("\nParsing metaInflIndexData")
                 midxhdr, mhordt1, mhordt2 = self.parseHeader(metaInflIndexData)
 
                 metaIndexCount = midxhdr['count']
@@ -142,29 +145,29 @@ class dictSupport(object):
                 tagSectionStart = midxhdr['len']
                 inflectionControlByteCount, inflectionTagTable = readTagSection(tagSectionStart, metaInflIndexData)
                 if DEBUG_DICT:
-                    print("inflectionTagTable: %s" % inflectionTagTable)
+                    logger.info("inflectionTagTable: %s" % inflectionTagTable)
                 if self.hasTag(inflectionTagTable, 0x07):
-                    print("Error: Dictionary uses obsolete inflection rule scheme which is not yet supported")
+                    logger.error("Error: Dictionary uses obsolete inflection rule scheme which is not yet supported")
                     decodeInflection = False
 
             data = sect.loadSection(metaOrthIndex)
 
-            print("\nParsing metaOrthIndex")
+            logger.info("\nParsing metaOrthIndex")
             idxhdr, hordt1, hordt2 = self.parseHeader(data)
 
             tagSectionStart = idxhdr['len']
             controlByteCount, tagTable = readTagSection(tagSectionStart, data)
             orthIndexCount = idxhdr['count']
-            print("orthIndexCount is", orthIndexCount)
+            logger.info("orthIndexCount is %s", orthIndexCount)
             if DEBUG_DICT:
-                print("orthTagTable: %s" % tagTable)
+                logger.info("orthTagTable: %s" % tagTable)
             if hordt2 is not None:
-                print("orth entry uses ordt2 lookup table of type ", idxhdr['otype'])
+                logger.info("orth entry uses ordt2 lookup table of type  %s", idxhdr['otype'])
             hasEntryLength = self.hasTag(tagTable, 0x02)
             if not hasEntryLength:
-                print("Info: Index doesn't contain entry length tags")
+                logger.info("Info: Index doesn't contain entry length tags")
 
-            print("Read dictionary index data")
+            logger.info("Read dictionary index data")
             for i in range(metaOrthIndex + 1, metaOrthIndex + 1 + orthIndexCount):
                 data = sect.loadSection(i)
                 hdrinfo, ordt1, ordt2 = self.parseHeader(data)
@@ -265,10 +268,10 @@ class dictSupport(object):
 
             # Make sure that the required tags are available.
             if 0x05 not in tagMap:
-                print("Error: Required tag 0x05 not found in tagMap")
+                logger.error("Error: Required tag 0x05 not found in tagMap")
                 return ""
             if 0x1a not in tagMap:
-                print("Error: Required tag 0x1a not found in tagMap")
+                logger.error("Error: Required tag 0x1a not found in tagMap")
                 return b''
 
             result += b'<idx:infl>'
@@ -317,10 +320,10 @@ class dictSupport(object):
                 position -= offset
             elif abyte > 0x13:
                 if mode == -1:
-                    print("Error: Unexpected first byte %i of inflection rule" % abyte)
+                    logger.error("Error: Unexpected first byte %i of inflection rule" % abyte)
                     return None
                 elif position == -1:
-                    print("Error: Unexpected first byte %i of inflection rule" % abyte)
+                    logger.error("Error: Unexpected first byte %i of inflection rule" % abyte)
                     return None
                 else:
                     if mode == 0x01:
@@ -336,19 +339,19 @@ class dictSupport(object):
                         deleted = byteArray.pop(position)
                         if bchr(deleted) != char:
                             if DEBUG_DICT:
-                                print("0x03: %s %s %s %s" % (mainEntry, toHex(inflectionRuleData[start:end]), char, bchr(deleted)))
-                            print("Error: Delete operation of inflection rule failed")
+                                logger.info("0x03: %s %s %s %s" % (mainEntry, toHex(inflectionRuleData[start:end]), char, bchr(deleted)))
+                            logger.error("Error: Delete operation of inflection rule failed")
                             return None
                     elif mode == 0x04:
                         # Delete at word start
                         deleted = byteArray.pop(position)
                         if bchr(deleted) != char:
                             if DEBUG_DICT:
-                                print("0x03: %s %s %s %s" % (mainEntry, toHex(inflectionRuleData[start:end]), char, bchr(deleted)))
-                            print("Error: Delete operation of inflection rule failed")
+                                logger.info("0x03: %s %s %s %s" % (mainEntry, toHex(inflectionRuleData[start:end]), char, bchr(deleted)))
+                            logger.error("Error: Delete operation of inflection rule failed")
                             return None
                     else:
-                        print("Error: Inflection rule mode %x is not implemented" % mode)
+                        logger.error("Error: Inflection rule mode %x is not implemented" % mode)
                         return None
             elif abyte == 0x01:
                 # Insert at word start
@@ -372,6 +375,6 @@ class dictSupport(object):
                 # Delete at word start
                 mode = abyte
             else:
-                print("Error: Inflection rule mode %x is not implemented" % abyte)
+                logger.error("Error: Inflection rule mode %x is not implemented" % abyte)
                 return None
         return utf8_str(byteArray.tostring())
@@ -12,22 +12,64 @@ if DEBUG_USE_ORDERED_DICTIONARY:
 else:
     dict_ = dict
 
+import logging
 from .compatibility_utils import PY2, unicode_str, hexlify, bord
 
 if PY2:
     range = xrange
 
+import os
 import struct
 import uuid
+import multiprocessing
 
 # import the mobiunpack support libraries
 from .mobi_utils import getLanguage
 from .mobi_uncompress import HuffcdicReader, PalmdocReader, UncompressedReader
+from .mobi_sectioner import Sectionizer
+
+logger = logging.getLogger(__name__)
+
+PARALLEL_MIN_RECORDS = 1024
+""" Books with fewer text records than this are always unpacked serially. """
+
+PARALLEL_CHUNK_RECORDS = 64
+""" Number of text records handed to a worker process at a time. """
 
 class unpackException(Exception):
     pass
 
 
+# each worker process maps the book itself and keeps its own copy of the
+# mobi header, so only record numbers and decompressed text are exchanged
+# the pool may be shared with other work, so a worker opens the book the
+# first time it is handed a span of it and holds on to it for the rest
+# the key includes the file's size and mtime, so a book that is rewritten
+# in place between two opens is mapped again instead of read stale
+recordWorkerHeader = None
+recordWorkerKey = None
+
+def fileFingerprint(filename):
+    stat = os.stat(filename)
+    return (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+
+def getRecordWorkerHeader(filename, start, fingerprint):
+    global recordWorkerHeader, recordWorkerKey
+    key = (filename, start, fingerprint)
+    if recordWorkerKey != key:
+        if recordWorkerHeader is not None:
+            recordWorkerHeader.sect.close()
+            recordWorkerHeader = None
+        recordWorkerHeader = MobiHeader(Sectionizer(filename), start)
+        recordWorkerKey = key
+    return recordWorkerHeader
+
+def unpackRecordSpan(task):
+    filename, start, fingerprint, first, last = task
+    mh = getRecordWorkerHeader(filename, start, fingerprint)
+    return b''.join([mh.unpack(mh.getTextRecord(i)) for i in range(first, last)])
+
+
 def sortedHeaderKeys(mheader):
     hdrkeys = sorted(list(mheader.keys()), key=lambda akey: mheader[akey][0])
     return hdrkeys
@@ -169,27 +211,27 @@ def dump_contexth(cpage, extheader):
         content = extheader[pos + 8: pos + size]
         if id in id_map_strings:
             name = id_map_strings[id]
-            print('\n    Key: "%s"\n        Value: "%s"' % (name, content.decode(codec, errors='replace')))
+            logger.info('\n    Key: "%s"\n        Value: "%s"' % (name, content.decode(codec, errors='replace')))
         elif id in id_map_values:
             name = id_map_values[id]
             if size == 9:
                 value, = struct.unpack(b'B',content)
-                print('\n    Key: "%s"\n        Value: 0x%01x' % (name, value))
+                logger.info('\n    Key: "%s"\n        Value: 0x%01x' % (name, value))
             elif size == 10:
                 value, = struct.unpack(b'>H',content)
-                print('\n    Key: "%s"\n        Value: 0x%02x' % (name, value))
+                logger.info('\n    Key: "%s"\n        Value: 0x%02x' % (name, value))
             elif size == 12:
                 value, = struct.unpack(b'>L',content)
-                print('\n    Key: "%s"\n        Value: 0x%04x' % (name, value))
+                logger.info('\n    Key: "%s"\n        Value: 0x%04x' % (name, value))
             else:
-                print("\nError: Value for %s has unexpected size of %s" % (name, size))
+                logger.error("\nError: Value for %s has unexpected size of %s" % (name, size))
         elif id in id_map_hexstrings:
             name = id_map_hexstrings[id]
-            print('\n    Key: "%s"\n        Value: 0x%s' % (name, hexlify(content)))
+            logger.info('\n    Key: "%s"\n        Value: 0x%s' % (name, hexlify(content)))
         else:
-            print("\nWarning: Unknown metadata with id %s found" % id)
+            logger.warning("\nWarning: Unknown metadata with id %s found" % id)
             name = str(id) + ' (hex)'
-            print('    Key: "%s"\n        Value: 0x%s' % (name, hexlify(content)))
+            logger.info('    Key: "%s"\n        Value: 0x%s' % (name, hexlify(content)))
         pos += size
     return
 
@@ -537,23 +579,14 @@ class MobiHeader:
         self.metadata = dict_()
 
         # set up for decompression/unpacking
+        # the reader itself is only created once text is unpacked so that
+        # metadata only access never loads the HUFF/CDIC sections
         self.compression, = struct.unpack_from(b'>H', self.header, 0x0)
-        if self.compression == 0x4448:
-            reader = HuffcdicReader()
-            huffoff, huffnum = struct.unpack_from(b'>LL', self.header, 0x70)
-            huffoff = huffoff + self.start
-            self.sect.setsectiondescription(huffoff,"Huffman Compression Seed")
-            reader.loadHuff(self.sect.loadSection(huffoff))
-            for i in range(1, huffnum):
-                self.sect.setsectiondescription(huffoff+i,"Huffman CDIC Compression Seed %d" % i)
-                reader.loadCdic(self.sect.loadSection(huffoff+i))
-            self.unpack = reader.unpack
-        elif self.compression == 2:
-            self.unpack = PalmdocReader().unpack
-        elif self.compression == 1:
-            self.unpack = UncompressedReader().unpack
-        else:
+        if self.compression not in (0x4448, 2, 1):
             raise unpackException('invalid compression type: 0x%4x' % self.compression)
+        self.reader = None
+        self.multibyte = 0
+        self.trailers = None
 
         if self.palm:
             return
@@ -661,33 +694,33 @@ class MobiHeader:
             return
         num_items, = struct.unpack(b'>L', self.exth[8:12])
         pos = 12
-        print("Key Size Decription                     Value")
+        logger.info("Key Size Decription                     Value")
         for _ in range(num_items):
             id, size = struct.unpack(b'>LL', self.exth[pos:pos+8])
             contentsize = size-8
             content = self.exth[pos + 8: pos + size]
             if id in MobiHeader.id_map_strings:
                 exth_name = MobiHeader.id_map_strings[id]
-                print('{0: >3d} {1: >4d} {2: <30s} {3:s}'.format(id, contentsize, exth_name, content.decode(codec, errors='replace')))
+                logger.info('{0: >3d} {1: >4d} {2: <30s} {3:s}'.format(id, contentsize, exth_name, content.decode(codec, errors='replace')))
             elif id in MobiHeader.id_map_values:
                 exth_name = MobiHeader.id_map_values[id]
                 if size == 9:
                     value, = struct.unpack(b'B',content)
-                    print('{0:3d} byte {1:<30s} {2:d}'.format(id, exth_name, value))
+                    logger.info('{0:3d} byte {1:<30s} {2:d}'.format(id, exth_name, value))
                 elif size == 10:
                     value, = struct.unpack(b'>H',content)
-                    print('{0:3d} word {1:<30s} 0x{2:0>4X} ({2:d})'.format(id, exth_name, value))
+                    logger.info('{0:3d} word {1:<30s} 0x{2:0>4X} ({2:d})'.format(id, exth_name, value))
                 elif size == 12:
                     value, = struct.unpack(b'>L',content)
-                    print('{0:3d} long {1:<30s} 0x{2:0>8X} ({2:d})'.format(id, exth_name, value))
+                    logger.info('{0:3d} long {1:<30s} 0x{2:0>8X} ({2:d})'.format(id, exth_name, value))
                 else:
-                    print('{0: >3d} {1: >4d} {2: <30s} (0x{3:s})'.format(id, contentsize, "Bad size for "+exth_name, hexlify(content)))
+                    logger.info('{0: >3d} {1: >4d} {2: <30s} (0x{3:s})'.format(id, contentsize, "Bad size for "+exth_name, hexlify(content)))
             elif id in MobiHeader.id_map_hexstrings:
                 exth_name = MobiHeader.id_map_hexstrings[id]
-                print('{0:3d} {1:4d} {2:<30s} 0x{3:s}'.format(id, contentsize, exth_name, hexlify(content)))
+                logger.info('{0:3d} {1:4d} {2:<30s} 0x{3:s}'.format(id, contentsize, exth_name, hexlify(content)))
             else:
                 exth_name = "Unknown EXTH ID {0:d}".format(id)
-                print("{0: >3d} {1: >4d} {2: <30s} 0x{3:s}".format(id, contentsize, exth_name, hexlify(content)))
+                logger.info("{0: >3d} {1: >4d} {2: <30s} 0x{3:s}".format(id, contentsize, exth_name, hexlify(content)))
             pos += size
         return
 
@@ -695,7 +728,7 @@ class MobiHeader:
         # first 16 bytes are not part of the official mobiheader
         # but we will treat it as such
         # so section 0 is 16 (decimal) + self.length in total == at least 0x108 bytes for Mobi 8 headers
-        print("Dumping section %d, Mobipocket Header version: %d, total length %d" % (self.start,self.version, self.length+16))
+        logger.info("Dumping section %d, Mobipocket Header version: %d, total length %d" % (self.start,self.version, self.length+16))
         self.hdr = {}
         # set it up for the proper header version
         if self.version == 0:
@@ -733,8 +766,8 @@ class MobiHeader:
         self.extra1 = self.header[self.exth_offset+self.exth_length:title_offset]
         self.extra2 = self.header[title_offset+title_length:]
 
-        print("Mobipocket header from section %d" % self.start)
-        print("     Offset  Value Hex Dec        Description")
+        logger.info("Mobipocket header from section %d" % self.start)
+        logger.info("     Offset  Value Hex Dec        Description")
         for key in self.mobi_header_sorted_keys:
             (pos, format, tot_len) = self.mobi_header[key]
             if pos < (self.length + 16):
@@ -743,27 +776,27 @@ class MobiHeader:
                 else:
                     self.hdr[key] = unicode_str(self.hdr[key])
                     fmt_string = "0x{0:0>3X} ({0:3d}){2:>11s}            {3:s}"
-                print(fmt_string.format(pos, " ",self.hdr[key], key))
-        print("")
+                logger.info(fmt_string.format(pos, " ",self.hdr[key], key))
+        logger.info("")
 
         if self.exth_length > 0:
-            print("EXTH metadata, offset %d, padded length %d" % (self.exth_offset,self.exth_length))
+            logger.info("EXTH metadata, offset %d, padded length %d" % (self.exth_offset,self.exth_length))
             self.dump_exth()
-            print("")
+            logger.info("")
 
         if len(self.extra1) > 0:
-            print("Extra data between EXTH and Title, length %d" % len(self.extra1))
-            print(hexlify(self.extra1))
-            print("")
+            logger.info("Extra data between EXTH and Title, length %d" % len(self.extra1))
+            logger.info(hexlify(self.extra1))
+            logger.info("")
 
         if title_length > 0:
-            print("Title in header at offset %d, padded length %d: '%s'" %(title_offset,title_length,self.title))
-            print("")
+            logger.info("Title in header at offset %d, padded length %d: '%s'" %(title_offset,title_length,self.title))
+            logger.info("")
 
         if len(self.extra2) > 0:
-            print("Extra data between Title and end of header, length %d" % len(self.extra2))
-            print(hexlify(self.extra2))
-            print("")
+            logger.info("Extra data between Title and end of header, length %d" % len(self.extra2))
+            logger.info(hexlify(self.extra2))
+            logger.info("")
 
     def isPrintReplica(self):
         return self.mlstart[0:4] == b"%MOP"
@@ -783,6 +816,26 @@ class MobiHeader:
     def getncxIndex(self):
         return self.ncxidx
 
+    def getReader(self):
+        if self.compression == 0x4448:
+            reader = HuffcdicReader()
+            huffoff, huffnum = struct.unpack_from(b'>LL', self.header, 0x70)
+            huffoff = huffoff + self.start
+            self.sect.setsectiondescription(huffoff,"Huffman Compression Seed")
+            reader.loadHuff(self.sect.loadSection(huffoff))
+            for i in range(1, huffnum):
+                self.sect.setsectiondescription(huffoff+i,"Huffman CDIC Compression Seed %d" % i)
+                reader.loadCdic(self.sect.loadSection(huffoff+i))
+            return reader.unpack
+        elif self.compression == 2:
+            return PalmdocReader().unpack
+        return UncompressedReader().unpack
+
+    def unpack(self, data):
+        if self.reader is None:
+            self.reader = self.getReader()
+        return self.reader(data)
+
     def decompress(self, data):
         return self.unpack(data)
 
@@ -810,7 +863,8 @@ class MobiHeader:
                 return getLanguage(langid, sublangid)
         return False
 
-    def getRawML(self):
+    def getTextRecord(self, i):
+        # return text record i with its trailing entries trimmed
         def getSizeOfTrailingDataEntry(data):
             num = 0
             for v in data[-4:]:
@@ -818,33 +872,67 @@ class MobiHeader:
                     num = 0
                 num = (num << 7) | (bord(v) & 0x7f)
             return num
-        def trimTrailingDataEntries(data):
-            for _ in range(trailers):
-                num = getSizeOfTrailingDataEntry(data)
-                data = data[:-num]
-            if multibyte:
-                num = (ord(data[-1:]) & 3) + 1
-                data = data[:-num]
-            return data
-        multibyte = 0
-        trailers = 0
-        if self.sect.ident == b'BOOKMOBI':
-            mobi_length, = struct.unpack_from(b'>L', self.header, 0x14)
-            mobi_version, = struct.unpack_from(b'>L', self.header, 0x68)
-            if (mobi_length >= 0xE4) and (mobi_version >= 5):
-                flags, = struct.unpack_from(b'>H', self.header, 0xF2)
-                multibyte = flags & 1
-                while flags > 1:
-                    if flags & 2:
-                        trailers += 1
-                    flags = flags >> 1
+        if self.trailers is None:
+            self.multibyte = 0
+            self.trailers = 0
+            if self.sect.ident == b'BOOKMOBI':
+                mobi_length, = struct.unpack_from(b'>L', self.header, 0x14)
+                mobi_version, = struct.unpack_from(b'>L', self.header, 0x68)
+                if (mobi_length >= 0xE4) and (mobi_version >= 5):
+                    flags, = struct.unpack_from(b'>H', self.header, 0xF2)
+                    self.multibyte = flags & 1
+                    while flags > 1:
+                        if flags & 2:
+                            self.trailers += 1
+                        flags = flags >> 1
+        data = self.sect.loadSectionView(self.start + i)
+        for _ in range(self.trailers):
+            num = getSizeOfTrailingDataEntry(data)
+            data = data[:-num]
+        if self.multibyte:
+            num = (bord(data[-1]) & 3) + 1
+            data = data[:-num]
+        return data
+
+    def getRawMLParallel(self, processes, pool=None):
+        fingerprint = fileFingerprint(self.sect.filename)
+        tasks = [(self.sect.filename, self.start, fingerprint, first, min(first + PARALLEL_CHUNK_RECORDS, self.records + 1))
+                 for first in range(1, self.records + 1, PARALLEL_CHUNK_RECORDS)]
+        # map hands the spans back in order
+        if pool is not None:
+            return pool.map(unpackRecordSpan, tasks, chunksize=1)
+
+        # no pool to borrow (command line use), so start one for this book
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+        pool = context.Pool(min(processes, len(tasks)))
+        try:
+            dataList = pool.map(unpackRecordSpan, tasks, chunksize=1)
+        finally:
+            pool.terminate()
+            pool.join()
+        return dataList
+
+    def getRawML(self, processes=1, getpool=None):
         # get raw mobi markup languge
-        print("Unpacking raw markup language")
-        dataList = []
-        # offset = 0
+        logger.info("Unpacking raw markup language")
+        dataList = None
+        # worker processes cannot be started from inside a daemonic process
+        if (processes > 1 and self.records >= PARALLEL_MIN_RECORDS and
+                not multiprocessing.current_process().daemon):
+            try:
+                pool = getpool() if getpool is not None else None
+                dataList = self.getRawMLParallel(processes, pool)
+            except Exception as e:
+                logger.info("Parallel unpacking failed, unpacking serially: %s" % e)
+                dataList = None
+        if dataList is None:
+            dataList = []
+            # offset = 0
+            for i in range(1, self.records+1):
+                data = self.getTextRecord(i)
+                dataList.append(self.unpack(data))
         for i in range(1, self.records+1):
-            data = trimTrailingDataEntries(self.sect.loadSection(self.start + i))
-            dataList.append(self.unpack(data))
             if self.isK8():
                 self.sect.setsectiondescription(self.start + i,"KF8 Text Section {0:d}".format(i))
             elif self.version == 0:
@@ -893,7 +981,7 @@ class MobiHeader:
                         else:
                             addValue(name, unicode_str(str(value)))
                     else:
-                        print("Warning: Bad key, size, value combination detected in EXTH ", id, size, hexlify(content))
+                        logger.warning("Warning: Bad key, size, value combination detected in EXTH  %s %s %s", id, size, hexlify(content))
                         addValue(name, hexlify(content))
                 elif id in MobiHeader.id_map_hexstrings:
                     name = MobiHeader.id_map_hexstrings[id]
@@ -919,16 +1007,16 @@ class MobiHeader:
         return self.metadata
 
     def describeHeader(self, DUMP):
-        print("Mobi Version:", self.version)
-        print("Codec:", self.codec)
-        print("Title:", self.title)
+        logger.info("Mobi Version: %s", self.version)
+        logger.info("Codec: %s", self.codec)
+        logger.info("Title: %s", self.title)
         if 'Updated_Title' in self.metadata:
-            print("EXTH Title:", self.metadata['Updated_Title'][0])
+            logger.info("EXTH Title: %s", self.metadata['Updated_Title'][0])
         if self.compression == 0x4448:
-            print("Huffdic compression")
+            logger.info("Huffdic compression")
         elif self.compression == 2:
-            print("Palmdoc compression")
+            logger.info("Palmdoc compression")
         elif self.compression == 1:
-            print("No compression")
+            logger.info("No compression")
         if DUMP:
             self.dumpheader()
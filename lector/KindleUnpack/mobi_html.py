@@ -4,6 +4,7 @@
 
 from __future__ import unicode_literals, division, absolute_import, print_function
 
+import logging
 from .compatibility_utils import PY2, utf8_str
 
 if PY2:
@@ -15,6 +16,8 @@ import re
 
 from .mobi_utils import fromBase32
 
+logger = logging.getLogger(__name__)
+
 class HTMLProcessor:
 
     def __init__(self, files, metadata, rscnames):
@@ -29,7 +32,7 @@ class HTMLProcessor:
     def findAnchors(self, rawtext, indx_data, positionMap):
         # process the raw text
         # find anchors...
-        print("Find link anchors")
+        logger.info("Find link anchors")
         link_pattern = re.compile(br'''<[^<>]+filepos=['"]{0,1}(\d+)[^<>]*>''', re.IGNORECASE)
         # TEST NCX: merge in filepos from indx
         pos_links = [int(m.group(1)) for m in link_pattern.finditer(rawtext)]
@@ -44,7 +47,7 @@ class HTMLProcessor:
                 positionMap[position] = utf8_str('<a id="filepos%d" />' % position)
 
         # apply dictionary metadata and anchors
-        print("Insert data into html")
+        logger.info("Insert data into html")
         pos = 0
         lastPos = len(rawtext)
         dataList = []
@@ -68,19 +71,19 @@ class HTMLProcessor:
         metadata = self.metadata
 
         # put in the hrefs
-        print("Insert hrefs into html")
+        logger.info("Insert hrefs into html")
         # There doesn't seem to be a standard, so search as best as we can
 
         link_pattern = re.compile(br'''<a([^>]*?)filepos=['"]{0,1}0*(\d+)['"]{0,1}([^>]*?)>''', re.IGNORECASE)
         srctext = link_pattern.sub(br'''<a\1href="#filepos\2"\3>''', srctext)
 
         # remove empty anchors
-        print("Remove empty anchors from html")
+        logger.info("Remove empty anchors from html")
         srctext = re.sub(br"<a\s*/>",br"", srctext)
         srctext = re.sub(br"<a\s*>\s*</a>",br"", srctext)
 
         # convert image references
-        print("Insert image references into html")
+        logger.info("Insert image references into html")
         # split string into image tag pieces and other pieces
         image_pattern = re.compile(br'''(<img.*?>)''', re.IGNORECASE)
         image_index_pattern = re.compile(br'''recindex=['"]{0,1}([0-9]+)['"]{0,1}''', re.IGNORECASE)
@@ -94,7 +97,7 @@ class HTMLProcessor:
                 imageNumber = int(m.group(1))
                 imageName = rscnames[imageNumber-1]
                 if imageName is None:
-                    print("Error: Referenced image %s was not recognized as a valid image" % imageNumber)
+                    logger.error("Error: Referenced image %s was not recognized as a valid image" % imageNumber)
                 else:
                     replacement = b'src="Images/' + utf8_str(imageName) + b'"'
                     tag = image_index_pattern.sub(replacement, tag, 1)
@@ -129,7 +132,7 @@ class XHTMLK8Processor:
         posfid_index_pattern = re.compile(br'''['"]kindle:pos:fid:([0-9|A-V]+):off:([0-9|A-V]+).*?["']''')
 
         parts = []
-        print("Building proper xhtml for each file")
+        logger.info("Building proper xhtml for each file")
         for i in range(self.k8proc.getNumberOfParts()):
             part = self.k8proc.getPart(i)
             [partnum, dir, filename, beg, end, aidtext] = self.k8proc.getPartInfo(i)
@@ -233,7 +236,7 @@ class XHTMLK8Processor:
                             self.used[imageName] = 'used'
                             tag = img_index_pattern.sub(replacement, tag, 1)
                         else:
-                            print("Error: Referenced image %s was not recognized as a valid image in %s" % (imageNumber, tag))
+                            logger.error("Error: Referenced image %s was not recognized as a valid image in %s" % (imageNumber, tag))
                     srcpieces[j] = tag
             flowpart = b"".join(srcpieces)
 
@@ -253,7 +256,7 @@ class XHTMLK8Processor:
                         self.used[imageName] = 'used'
                         tag = url_img_index_pattern.sub(replacement, tag, 1)
                     else:
-                        print("Error: Referenced image %s was not recognized as a valid image in %s" % (imageNumber, tag))
+                        logger.error("Error: Referenced image %s was not recognized as a valid image in %s" % (imageNumber, tag))
 
                 # process links to fonts
                 for m in font_index_pattern.finditer(tag):
@@ -262,7 +265,7 @@ class XHTMLK8Processor:
                     osep = m.group()[0:1]
                     csep = m.group()[-1:]
                     if fontName is None:
-                        print("Error: Referenced font %s was not recognized as a valid font in %s" % (fontNumber, tag))
+                        logger.error("Error: Referenced font %s was not recognized as a valid font in %s" % (fontNumber, tag))
                     else:
                         replacement = osep +  b'../Fonts/' + utf8_str(fontName) +  csep
                         tag = font_index_pattern.sub(replacement, tag, 1)
@@ -340,7 +343,7 @@ class XHTMLK8Processor:
                                 tag = flow_pattern.sub(replacement, tag, 1)
                                 self.used[fnm] = 'used'
                         else:
-                            print("warning: ignoring non-existent flow link", tag, " value 0x%x" % num)
+                            logger.warning("warning: ignoring non-existent flow link %s %s", tag, " value 0x%x" % num)
                     srcpieces[j] = tag
             part = b''.join(srcpieces)
 
@@ -370,7 +373,7 @@ class XHTMLK8Processor:
                             self.used[imageName] = 'used'
                             tag = img_index_pattern.sub(replacement, tag, 1)
                         else:
-                            print("Error: Referenced image %s in style url was not recognized in %s" % (imageNumber, tag))
+                            logger.error("Error: Referenced image %s in style url was not recognized in %s" % (imageNumber, tag))
                     srcpieces[j] = tag
             part = b"".join(srcpieces)
 
@@ -400,7 +403,7 @@ class XHTMLK8Processor:
                             self.used[imageName] = 'used'
                             tag = img_index_pattern.sub(replacement, tag, 1)
                         else:
-                            print("Error: Referenced image %s was not recognized as a valid image in %s" % (imageNumber, tag))
+                            logger.error("Error: Referenced image %s was not recognized as a valid image in %s" % (imageNumber, tag))
                     srcpieces[j] = tag
             part = b"".join(srcpieces)
             # store away modified version
@@ -4,6 +4,7 @@
 
 from __future__ import unicode_literals, division, absolute_import, print_function
 
+import logging
 from .compatibility_utils import PY2, bchr, bstr, bord
 if PY2:
     range = xrange
@@ -14,13 +15,17 @@ import struct
 
 from .mobi_utils import toHex
 
+logger = logging.getLogger(__name__)
+
 class MobiIndex:
 
     def __init__(self, sect, DEBUG=False):
         self.sect = sect
         self.DEBUG = DEBUG
 
-    def getIndexData(self, idx, label="Unknown"):
+    def getIndexData(self, idx, label="Unknown", convert=None):
+        # only the entry positions are read here, each entry is decoded
+        # (and passed through convert if given) the first time it is used
         sect = self.sect
         outtbl = []
         ctoc_text = {}
@@ -42,9 +47,10 @@ class MobiIndex:
             tagSectionStart = idxhdr['len']
             controlByteCount, tagTable = readTagSection(tagSectionStart, data)
             if self.DEBUG:
-                print("ControlByteCount is", controlByteCount)
-                print("IndexCount is", IndexCount)
-                print("TagTable: %s" % tagTable)
+                logger.info("ControlByteCount is %s", controlByteCount)
+                logger.info("IndexCount is %s", IndexCount)
+                logger.info("TagTable: %s" % tagTable)
+            outtbl = IndexEntries(controlByteCount, tagTable, hordt2, convert, self.DEBUG)
             for i in range(idx + 1, idx + 1 + IndexCount):
                 sect.setsectiondescription(i,"{0} Extra {1:d} INDX section".format(label,i-idx))
                 data = sect.loadSection(i)
@@ -52,33 +58,18 @@ class MobiIndex:
                 idxtPos = hdrinfo['start']
                 entryCount = hdrinfo['count']
                 if self.DEBUG:
-                    print(idxtPos, entryCount)
+                    logger.info('%s %s', idxtPos, entryCount)
                 # loop through to build up the IDXT position starts
-                idxPositions = []
-                for j in range(entryCount):
-                    pos, = struct.unpack_from(b'>H', data, idxtPos + 4 + (2 * j))
-                    idxPositions.append(pos)
+                idxPositions = list(struct.unpack_from(bstr('>%dH' % entryCount), data, idxtPos + 4))
                 # The last entry ends before the IDXT tag (but there might be zero fill bytes we need to ignore!)
                 idxPositions.append(idxtPos)
-                # for each entry in the IDXT build up the tagMap and any associated text
-                for j in range(entryCount):
-                    startPos = idxPositions[j]
-                    endPos = idxPositions[j+1]
-                    textLength = ord(data[startPos:startPos+1])
-                    text = data[startPos+1:startPos+1+textLength]
-                    if hordt2 is not None:
-                        text = b''.join(bchr(hordt2[bord(x)]) for x in text)
-                    tagMap = getTagMap(controlByteCount, tagTable, data, startPos+1+textLength, endPos)
-                    outtbl.append([text, tagMap])
-                    if self.DEBUG:
-                        print(tagMap)
-                        print(text)
+                outtbl.addRecord(data, idxPositions)
         return outtbl, ctoc_text
 
     def parseINDXHeader(self, data):
         "read INDX header"
         if not data[:4] == b'INDX':
-            print("Warning: index section is not INDX")
+            logger.warning("Warning: index section is not INDX")
             return False
         words = (
                 'len', 'nul1', 'type', 'gen', 'start', 'count', 'code',
@@ -109,10 +100,10 @@ class MobiIndex:
             ordt2 = struct.unpack_from(bstr('>%dH' % oentries), data, op2+4)
 
         if self.DEBUG:
-            print("parsed INDX header:")
+            logger.info("parsed INDX header:")
             for n in words:
-                print(n, "%X" % header[n],)
-            print("")
+                logger.info('%s %s', n, "%X" % header[n])
+            logger.info("")
         return header, ordt1, ordt2
 
     def readCTOC(self, txtdata):
@@ -134,12 +125,70 @@ class MobiIndex:
             name = txtdata[offset:offset+ilen]
             offset += ilen
             if self.DEBUG:
-                print("name length is ", ilen)
-                print(idx_offs, name)
+                logger.info("name length is  %s", ilen)
+                logger.info('%s %s', idx_offs, name)
             ctoc_data[idx_offs] = name
         return ctoc_data
 
 
+class IndexEntries(object):
+    """
+    The entries of an index as a sequence of [text, tagMap], or of whatever
+    convert(num, text, tagMap) returns. Entries are decoded on first access
+    and kept, all entries of the index share one cache of tag layouts.
+    """
+
+    def __init__(self, controlByteCount, tagTable, hordt2=None, convert=None, DEBUG=False):
+        self.controlByteCount = controlByteCount
+        self.tagTable = tagTable
+        self.hordt2 = hordt2
+        self.convert = convert
+        self.DEBUG = DEBUG
+        self.tagLayouts = {}
+        # (record data, entry start, entry end) of every entry
+        self.positions = []
+        self.entries = []
+
+    def addRecord(self, data, idxPositions):
+        for j in range(len(idxPositions) - 1):
+            self.positions.append((data, idxPositions[j], idxPositions[j+1]))
+        self.entries.extend([None] * (len(idxPositions) - 1))
+
+    def decodeEntry(self, num):
+        data, startPos, endPos = self.positions[num]
+        textLength = ord(data[startPos:startPos+1])
+        text = data[startPos+1:startPos+1+textLength]
+        if self.hordt2 is not None:
+            text = b''.join(bchr(self.hordt2[bord(x)]) for x in text)
+        tagMap = getTagMap(self.controlByteCount, self.tagTable, data, startPos+1+textLength, endPos, self.tagLayouts)
+        if self.DEBUG:
+            logger.info(tagMap)
+            logger.info(text)
+        if self.convert is not None:
+            return self.convert(num, text, tagMap)
+        return [text, tagMap]
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __getitem__(self, num):
+        if isinstance(num, slice):
+            return [self[i] for i in range(*num.indices(len(self)))]
+        if num < 0:
+            num += len(self)
+        entry = self.entries[num]
+        if entry is None:
+            entry = self.entries[num] = self.decodeEntry(num)
+        return entry
+
+    def __setitem__(self, num, entry):
+        self.entries[num] = entry
+
+    def __iter__(self):
+        for num in range(len(self)):
+            yield self[num]
+
+
 def getVariableWidthValue(data, offset):
     '''
     Decode variable width value from given bytes.
@@ -150,13 +199,12 @@ def getVariableWidthValue(data, offset):
     '''
     value = 0
     consumed = 0
-    finished = False
-    while not finished:
-        v = data[offset + consumed: offset + consumed + 1]
+    while True:
+        v = bord(data[offset + consumed])
         consumed += 1
-        if ord(v) & 0x80:
-            finished = True
-        value = (value << 7) | (ord(v) & 0x7f)
+        value = (value << 7) | (v & 0x7f)
+        if v & 0x80:
+            break
     return consumed, value
 
 
@@ -197,48 +245,72 @@ def countSetBits(value, bits=8):
     return count
 
 
-def getTagMap(controlByteCount, tagTable, entryData, startPos, endPos):
+def getTagLayout(tagTable, controlBytes):
     '''
-    Create a map of tags and values from the given byte section.
+    Work out which tags an entry holds from its control bytes.
 
-    @param controlByteCount: The number of control bytes.
     @param tagTable: The tag table.
-    @param entryData: The data to process.
-    @param startPos: The starting position in entryData.
-    @param endPos: The end position in entryData or None if it is unknown.
-    @return: Hashmap of tag and list of values.
+    @param controlBytes: The control bytes of the entry.
+    @return: List of (tag, value count, valuesPerEntry) tuples, the value count
+             is None when the entry gives the byte length of the values instead.
     '''
-    tags = []
-    tagHashMap = {}
+    layout = []
     controlByteIndex = 0
-    dataStart = startPos + controlByteCount
-
     for tag, valuesPerEntry, mask, endFlag in tagTable:
         if endFlag == 0x01:
             controlByteIndex += 1
             continue
-        cbyte = ord(entryData[startPos + controlByteIndex:startPos + controlByteIndex+1])
-        if 0:
-            print("Control Byte Index %0x , Control Byte Value %0x" % (controlByteIndex, cbyte))
-
-        value = ord(entryData[startPos + controlByteIndex:startPos + controlByteIndex+1]) & mask
+        value = ord(controlBytes[controlByteIndex:controlByteIndex+1]) & mask
         if value != 0:
             if value == mask:
                 if countSetBits(mask) > 1:
                     # If all bits of masked value are set and the mask has more than one bit, a variable width value
                     # will follow after the control bytes which defines the length of bytes (NOT the value count!)
                     # which will contain the corresponding variable width values.
-                    consumed, value = getVariableWidthValue(entryData, dataStart)
-                    dataStart += consumed
-                    tags.append((tag, None, value, valuesPerEntry))
+                    layout.append((tag, None, valuesPerEntry))
                 else:
-                    tags.append((tag, 1, None, valuesPerEntry))
+                    layout.append((tag, 1, valuesPerEntry))
             else:
                 # Shift bits to get the masked value.
                 while mask & 0x01 == 0:
                     mask = mask >> 1
                     value = value >> 1
-                tags.append((tag, value, None, valuesPerEntry))
+                layout.append((tag, value, valuesPerEntry))
+    return layout
+
+
+def getTagMap(controlByteCount, tagTable, entryData, startPos, endPos, tagLayouts=None):
+    '''
+    Create a map of tags and values from the given byte section.
+
+    @param controlByteCount: The number of control bytes.
+    @param tagTable: The tag table.
+    @param entryData: The data to process.
+    @param startPos: The starting position in entryData.
+    @param endPos: The end position in entryData or None if it is unknown.
+    @param tagLayouts: Optional dict caching the tag layout of each set of control bytes.
+    @return: Hashmap of tag and list of values.
+    '''
+    tags = []
+    tagHashMap = {}
+    dataStart = startPos + controlByteCount
+
+    controlBytes = bytes(entryData[startPos:dataStart])
+    layout = None
+    if tagLayouts is not None:
+        layout = tagLayouts.get(controlBytes)
+    if layout is None:
+        layout = getTagLayout(tagTable, controlBytes)
+        if tagLayouts is not None:
+            tagLayouts[controlBytes] = layout
+
+    for tag, valueCount, valuesPerEntry in layout:
+        if valueCount is None:
+            consumed, value = getVariableWidthValue(entryData, dataStart)
+            dataStart += consumed
+            tags.append((tag, None, value, valuesPerEntry))
+        else:
+            tags.append((tag, valueCount, None, valuesPerEntry))
     for tag, valueCount, valueBytes, valuesPerEntry in tags:
         values = []
         if valueCount is not None:
@@ -258,19 +330,19 @@ def getTagMap(controlByteCount, tagTable, entryData, startPos, endPos):
                 totalConsumed += consumed
                 values.append(data)
             if totalConsumed != valueBytes:
-                print("Error: Should consume %s bytes, but consumed %s" % (valueBytes, totalConsumed))
+                logger.error("Error: Should consume %s bytes, but consumed %s" % (valueBytes, totalConsumed))
         tagHashMap[tag] = values
     # Test that all bytes have been processed if endPos is given.
     if endPos is not None and dataStart != endPos:
         # The last entry might have some zero padding bytes, so complain only if non zero bytes are left.
         for char in entryData[dataStart:endPos]:
             if bord(char) != 0:
-                print("Warning: There are unprocessed index bytes left: %s" % toHex(entryData[dataStart:endPos]))
+                logger.warning("Warning: There are unprocessed index bytes left: %s" % toHex(entryData[dataStart:endPos]))
                 if 0:
-                    print("controlByteCount: %s" % controlByteCount)
-                    print("tagTable: %s" % tagTable)
-                    print("data: %s" % toHex(entryData[startPos:endPos]))
-                    print("tagHashMap: %s" % tagHashMap)
+                    logger.info("controlByteCount: %s" % controlByteCount)
+                    logger.info("tagTable: %s" % tagTable)
+                    logger.info("data: %s" % toHex(entryData[startPos:endPos]))
+                    logger.info("tagHashMap: %s" % tagHashMap)
                 break
 
     return tagHashMap
@@ -4,6 +4,7 @@
 
 from __future__ import unicode_literals, division, absolute_import, print_function
 
+import logging
 from .compatibility_utils import PY2, bstr, utf8_str
 
 if PY2:
@@ -21,7 +22,8 @@ import re
 
 from .mobi_index import MobiIndex
 from .mobi_utils import fromBase32
-from .unipath import pathof
+
+logger = logging.getLogger(__name__)
 
 _guide_types = [b'cover',b'title-page',b'toc',b'index',b'glossary',b'acknowledgements',
                 b'bibliography',b'colophon',b'copyright-page',b'dedication',
@@ -52,6 +54,139 @@ def reverse_tag_iter(block):
         end = plt
 
 
+class SkeletonParts:
+    """
+    A skeleton being filled with its fragments. Skeleton and fragments are
+    all pieces of the same text, so the skeleton is kept as a list of
+    (start, end) ranges into that text and nothing is copied until the
+    finished part is joined. Positions are in the assembled skeleton.
+    """
+
+    def __init__(self, text, start, end):
+        self.text = text
+        self.ranges = [(start, end)]
+        self.length = end - start
+        # index of a range and its position in the skeleton, inserts mostly
+        # land at or after the previous one so searches start from here
+        self.cursor = (0, 0)
+
+    def __len__(self):
+        return self.length
+
+    def locate(self, pos):
+        # find the range holding pos, returns its index and position
+        k, base = self.cursor
+        ranges = self.ranges
+        while pos < base and k > 0:
+            k -= 1
+            base -= ranges[k][1] - ranges[k][0]
+        while k < len(ranges) - 1 and pos > base + ranges[k][1] - ranges[k][0]:
+            base += ranges[k][1] - ranges[k][0]
+            k += 1
+        self.cursor = (k, base)
+        return k, base
+
+    def insert(self, pos, start, end):
+        end = min(end, len(self.text))
+        if end <= start:
+            return
+        k, base = self.locate(pos)
+        rstart, rend = self.ranges[k]
+        cut = rstart + pos - base
+        pieces = []
+        if cut > rstart:
+            pieces.append((rstart, cut))
+        self.cursor = (k + len(pieces), pos)
+        pieces.append((start, end))
+        if rend > cut:
+            pieces.append((cut, rend))
+        self.ranges[k:k+1] = pieces
+        self.length += end - start
+
+    def find(self, pos, sub):
+        # offset of the first sub at or after pos, like skeleton[pos:].find(sub)
+        k, base = self.locate(pos)
+        ranges = self.ranges
+        dist = 0
+        rstart, rend = ranges[k]
+        begin = rstart + pos - base
+        while True:
+            found = self.text.find(sub, begin, rend)
+            if found != -1:
+                return dist + found - begin
+            dist += rend - begin
+            k += 1
+            if k == len(ranges):
+                return -1
+            begin, rend = ranges[k]
+
+    def rfind(self, pos, sub):
+        # position of the last sub before pos, like skeleton[:pos].rfind(sub)
+        k, base = self.locate(pos)
+        rstart, rend = self.ranges[k]
+        end = rstart + pos - base
+        while True:
+            found = self.text.rfind(sub, rstart, end)
+            if found != -1:
+                return base + found - rstart
+            if k == 0:
+                return -1
+            k -= 1
+            rstart, end = self.ranges[k]
+            base -= end - rstart
+
+    def tobytes(self):
+        view = memoryview(self.text)
+        return b''.join([view[rstart:rend] for rstart, rend in self.ranges])
+
+
+def assembleParts(text, skeltbl, fragtbl):
+    # insert the fragments of every skeleton into it, returns the parts and
+    # their [skelnum, 'Text', filename, start, end, aidtext] positions in text.
+    # Corrupt fragment insert positions are repaired in fragtbl
+    parts = []
+    partinfo = []
+    fragptr = 0
+    baseptr = 0
+    cnt = 0
+    filename = 'part%04d.xhtml' % cnt
+    for [skelnum, skelname, fragcnt, skelpos, skellen] in skeltbl:
+        baseptr = skelpos + skellen
+        skeleton = SkeletonParts(text, skelpos, baseptr)
+        aidtext = "0"
+        for i in range(fragcnt):
+            [insertpos, idtext, filenum, seqnum, startpos, length] = fragtbl[fragptr]
+            aidtext = idtext[12:-2]
+            if i == 0:
+                filename = 'part%04d.xhtml' % filenum
+            # bring insertpos into the skeleton the way slicing it would
+            insertpos = insertpos - skelpos
+            if insertpos < 0:
+                insertpos = max(insertpos + len(skeleton), 0)
+            insertpos = min(insertpos, len(skeleton))
+            actual_inspos = insertpos
+            if (skeleton.find(insertpos, b'>') < skeleton.find(insertpos, b'<') or
+                    skeleton.rfind(insertpos, b'>') < skeleton.rfind(insertpos, b'<')):
+                # There is an incomplete tag in either the head or tail.
+                # This can happen for some badly formed KF8 files
+                logger.info('The fragment table for %s has incorrect insert position. Calculating manually.' % skelname)
+                bp, ep = locate_beg_end_of_tag(skeleton.tobytes(), aidtext)
+                if bp != ep:
+                    actual_inspos = ep + 1 + startpos
+            if insertpos != actual_inspos:
+                logger.info("fixed corrupt fragment table insert position %s %s", insertpos+skelpos, actual_inspos+skelpos)
+                insertpos = actual_inspos
+                fragtbl[fragptr][0] = actual_inspos + skelpos
+                insertpos = min(insertpos, len(skeleton))
+            skeleton.insert(insertpos, baseptr, baseptr + length)
+            baseptr = baseptr + length
+            fragptr += 1
+        cnt += 1
+        parts.append(skeleton.tobytes())
+        partinfo.append([skelnum, 'Text', filename, skelpos, baseptr, aidtext])
+    return parts, partinfo
+
+
 class K8Processor:
 
     def __init__(self, mh, sect, files, debug=False):
@@ -83,11 +218,11 @@ class K8Processor:
                 self.fdsttbl = struct.unpack_from(bstr('>%dL' % (num_sections*2)), header, 12)[::2] + (mh.rawSize, )
                 sect.setsectiondescription(self.fdst,"KF8 FDST INDX")
                 if self.DEBUG:
-                    print("\nFDST Section Map:  %d sections" % num_sections)
+                    logger.info("\nFDST Section Map:  %d sections" % num_sections)
                     for j in range(num_sections):
-                        print("Section %d: 0x%08X - 0x%08X" % (j, self.fdsttbl[j],self.fdsttbl[j+1]))
+                        logger.info("Section %d: 0x%08X - 0x%08X" % (j, self.fdsttbl[j],self.fdsttbl[j+1]))
             else:
-                print("\nError: K8 Mobi with Missing FDST info")
+                logger.error("\nError: K8 Mobi with Missing FDST info")
 
         # read/process skeleton index info to create the skeleton table
         skeltbl = []
@@ -105,10 +240,10 @@ class K8Processor:
                 fileptr += 1
         self.skeltbl = skeltbl
         if self.DEBUG:
-            print("\nSkel Table:  %d entries" % len(self.skeltbl))
-            print("table: filenum, skeleton name, frag tbl record count, start position, length")
+            logger.info("\nSkel Table:  %d entries" % len(self.skeltbl))
+            logger.info("table: filenum, skeleton name, frag tbl record count, start position, length")
             for j in range(len(self.skeltbl)):
-                print(self.skeltbl[j])
+                logger.info(self.skeltbl[j])
 
         # read/process the fragment index to create the fragment table
         fragtbl = []
@@ -126,10 +261,10 @@ class K8Processor:
                 fragtbl.append([int(text), ctocdata, tagMap[3][0], tagMap[4][0], tagMap[6][0], tagMap[6][1]])
         self.fragtbl = fragtbl
         if self.DEBUG:
-            print("\nFragment Table: %d entries" % len(self.fragtbl))
-            print("table: file position, link id text, file num, sequence number, start position, length")
+            logger.info("\nFragment Table: %d entries" % len(self.fragtbl))
+            logger.info("table: file position, link id text, file num, sequence number, start position, length")
             for j in range(len(self.fragtbl)):
-                print(self.fragtbl[j])
+                logger.info(self.fragtbl[j])
 
         # read / process guide index for guide elements of opf
         guidetbl = []
@@ -153,10 +288,10 @@ class K8Processor:
                 guidetbl.append([ref_type, ref_title, fileno])
         self.guidetbl = guidetbl
         if self.DEBUG:
-            print("\nGuide Table: %d entries" % len(self.guidetbl))
-            print("table: ref_type, ref_title, fragtbl entry number")
+            logger.info("\nGuide Table: %d entries" % len(self.guidetbl))
+            logger.info("table: ref_type, ref_title, fragtbl entry number")
             for j in range(len(self.guidetbl)):
-                print(self.guidetbl[j])
+                logger.info(self.guidetbl[j])
 
     def buildParts(self, rawML):
         # now split the rawML into its flow pieces
@@ -174,50 +309,13 @@ class K8Processor:
         # *without* destroying any file position information needed for later href processing
         # and create final list of file separation start: stop points and etc in partinfo
         if self.DEBUG:
-            print("\nRebuilding flow piece 0: the main body of the ebook")
-        self.parts = []
-        self.partinfo = []
-        fragptr = 0
-        baseptr = 0
-        cnt = 0
-        filename = 'part%04d.xhtml' % cnt
-        for [skelnum, skelname, fragcnt, skelpos, skellen] in self.skeltbl:
-            baseptr = skelpos + skellen
-            skeleton = text[skelpos: baseptr]
-            aidtext = "0"
-            for i in range(fragcnt):
-                [insertpos, idtext, filenum, seqnum, startpos, length] = self.fragtbl[fragptr]
-                aidtext = idtext[12:-2]
-                if i == 0:
-                    filename = 'part%04d.xhtml' % filenum
-                slice = text[baseptr: baseptr + length]
-                insertpos = insertpos - skelpos
-                head = skeleton[:insertpos]
-                tail = skeleton[insertpos:]
-                actual_inspos = insertpos
-                if (tail.find(b'>') < tail.find(b'<') or head.rfind(b'>') < head.rfind(b'<')):
-                    # There is an incomplete tag in either the head or tail.
-                    # This can happen for some badly formed KF8 files
-                    print('The fragment table for %s has incorrect insert position. Calculating manually.' % skelname)
-                    bp, ep = locate_beg_end_of_tag(skeleton, aidtext)
-                    if bp != ep:
-                        actual_inspos = ep + 1 + startpos
-                if insertpos != actual_inspos:
-                    print("fixed corrupt fragment table insert position", insertpos+skelpos, actual_inspos+skelpos)
-                    insertpos = actual_inspos
-                    self.fragtbl[fragptr][0] = actual_inspos + skelpos
-                skeleton = skeleton[0:insertpos] + slice + skeleton[insertpos:]
-                baseptr = baseptr + length
-                fragptr += 1
-            cnt += 1
-            self.parts.append(skeleton)
-            self.partinfo.append([skelnum, 'Text', filename, skelpos, baseptr, aidtext])
+            logger.info("\nRebuilding flow piece 0: the main body of the ebook")
+        self.parts, self.partinfo = assembleParts(text, self.skeltbl, self.fragtbl)
 
         assembled_text = b''.join(self.parts)
         if self.DEBUG:
             outassembled = os.path.join(self.files.k8dir, 'assembled_text.dat')
-            with open(pathof(outassembled),'wb') as f:
-                f.write(assembled_text)
+            self.files.write(outassembled, assembled_text)
 
         # The primary css style sheet is typically stored next followed by any
         # snippets of code that were previously inlined in the
@@ -279,14 +377,14 @@ class K8Processor:
             self.flowinfo.append([ptype, pformat, pdir, fname])
 
         if self.DEBUG:
-            print("\nFlow Map:  %d entries" % len(self.flowinfo))
+            logger.info("\nFlow Map:  %d entries" % len(self.flowinfo))
             for fi in self.flowinfo:
-                print(fi)
-            print("\n")
+                logger.info(fi)
+            logger.info("\n")
 
-            print("\nXHTML File Part Position Information: %d entries" % len(self.partinfo))
+            logger.info("\nXHTML File Part Position Information: %d entries" % len(self.partinfo))
             for pi in self.partinfo:
-                print(pi)
+                logger.info(pi)
 
         if False:  # self.Debug:
             # dump all of the locations of the aid tags used in TEXT
@@ -295,14 +393,14 @@ class K8Processor:
             #    [^>]* means match any amount of chars except for  '>' char
             #    [^'"] match any amount of chars except for the quote character
             #    \s* means match any amount of whitespace
-            print("\npositions of all aid= pieces")
+            logger.info("\npositions of all aid= pieces")
             id_pattern = re.compile(br'''<[^>]*\said\s*=\s*['"]([^'"]*)['"][^>]*>''',re.IGNORECASE)
             for m in re.finditer(id_pattern, rawML):
                 [filename, partnum, start, end] = self.getFileInfo(m.start())
                 [seqnum, idtext] = self.getFragTblInfo(m.start())
                 value = fromBase32(m.group(1))
-                print("  aid: %s value: %d at: %d -> part: %d, start: %d, end: %d" % (m.group(1), value, m.start(), partnum, start, end))
-                print("       %s  fragtbl entry %d" % (idtext, seqnum))
+                logger.info("  aid: %s value: %d at: %d -> part: %d, start: %d, end: %d" % (m.group(1), value, m.start(), partnum, start, end))
+                logger.info("       %s  fragtbl entry %d" % (idtext, seqnum))
 
         return
 
@@ -364,7 +462,7 @@ class K8Processor:
         if fname is None:
             # pos does not exist
             # default to skeleton pos instead
-            print("Link To Position", pos, "does not exist, retargeting to top of target")
+            logger.info("Link To Position %s %s", pos, "does not exist, retargeting to top of target")
             pos = self.skeltbl[filenum][3]
             fname, pn, skelpos, skelend = self.getFileInfo(pos)
         # an existing "id=" or "name=" attribute must exist in original xhtml otherwise it would not have worked for linking.
@@ -378,7 +476,7 @@ class K8Processor:
         # find the first tag with a named anchor (name or id attribute) before pos
         fname, pn, skelpos, skelend = self.getFileInfo(pos)
         if pn is None and skelpos is None:
-            print("Error: getIDTag - no file contains ", pos)
+            logger.error("Error: getIDTag - no file contains  %s", pos)
         textblock = self.parts[pn]
         npos = pos - skelpos
         # if npos inside a tag then search all text before the its end of tag marker
@@ -457,7 +555,7 @@ class K8Processor:
         # into a tag look for the next ending tag "/>" or "</" and start your search from there.
         fname, pn, skelpos, skelend = self.getFileInfo(pos)
         if pn is None and skelpos is None:
-            print("Error: getIDTag - no file contains ", pos)
+            logger.error("Error: getIDTag - no file contains  %s", pos)
         textblock = self.parts[pn]
         npos = pos - skelpos
         # if npos inside a tag then search all text before next ending tag
@@ -12,10 +12,13 @@ if DEBUG_USE_ORDERED_DICTIONARY:
 else:
     dict_ = dict
 
+import logging
 from .compatibility_utils import unicode_str
 
 from .mobi_utils import fromBase32
 
+logger = logging.getLogger(__name__)
+
 _OPF_PARENT_TAGS = ['xml', 'package', 'metadata', 'dc-metadata',
                     'x-metadata', 'manifest', 'spine', 'tours', 'guide']
 
@@ -58,7 +61,7 @@ class K8RESCProcessor(object):
             else:
                 self.resc_length = end_pos - start_pos
         if self.resc_length != resc_size:
-            print("Warning: RESC section length({:d}bytes) does not match its size({:d}bytes).".format(self.resc_length, resc_size))
+            logger.info("Warning: RESC section length({:d}bytes) does not match its size({:d}bytes).".format(self.resc_length, resc_size))
         # now parse RESC after converting it to unicode from utf-8
         self.resc = unicode_str(data[start_pos:start_pos+self.resc_length])
         self.parseData()
@@ -106,7 +109,7 @@ class K8RESCProcessor(object):
     def parseData(self):
         for prefix, tname, tattr, tcontent in self.resc_tag_iter():
             if self._debug:
-                print("   Parsing RESC: ", prefix, tname, tattr, tcontent)
+                logger.info("   Parsing RESC:  %s %s %s %s", prefix, tname, tattr, tcontent)
             if tname == 'package':
                 self.package_ver = tattr.get('version', '2.0')
                 package_prefix = tattr.get('prefix','')
@@ -4,11 +4,13 @@
 
 from __future__ import unicode_literals, division, absolute_import, print_function
 
+import logging
 from .compatibility_utils import unicode_str
 import os
-from .unipath import pathof
 
 import re
+
+logger = logging.getLogger(__name__)
 # note: re requites the pattern to be the exact same type as the data to be searched in python3
 # but u"" is not allowed for the pattern itself only b""
 
@@ -102,10 +104,10 @@ class NAVProcessor(object):
         # recursive part
         def recursINDX(max_lvl=0, num=0, lvl=0, start=-1, end=-1):
             if start>len(indx_data) or end>len(indx_data):
-                print("Warning (in buildTOC): missing INDX child entries", start, end, len(indx_data))
+                logger.warning("Warning (in buildTOC): missing INDX child entries %s %s %s", start, end, len(indx_data))
                 return ''
             if DEBUG_NAV:
-                print("recursINDX (in buildTOC) lvl %d from %d to %d" % (lvl, start, end))
+                logger.info("recursINDX (in buildTOC) lvl %d from %d to %d" % (lvl, start, end))
             xhtml = ''
             if start <= 0:
                 start = 0
@@ -146,11 +148,11 @@ class NAVProcessor(object):
 
         data, max_lvl, num = recursINDX()
         if not len(indx_data) == num:
-            print("Warning (in buildTOC): different number of entries in NCX", len(indx_data), num)
+            logger.warning("Warning (in buildTOC): different number of entries in NCX %s %s", len(indx_data), num)
         return header + data + footer
 
     def buildNAV(self, ncx_data, guidetext, title, lang):
-        print("Building Navigation Document.")
+        logger.info("Building Navigation Document.")
         if FORCE_DEFAULT_TITLE:
             title = DEFAULT_TITLE
         nav_header = ''
@@ -182,5 +184,4 @@ class NAVProcessor(object):
         # print("Write Navigation Document.")
         xhtml = self.buildNAV(ncx_data, guidetext, metadata.get('Title')[0], metadata.get('Language')[0])
         fname = os.path.join(self.files.k8text, self.navname)
-        with open(pathof(fname), 'wb') as f:
-            f.write(xhtml.encode('utf-8'))
+        self.files.write(fname, xhtml.encode('utf-8'))
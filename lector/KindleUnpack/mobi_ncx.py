@@ -4,8 +4,8 @@
 
 from __future__ import unicode_literals, division, absolute_import, print_function
 
+import logging
 import os
-from .unipath import pathof
 
 
 import re
@@ -15,6 +15,8 @@ import re
 from .mobi_utils import toBase32
 from .mobi_index import MobiIndex
 
+logger = logging.getLogger(__name__)
+
 DEBUG_NCX = False
 
 class ncxExtract:
@@ -28,74 +30,75 @@ class ncxExtract:
         self.ncxidx = self.mh.ncxidx
         self.indx_data = None
 
+    tag_fieldname_map = {
+            1: ['pos',0],
+            2: ['len',0],
+            3: ['noffs',0],
+            4: ['hlvl',0],
+            5: ['koffs',0],
+            6: ['pos_fid',0],
+            21: ['parent',0],
+            22: ['child1',0],
+            23: ['childn',0]
+    }
+
     def parseNCX(self):
+        # the entries are only decoded by ncxEntry as they are looked at
         indx_data = []
-        tag_fieldname_map = {
-                1: ['pos',0],
-                2: ['len',0],
-                3: ['noffs',0],
-                4: ['hlvl',0],
-                5: ['koffs',0],
-                6: ['pos_fid',0],
-                21: ['parent',0],
-                22: ['child1',0],
-                23: ['childn',0]
-        }
+        self.ctoc_text = {}
         if self.ncxidx != 0xffffffff:
-            outtbl, ctoc_text = self.mi.getIndexData(self.ncxidx, "NCX")
+            indx_data, self.ctoc_text = self.mi.getIndexData(self.ncxidx, "NCX", self.ncxEntry)
             if DEBUG_NCX:
-                print(ctoc_text)
-                print(outtbl)
-            num = 0
-            for [text, tagMap] in outtbl:
-                tmp = {
-                        'name': text.decode('utf-8'),
-                        'pos':  -1,
-                        'len':  0,
-                        'noffs': -1,
-                        'text' : "Unknown Text",
-                        'hlvl' : -1,
-                        'kind' : "Unknown Kind",
-                        'pos_fid' : None,
-                        'parent' : -1,
-                        'child1' : -1,
-                        'childn' : -1,
-                        'num'  : num
-                        }
-                for tag in tag_fieldname_map:
-                    [fieldname, i] = tag_fieldname_map[tag]
-                    if tag in tagMap:
-                        fieldvalue = tagMap[tag][i]
-                        if tag == 6:
-                            pos_fid = toBase32(fieldvalue,4).decode('utf-8')
-                            fieldvalue2 = tagMap[tag][i+1]
-                            pos_off = toBase32(fieldvalue2,10).decode('utf-8')
-                            fieldvalue = 'kindle:pos:fid:%s:off:%s' % (pos_fid, pos_off)
-                        tmp[fieldname] = fieldvalue
-                        if tag == 3:
-                            toctext = ctoc_text.get(fieldvalue, 'Unknown Text')
-                            toctext = toctext.decode(self.mh.codec)
-                            tmp['text'] = toctext
-                        if tag == 5:
-                            kindtext = ctoc_text.get(fieldvalue, 'Unknown Kind')
-                            kindtext = kindtext.decode(self.mh.codec)
-                            tmp['kind'] = kindtext
-                indx_data.append(tmp)
-                if DEBUG_NCX:
-                    print("record number: ", num)
-                    print("name: ", tmp['name'],)
-                    print("position", tmp['pos']," length: ", tmp['len'])
-                    print("text: ", tmp['text'])
-                    print("kind: ", tmp['kind'])
-                    print("heading level: ", tmp['hlvl'])
-                    print("parent:", tmp['parent'])
-                    print("first child: ",tmp['child1']," last child: ", tmp['childn'])
-                    print("pos_fid is ", tmp['pos_fid'])
-                    print("\n\n")
-                num += 1
+                logger.info(self.ctoc_text)
         self.indx_data = indx_data
         return indx_data
 
+    def ncxEntry(self, num, text, tagMap):
+        tmp = {
+                'name': text.decode('utf-8'),
+                'pos':  -1,
+                'len':  0,
+                'noffs': -1,
+                'text' : "Unknown Text",
+                'hlvl' : -1,
+                'kind' : "Unknown Kind",
+                'pos_fid' : None,
+                'parent' : -1,
+                'child1' : -1,
+                'childn' : -1,
+                'num'  : num
+                }
+        for tag in self.tag_fieldname_map:
+            [fieldname, i] = self.tag_fieldname_map[tag]
+            if tag in tagMap:
+                fieldvalue = tagMap[tag][i]
+                if tag == 6:
+                    pos_fid = toBase32(fieldvalue,4).decode('utf-8')
+                    fieldvalue2 = tagMap[tag][i+1]
+                    pos_off = toBase32(fieldvalue2,10).decode('utf-8')
+                    fieldvalue = 'kindle:pos:fid:%s:off:%s' % (pos_fid, pos_off)
+                tmp[fieldname] = fieldvalue
+                if tag == 3:
+                    toctext = self.ctoc_text.get(fieldvalue, 'Unknown Text')
+                    toctext = toctext.decode(self.mh.codec)
+                    tmp['text'] = toctext
+                if tag == 5:
+                    kindtext = self.ctoc_text.get(fieldvalue, 'Unknown Kind')
+                    kindtext = kindtext.decode(self.mh.codec)
+                    tmp['kind'] = kindtext
+        if DEBUG_NCX:
+            logger.info("record number:  %s", num)
+            logger.info("name:  %s", tmp['name'])
+            logger.info("position %s %s %s", tmp['pos'], " length: ", tmp['len'])
+            logger.info("text:  %s", tmp['text'])
+            logger.info("kind:  %s", tmp['kind'])
+            logger.info("heading level:  %s", tmp['hlvl'])
+            logger.info("parent: %s", tmp['parent'])
+            logger.info("first child:  %s %s %s", tmp['child1'], " last child: ", tmp['childn'])
+            logger.info("pos_fid is  %s", tmp['pos_fid'])
+            logger.info("\n\n")
+        return tmp
+
     def buildNCX(self, htmlfile, title, ident, lang):
         indx_data = self.indx_data
 
@@ -130,10 +133,10 @@ class ncxExtract:
         # recursive part
         def recursINDX(max_lvl=0, num=0, lvl=0, start=-1, end=-1):
             if start>len(indx_data) or end>len(indx_data):
-                print("Warning: missing INDX child entries", start, end, len(indx_data))
+                logger.warning("Warning: missing INDX child entries %s %s %s", start, end, len(indx_data))
                 return ''
             if DEBUG_NCX:
-                print("recursINDX lvl %d from %d to %d" % (lvl, start, end))
+                logger.info("recursINDX lvl %d from %d to %d" % (lvl, start, end))
             xml = ''
             if start <= 0:
                 start = 0
@@ -167,13 +170,13 @@ class ncxExtract:
         header = ncx_header % (lang, ident, max_lvl + 1, title)
         ncx =  header + body + ncx_footer
         if not len(indx_data) == num:
-            print("Warning: different number of entries in NCX", len(indx_data), num)
+            logger.warning("Warning: different number of entries in NCX %s %s", len(indx_data), num)
         return ncx
 
     def writeNCX(self, metadata):
         # build the xml
         self.isNCX = True
-        print("Write ncx")
+        logger.info("Write ncx")
         # htmlname = os.path.basename(self.files.outbase)
         # htmlname += '.html'
         htmlname = 'book.html'
@@ -181,8 +184,7 @@ class ncxExtract:
         # write the ncx file
         # ncxname = os.path.join(self.files.mobi7dir, self.files.getInputFileBasename() + '.ncx')
         ncxname = os.path.join(self.files.mobi7dir, 'toc.ncx')
-        with open(pathof(ncxname), 'wb') as f:
-            f.write(xml.encode('utf-8'))
+        self.files.write(ncxname, xml.encode('utf-8'))
 
     def buildK8NCX(self, indx_data, title, ident, lang):
         ncx_header = \
@@ -216,10 +218,10 @@ class ncxExtract:
         # recursive part
         def recursINDX(max_lvl=0, num=0, lvl=0, start=-1, end=-1):
             if start>len(indx_data) or end>len(indx_data):
-                print("Warning: missing INDX child entries", start, end, len(indx_data))
+                logger.warning("Warning: missing INDX child entries %s %s %s", start, end, len(indx_data))
                 return ''
             if DEBUG_NCX:
-                print("recursINDX lvl %d from %d to %d" % (lvl, start, end))
+                logger.info("recursINDX lvl %d from %d to %d" % (lvl, start, end))
             xml = ''
             if start <= 0:
                 start = 0
@@ -258,15 +260,14 @@ class ncxExtract:
         header = ncx_header % (lang, ident, max_lvl + 1, title)
         ncx =  header + body + ncx_footer
         if not len(indx_data) == num:
-            print("Warning: different number of entries in NCX", len(indx_data), num)
+            logger.warning("Warning: different number of entries in NCX %s %s", len(indx_data), num)
         return ncx
 
     def writeK8NCX(self, ncx_data, metadata):
         # build the xml
         self.isNCX = True
-        print("Write K8 ncx")
+        logger.info("Write K8 ncx")
         xml = self.buildK8NCX(ncx_data, metadata['Title'][0], metadata['UniqueID'][0], metadata.get('Language')[0])
         bname = 'toc.ncx'
         ncxname = os.path.join(self.files.k8oebps,bname)
-        with open(pathof(ncxname), 'wb') as f:
-            f.write(xml.encode('utf-8'))
+        self.files.write(ncxname, xml.encode('utf-8'))
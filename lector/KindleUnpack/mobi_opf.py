@@ -4,10 +4,10 @@
 
 from __future__ import unicode_literals, division, absolute_import, print_function
 
+import logging
 from .compatibility_utils import unicode_str, unescapeit
 from .compatibility_utils import lzip
 
-from .unipath import pathof
 
 from xml.sax.saxutils import escape as xmlescape
 
@@ -15,6 +15,8 @@ import os
 import uuid
 from datetime import datetime
 
+logger = logging.getLogger(__name__)
+
 # In EPUB3, NCX and <guide> MAY exist in OPF, although the NCX is superseded
 # by the Navigation Document and the <guide> is deprecated. Currently, EPUB3_WITH_NCX
 # and EPUB3_WITH_GUIDE are set to True due to compatibility with epub2 reading systems.
@@ -265,7 +267,7 @@ class OPFProcessor(object):
             imageNumber = int(metadata['CoverOffset'][0])
             self.covername = self.rscnames[imageNumber]
             if self.covername is None:
-                print("Error: Cover image %s was not recognized as a valid image" % imageNumber)
+                logger.error("Error: Cover image %s was not recognized as a valid image" % imageNumber)
             else:
                 # <meta name="cover"> is obsoleted in EPUB3, but kindlegen v2.9 requires it.
                 data.append('<meta name="cover" content="' + self.cover_id + '" />\n')
@@ -297,7 +299,7 @@ class OPFProcessor(object):
             priceList = metadata['Price']
             currencyList = metadata['Currency']
             if len(priceList) != len(currencyList):
-                print("Error: found %s price entries, but %s currency entries.")
+                logger.error("Error: found %s price entries, but %s currency entries.")
             else:
                 for i in range(len(priceList)):
                     data.append('<SRP Currency="'+currencyList[i]+'">'+priceList[i]+'</SRP>\n')
@@ -317,7 +319,7 @@ class OPFProcessor(object):
             imageNumber = int(metadata['ThumbOffset'][0])
             imageName = self.rscnames[imageNumber]
             if imageName is None:
-                print("Error: Cover Thumbnail image %s was not recognized as a valid image" % imageNumber)
+                logger.error("Error: Cover Thumbnail image %s was not recognized as a valid image" % imageNumber)
             else:
                 data.append('<meta name="Cover ThumbNail Image" content="'+ 'Images/'+imageName+'" />\n')
                 # self.used[imageName] = 'used' # thumbnail image is always generated by Kindlegen, so don't include in manifest
@@ -475,7 +477,7 @@ class OPFProcessor(object):
 
     def buildMobi7OPF(self):
         # Build an OPF for mobi7 and azw4.
-        print("Building an opf for mobi7/azw4.")
+        logger.info("Building an opf for mobi7/azw4.")
         data = []
         data.append('<?xml version="1.0" encoding="utf-8"?>\n')
         data.append('<package version="2.0" xmlns="http://www.idpf.org/2007/opf" unique-identifier="uid">\n')
@@ -499,7 +501,7 @@ class OPFProcessor(object):
         return ''.join(data)
 
     def buildEPUBOPF(self, has_obfuscated_fonts=False):
-        print("Building an opf for mobi8 using epub version: ", self.target_epubver)
+        logger.info("Building an opf for mobi8 using epub version:  %s", self.target_epubver)
         if self.target_epubver == '2':
             has_ncx = self.has_ncx
             has_guide = True
@@ -540,14 +542,12 @@ class OPFProcessor(object):
         if self.isK8:
             data = self.buildEPUBOPF(has_obfuscated_fonts)
             outopf = os.path.join(self.files.k8oebps, EPUB_OPF)
-            with open(pathof(outopf), 'wb') as f:
-                f.write(data.encode('utf-8'))
+            self.files.write(outopf, data.encode('utf-8'))
             return self.BookId
         else:
             data = self.buildMobi7OPF()
             outopf = os.path.join(self.files.mobi7dir, 'content.opf')
-            with open(pathof(outopf), 'wb') as f:
-                f.write(data.encode('utf-8'))
+            self.files.write(outopf, data.encode('utf-8'))
             return 0
 
     def getBookId(self):
@@ -4,6 +4,7 @@
 
 from __future__ import unicode_literals, division, absolute_import, print_function
 
+import logging
 from .compatibility_utils import PY2, unicode_str
 
 if PY2:
@@ -14,6 +15,8 @@ import struct
 # data all the way up to at least python 2.7.5, python 3 okay with bytestring
 
 import re
+
+logger = logging.getLogger(__name__)
 # note: re requites the pattern to be the exact same type as the data to be searched in python3
 # but u"" is not allowed for the pattern itself only b""
 
@@ -73,7 +76,7 @@ def _parseNames(numpages, data):
                     pname = svalue[0:sp]
                     svalue = svalue[sp+1:]
             else:
-                print("Error: unknown page numbering type", nametype)
+                logger.error("Error: unknown page numbering type %s", nametype)
             pagenames[i] = pname
     return pagenames, pageMap
 
@@ -91,7 +94,7 @@ class PageMapProcessor:
         self.pn_bits = 0
         self.pmoff = None
         self.pmstr = ''
-        print("Extracting Page Map Information")
+        logger.info("Extracting Page Map Information")
         rev_len, = struct.unpack_from(b'>L', self.data, 0x10)
         # skip over header, revision string length data, and revision string
         ptr = 0x14 + rev_len
@@ -4,9 +4,11 @@
 
 from __future__ import unicode_literals, division, absolute_import, print_function
 
+import logging
 from .compatibility_utils import PY2, hexlify, bstr, bord, bchar
 
 import datetime
+import mmap
 
 if PY2:
     range = xrange
@@ -17,6 +19,8 @@ import struct
 
 from .unipath import pathof
 
+logger = logging.getLogger(__name__)
+
 DUMP = False
 """ Set to True to dump all possible information. """
 
@@ -45,9 +49,21 @@ def datetimefrompalmtime(palmtime):
 class Sectionizer:
 
     def __init__(self, filename):
+        # map the file rather than reading it into memory so that sections
+        # are only paged in when they are actually loaded
+        self.filename = filename
         self.data = b''
+        self.view = None
         with open(pathof(filename), 'rb') as f:
-            self.data = f.read()
+            try:
+                self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # empty files cannot be mapped
+                self.data = f.read()
+        if len(self.data) < 78:
+            self.close()
+            raise unpackException('file is too short to be a palm database')
+        self.view = memoryview(self.data)
         self.palmheader = self.data[:78]
         self.palmname = self.data[:32]
         self.ident = self.palmheader[0x3C:0x3C+8]
@@ -61,60 +77,78 @@ class Sectionizer:
         return
 
     def dumpsectionsinfo(self):
-        print("Section     Offset  Length      UID Attribs Description")
+        logger.info("Section     Offset  Length      UID Attribs Description")
         for i in range(self.num_sections):
-            print("%3d %3X  0x%07X 0x%05X % 8d % 7d %s" % (i,i, self.sectionoffsets[i], self.sectionoffsets[
+            logger.info("%3d %3X  0x%07X 0x%05X % 8d % 7d %s" % (i,i, self.sectionoffsets[i], self.sectionoffsets[
                   i+1] - self.sectionoffsets[i], self.sectionattributes[i]&0xFFFFFF, (self.sectionattributes[i]>>24)&0xFF, self.sectiondescriptions[i]))
-        print("%3d %3X  0x%07X                          %s" %
+        logger.info("%3d %3X  0x%07X                          %s" %
               (self.num_sections,self.num_sections, self.sectionoffsets[self.num_sections], self.sectiondescriptions[self.num_sections]))
 
     def setsectiondescription(self, section, description):
         if section < len(self.sectiondescriptions):
             self.sectiondescriptions[section] = description
         else:
-            print("Section out of range: %d, description %s" % (section,description))
+            logger.info("Section out of range: %d, description %s" % (section,description))
 
     def dumppalmheader(self):
-        print("Palm Database Header")
-        print("Database name: " + repr(self.palmheader[:32]))
+        logger.info("Palm Database Header")
+        logger.info("Database name: " + repr(self.palmheader[:32]))
         dbattributes, = struct.unpack_from(b'>H', self.palmheader, 32)
-        print("Bitfield attributes: 0x%0X" % dbattributes,)
+        logger.info("Bitfield attributes: 0x%0X" % dbattributes)
         if dbattributes != 0:
-            print(" (",)
+            logger.info(" (")
             if (dbattributes & 2):
-                print("Read-only; ",)
+                logger.info("Read-only; ")
             if (dbattributes & 4):
-                print("Dirty AppInfoArea; ",)
+                logger.info("Dirty AppInfoArea; ")
             if (dbattributes & 8):
-                print("Needs to be backed up; ",)
+                logger.info("Needs to be backed up; ")
             if (dbattributes & 16):
-                print("OK to install over newer; ",)
+                logger.info("OK to install over newer; ")
             if (dbattributes & 32):
-                print("Reset after installation; ",)
+                logger.info("Reset after installation; ")
             if (dbattributes & 64):
-                print("No copying by PalmPilot beaming; ",)
-            print(")")
+                logger.info("No copying by PalmPilot beaming; ")
+            logger.info(")")
         else:
-            print("")
-        print("File version: %d" % struct.unpack_from(b'>H', self.palmheader, 34)[0])
+            logger.info("")
+        logger.info("File version: %d" % struct.unpack_from(b'>H', self.palmheader, 34)[0])
         dbcreation, = struct.unpack_from(b'>L', self.palmheader, 36)
-        print("Creation Date: " + str(datetimefrompalmtime(dbcreation))+ (" (0x%0X)" % dbcreation))
+        logger.info("Creation Date: " + str(datetimefrompalmtime(dbcreation))+ (" (0x%0X)" % dbcreation))
         dbmodification, = struct.unpack_from(b'>L', self.palmheader, 40)
-        print("Modification Date: " + str(datetimefrompalmtime(dbmodification))+ (" (0x%0X)" % dbmodification))
+        logger.info("Modification Date: " + str(datetimefrompalmtime(dbmodification))+ (" (0x%0X)" % dbmodification))
         dbbackup, = struct.unpack_from(b'>L', self.palmheader, 44)
         if dbbackup != 0:
-            print("Backup Date: " + str(datetimefrompalmtime(dbbackup))+ (" (0x%0X)" % dbbackup))
-        print("Modification No.: %d" % struct.unpack_from(b'>L', self.palmheader, 48)[0])
-        print("App Info offset: 0x%0X" % struct.unpack_from(b'>L', self.palmheader, 52)[0])
-        print("Sort Info offset: 0x%0X" % struct.unpack_from(b'>L', self.palmheader, 56)[0])
-        print("Type/Creator: %s/%s" % (repr(self.palmheader[60:64]), repr(self.palmheader[64:68])))
-        print("Unique seed: 0x%0X" % struct.unpack_from(b'>L', self.palmheader, 68)[0])
+            logger.info("Backup Date: " + str(datetimefrompalmtime(dbbackup))+ (" (0x%0X)" % dbbackup))
+        logger.info("Modification No.: %d" % struct.unpack_from(b'>L', self.palmheader, 48)[0])
+        logger.info("App Info offset: 0x%0X" % struct.unpack_from(b'>L', self.palmheader, 52)[0])
+        logger.info("Sort Info offset: 0x%0X" % struct.unpack_from(b'>L', self.palmheader, 56)[0])
+        logger.info("Type/Creator: %s/%s" % (repr(self.palmheader[60:64]), repr(self.palmheader[64:68])))
+        logger.info("Unique seed: 0x%0X" % struct.unpack_from(b'>L', self.palmheader, 68)[0])
         expectedzero, = struct.unpack_from(b'>L', self.palmheader, 72)
         if expectedzero != 0:
-            print("Should be zero but isn't: %d" % struct.unpack_from(b'>L', self.palmheader, 72)[0])
-        print("Number of sections: %d" % struct.unpack_from(b'>H', self.palmheader, 76)[0])
+            logger.info("Should be zero but isn't: %d" % struct.unpack_from(b'>L', self.palmheader, 72)[0])
+        logger.info("Number of sections: %d" % struct.unpack_from(b'>H', self.palmheader, 76)[0])
         return
 
     def loadSection(self, section):
         before, after = self.sectionoffsets[section:section+2]
         return self.data[before:after]
+
+    def loadSectionView(self, section):
+        # zero copy access to a section for consumers that only slice,
+        # unpack or write the data
+        before, after = self.sectionoffsets[section:section+2]
+        return self.view[before:after]
+
+    def close(self):
+        if self.view is not None:
+            self.view.release()
+            self.view = None
+        if isinstance(self.data, mmap.mmap):
+            try:
+                self.data.close()
+            except BufferError:
+                # a section view is still referenced somewhere; the map
+                # is released along with it
+                pass
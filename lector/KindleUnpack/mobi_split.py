@@ -4,12 +4,15 @@
 
 from __future__ import unicode_literals, division, absolute_import, print_function
 
+import logging
 import struct
 # note:  struct pack, unpack, unpack_from all require bytestring format
 # data all the way up to at least python 2.7.5, python 3 okay with bytestring
 
 from .unipath import pathof
 
+logger = logging.getLogger(__name__)
+
 
 # important  pdb header offsets
 unique_id_seed = 68
@@ -370,7 +373,7 @@ class mobi_split:
                 # print("n",n)
                 if n > 0 and n < lastimage:
                     lastimage = n-1
-        print("First Image, last Image", firstimage,lastimage)
+        logger.info("First Image, last Image %s %s", firstimage, lastimage)
 
         # Try to null out FONT and RES, but leave the (empty) PDB record so image refs remain valid
         for i in range(firstimage,lastimage):
@@ -4,11 +4,12 @@
 
 from __future__ import unicode_literals, division, absolute_import, print_function
 
-from .compatibility_utils import PY2, bchr, lmap, bstr
+from .compatibility_utils import PY2, lmap, bstr
 
 if PY2:
     range = xrange
 
+import re
 import struct
 # note:  struct pack, unpack, unpack_from all require bytestring format
 # data all the way up to at least python 2.7.5, python 3 okay with bytestring
@@ -22,38 +23,51 @@ class UncompressedReader:
     def unpack(self, data):
         return data
 
+# every byte that stands for itself in a PalmDOC record
+PALMDOC_LITERALS = re.compile(br'[\x00\x09-\x7f]+')
+
 class PalmdocReader:
 
     def unpack(self, i):
-        o, p = b'', 0
-        while p < len(i):
-            # for python 3 must use slice since i[p] returns int while slice returns character
-            c = ord(i[p:p+1])
-            p += 1
-            if (c >= 1 and c <= 8):
-                o += i[p:p+c]
-                p += c
-            elif (c < 128):
-                o += bchr(c)
-            elif (c >= 192):
-                o += b' ' + bchr(c ^ 128)
-            else:
-                if p < len(i):
-                    c = (c << 8) | ord(i[p:p+1])
+        # records may arrive as read-only section views
+        i = bytearray(i)
+        o = bytearray()
+        p, end = 0, len(i)
+        literals = PALMDOC_LITERALS.match
+        while p < end:
+            c = i[p]
+            if c >= 128:
+                p += 1
+                if c >= 192:
+                    o.append(32)
+                    o.append(c ^ 128)
+                elif p < end:
+                    c = (c << 8) | i[p]
                     p += 1
                     m = (c >> 3) & 0x07ff
                     n = (c & 7) + 3
-                    if (m > n):
+                    if m > n:
                         o += o[-m:n-m]
+                    elif 0 < m <= len(o):
+                        # overlapping copy, the last m bytes repeat
+                        o += (o[-m:] * (n // m + 1))[:n]
                     else:
+                        # malformed distance, keep the byte by byte behaviour
                         for _ in range(n):
-                            # because of completely ass-backwards decision by python mainters for python 3
-                            # we must use slice for bytes as i[p] returns int while slice returns character
                             if m == 1:
                                 o += o[-m:]
                             else:
                                 o += o[-m:-m+1]
-        return o
+            elif 1 <= c <= 8:
+                p += 1
+                o += i[p:p+c]
+                p += c
+            else:
+                # copy a run of plain text in one go
+                run = literals(i, p).end()
+                o += i[p:run]
+                p = run
+        return bytes(o)
 
 class HuffcdicReader:
     q = struct.Struct(b'>Q').unpack_from
@@ -79,53 +93,101 @@ class HuffcdicReader:
         for codelen, maxcode in enumerate((0,) + dict2[1::2]):
             self.maxcode += (((maxcode + 1) << (32 - codelen)) - 1, )
 
-        self.dictionary = []
+        # the dictionary index of a code only depends on its top codelen bits,
+        # so codes up to 16 bits are looked up straight from their first two
+        # bytes. The table is filled one leading byte at a time the first time
+        # that byte is seen; codes longer than 16 bits are marked with False
+        self.lookup = [None] * 65536
+
+        # raw phrases and their expansions, None until first used
+        self.phrases = []
+        self.expanded = []
 
     def loadCdic(self, cdic):
         if cdic[0:8] != b'CDIC\x00\x00\x00\x10':
             raise unpackException('invalid cdic header')
         phrases, bits = struct.unpack_from(b'>LL', cdic, 8)
-        n = min(1<<bits, phrases-len(self.dictionary))
+        n = min(1<<bits, phrases-len(self.phrases))
         h = struct.Struct(b'>H').unpack_from
-        def getslice(off):
+        for off in struct.unpack_from(bstr('>%dH' % n), cdic, 16):
             blen, = h(cdic, 16+off)
-            slice = cdic[18+off:18+off+(blen&0x7fff)]
-            return (slice, blen&0x8000)
-        self.dictionary += lmap(getslice, struct.unpack_from(bstr('>%dH' % n), cdic, 16))
+            phrase = bytes(cdic[18+off:18+off+(blen&0x7fff)])
+            self.phrases.append(phrase)
+            self.expanded.append(phrase if blen&0x8000 else None)
+
+    def fillLookup(self, prefix):
+        start, term, maxcode = self.dict1[prefix]
+        for low in range(256):
+            code = (prefix << 24) | (low << 16)
+            codelen = start
+            if not term:
+                while codelen <= 16 and code < self.mincode[codelen]:
+                    codelen += 1
+                maxcode = self.maxcode[codelen]
+            if codelen <= 16:
+                entry = (codelen, (maxcode - code) >> (32 - codelen))
+            else:
+                entry = False
+            self.lookup[(prefix << 8) | low] = entry
+
+    def lookupCode(self, code):
+        # resolve a code longer than 16 bits
+        codelen, term, maxcode = self.dict1[code >> 24]
+        if not term:
+            codelen = max(codelen, 17)
+            while code < self.mincode[codelen]:
+                codelen += 1
+            maxcode = self.maxcode[codelen]
+        return codelen, (maxcode - code) >> (32 - codelen)
+
+    def expandPhrase(self, r):
+        # a phrase met again while it is being expanded refers to itself,
+        # which only happens with corrupt data
+        phrase = self.phrases[r]
+        if phrase is None:
+            raise unpackException('recursive huffman phrase')
+        self.phrases[r] = None
+        phrase = self.unpack(phrase)
+        self.phrases[r] = phrase
+        self.expanded[r] = phrase
+        return phrase
 
     def unpack(self, data):
         q = HuffcdicReader.q
+        lookup = self.lookup
+        expanded = self.expanded
 
         bitsleft = len(data) * 8
+        data = bytearray(data)
         data += b"\x00\x00\x00\x00\x00\x00\x00\x00"
         pos = 0
         x, = q(data, pos)
         n = 32
 
-        s = b''
+        s = bytearray()
         while True:
             if n <= 0:
                 pos += 4
                 x, = q(data, pos)
                 n += 32
-            code = (x >> n) & ((1 << 32) - 1)
+            code = (x >> n) & 0xffffffff
 
-            codelen, term, maxcode = self.dict1[code >> 24]
-            if not term:
-                while code < self.mincode[codelen]:
-                    codelen += 1
-                maxcode = self.maxcode[codelen]
+            entry = lookup[code >> 16]
+            if not entry:
+                if entry is None:
+                    self.fillLookup(code >> 24)
+                    entry = lookup[code >> 16]
+                if not entry:
+                    entry = self.lookupCode(code)
+            codelen, r = entry
 
             n -= codelen
             bitsleft -= codelen
             if bitsleft < 0:
                 break
 
-            r = (maxcode - code) >> (32 - codelen)
-            slice, flag = self.dictionary[r]
-            if not flag:
-                self.dictionary[r] = None
-                slice = self.unpack(slice)
-                self.dictionary[r] = (slice, 1)
-            s += slice
-        return s
+            phrase = expanded[r]
+            if phrase is None:
+                phrase = self.expandPhrase(r)
+            s += phrase
+        return bytes(s)
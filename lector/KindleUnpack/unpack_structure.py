@@ -35,47 +35,93 @@ class ZipInfo(zipfile.ZipInfo):
 
 class fileNames:
 
-    def __init__(self, infile, outdir):
+    def __init__(self, infile, outdir, inmemory=False, dump=False, writeraw=False, dictionary=False):
         self.infile = infile
         self.outdir = outdir
-        if not unipath.exists(self.outdir):
-            unipath.mkdir(self.outdir)
+        # dump all possible information / write raw data for debugging,
+        # kept here rather than globally so unpacks stay independent
+        self.dump = dump
+        self.writeraw = writeraw
+        # dictionary indexes are slow to decode and only wanted on request
+        self.dictionary = dictionary
+        # when unpacking in memory nothing touches the disk, every file
+        # written is kept in outfiles keyed by its normalized path
+        self.inmemory = inmemory
+        self.outfiles = {}
+        self.makeDir(self.outdir)
         self.mobi7dir = os.path.join(self.outdir,'mobi7')
-        if not unipath.exists(self.mobi7dir):
-            unipath.mkdir(self.mobi7dir)
+        self.makeDir(self.mobi7dir)
         self.imgdir = os.path.join(self.mobi7dir, 'Images')
-        if not unipath.exists(self.imgdir):
-            unipath.mkdir(self.imgdir)
+        self.makeDir(self.imgdir)
         self.hdimgdir = os.path.join(self.outdir,'HDImages')
-        if not unipath.exists(self.hdimgdir):
-            unipath.mkdir(self.hdimgdir)
+        self.makeDir(self.hdimgdir)
         self.outbase = os.path.join(self.outdir, os.path.splitext(os.path.split(infile)[1])[0])
+        self.k8dir = None
+
+    def makeDir(self, path):
+        if not self.inmemory and not unipath.exists(path):
+            unipath.mkdir(path)
+
+    def write(self, path, data):
+        if self.inmemory:
+            # data may be a view into the mapped book
+            self.outfiles[os.path.normpath(path)] = bytes(data)
+        else:
+            with open(pathof(path), 'wb') as f:
+                f.write(data)
+
+    def read(self, path):
+        if self.inmemory:
+            return self.outfiles[os.path.normpath(path)]
+        with open(pathof(path), 'rb') as f:
+            return f.read()
+
+    def exists(self, path):
+        if self.inmemory:
+            return os.path.normpath(path) in self.outfiles
+        return unipath.exists(path)
+
+    def remove(self, path):
+        if self.inmemory:
+            del self.outfiles[os.path.normpath(path)]
+        else:
+            os.remove(pathof(path))
+
+    def listFiles(self, path):
+        # names of the files directly inside path
+        if self.inmemory:
+            path = os.path.normpath(path)
+            return [os.path.basename(i) for i in self.outfiles if os.path.dirname(i) == path]
+        return [i for i in unipath.listdir(path) if unipath.isfile(os.path.join(path, i))]
+
+    def getContainer(self, path):
+        # every file below path keyed by its relative name with forward
+        # slashes, the way a zip archive would list it
+        path = os.path.normpath(path)
+        container = {}
+        for name, data in self.outfiles.items():
+            if name.startswith(path + os.sep):
+                container[os.path.relpath(name, path).replace(os.sep, '/')] = data
+        return container
 
     def getInputFileBasename(self):
         return os.path.splitext(os.path.basename(self.infile))[0]
 
     def makeK8Struct(self):
         self.k8dir = os.path.join(self.outdir,'mobi8')
-        if not unipath.exists(self.k8dir):
-            unipath.mkdir(self.k8dir)
+        self.makeDir(self.k8dir)
         self.k8metainf = os.path.join(self.k8dir,'META-INF')
-        if not unipath.exists(self.k8metainf):
-            unipath.mkdir(self.k8metainf)
+        self.makeDir(self.k8metainf)
         self.k8oebps = os.path.join(self.k8dir,'OEBPS')
-        if not unipath.exists(self.k8oebps):
-            unipath.mkdir(self.k8oebps)
+        self.makeDir(self.k8oebps)
         self.k8images = os.path.join(self.k8oebps,'Images')
-        if not unipath.exists(self.k8images):
-            unipath.mkdir(self.k8images)
+        self.makeDir(self.k8images)
         self.k8fonts = os.path.join(self.k8oebps,'Fonts')
-        if not unipath.exists(self.k8fonts):
-            unipath.mkdir(self.k8fonts)
+        self.makeDir(self.k8fonts)
         self.k8styles = os.path.join(self.k8oebps,'Styles')
-        if not unipath.exists(self.k8styles):
-            unipath.mkdir(self.k8styles)
+        self.makeDir(self.k8styles)
         self.k8text = os.path.join(self.k8oebps,'Text')
-        if not unipath.exists(self.k8text):
-            unipath.mkdir(self.k8text)
+        self.makeDir(self.k8text)
 
     # recursive zip creation support routine
     def zipUpDir(self, myzip, tdir, localname):
@@ -104,7 +150,7 @@ class fileNames:
 
         # copy over all images and fonts that are actually used in the ebook
         # and remove all font files from mobi7 since not supported
-        imgnames = unipath.listdir(self.imgdir)
+        imgnames = self.listFiles(self.imgdir)
         for name in imgnames:
             if usedmap.get(name,'not used') == 'used':
                 filein = os.path.join(self.imgdir,name)
@@ -116,15 +162,13 @@ class fileNames:
                     fileout = os.path.join(self.k8fonts,name)
                 else:
                     fileout = os.path.join(self.k8images,name)
-                data = b''
-                with open(pathof(filein),'rb') as f:
-                    data = f.read()
+                data = self.read(filein)
                 if obfuscate_data:
                     if name in obfuscate_data:
                         data = mangle_fonts(key, data)
-                open(pathof(fileout),'wb').write(data)
+                self.write(fileout, data)
                 if name.endswith(".ttf") or name.endswith(".otf"):
-                    os.remove(pathof(filein))
+                    self.remove(filein)
 
         # opf file name hard coded to "content.opf"
         container = '<?xml version="1.0" encoding="UTF-8"?>\n'
@@ -133,8 +177,7 @@ class fileNames:
         container += '<rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/>'
         container += '    </rootfiles>\n</container>\n'
         fileout = os.path.join(self.k8metainf,'container.xml')
-        with open(pathof(fileout),'wb') as f:
-            f.write(container.encode('utf-8'))
+        self.write(fileout, container.encode('utf-8'))
 
         if obfuscate_data:
             encryption = '<encryption xmlns="urn:oasis:names:tc:opendocument:xmlns:container" \
@@ -148,17 +191,20 @@ xmlns:enc="http://www.w3.org/2001/04/xmlenc#" xmlns:deenc="http://ns.adobe.com/d
                 encryption += '  </enc:EncryptedData>\n'
             encryption += '</encryption>\n'
             fileout = os.path.join(self.k8metainf,'encryption.xml')
-            with open(pathof(fileout),'wb') as f:
-                f.write(encryption.encode('utf-8'))
-
-        # ready to build epub
-        self.outzip = zipfile.ZipFile(pathof(bname), 'w')
+            self.write(fileout, encryption.encode('utf-8'))
 
         # add the mimetype file uncompressed
         mimetype = b'application/epub+zip'
         fileout = os.path.join(self.k8dir,'mimetype')
-        with open(pathof(fileout),'wb') as f:
-            f.write(mimetype)
+        self.write(fileout, mimetype)
+
+        # the files in memory already make up the book, there is
+        # no archive to build
+        if self.inmemory:
+            return
+
+        # ready to build epub
+        self.outzip = zipfile.ZipFile(pathof(bname), 'w')
         nzinfo = ZipInfo('mimetype', compress_type=zipfile.ZIP_STORED)
         nzinfo.external_attr = 0o600 << 16 # make this a normal file
         self.outzip.writestr(nzinfo, mimetype)
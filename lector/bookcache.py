@@ -0,0 +1,365 @@
+# This file is a part of Lector, a Qt based ebook reader
+# Copyright (C) 2017-2019 BasioMeusPuga
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Parsed books are kept on disk so that opening a book again
+# skips the parser altogether. Every entry is a directory named
+# after the hash of the book and holds
+#   meta.pickle     - Parser, source file stat, ToC, block counts
+#   chapters.pickle - zlib compressed chapter HTML
+#   resources/      - Images etc. the chapters refer to
+# Chapters refer to resources with absolute paths inside the temp
+# directory of the session that parsed them. These are stored with a
+# placeholder and pointed at the current temp directory on loading.
+# Entries are evicted least recently used first once the cache grows
+# beyond its size limit.
+# The RenderCache next to it holds markup that parsers render from
+# parts of a book, such as the sections of a Markdown document.
+
+import os
+import re
+import uuid
+import zlib
+import pickle
+import shutil
+import logging
+import threading
+
+from PyQt5 import QtCore
+
+logger = logging.getLogger(__name__)
+
+# Bump this whenever the layout of an entry changes
+# Parsers can invalidate their own entries with a cache_version attribute
+CACHE_FORMAT = 1
+TEMP_DIR_PLACEHOLDER = '\x00lector-temp-dir\x00'
+
+# Extracted files that are never loaded from disk by the reader
+SKIPPED_RESOURCES = ('.html', '.xhtml', '.htm', '.xml', '.opf', '.ncx', '.css')
+
+_cache_lock = threading.Lock()
+
+
+def cache_location(name='books'):
+    return os.path.join(
+        QtCore.QStandardPaths.writableLocation(QtCore.QStandardPaths.CacheLocation),
+        name)
+
+
+def parser_version(parser):
+    return (parser.__name__, getattr(parser, 'cache_version', 1))
+
+
+def stat_fingerprint(filename):
+    # Anything that modifies a file will change at least one of these
+    file_stat = os.stat(filename)
+    return file_stat.st_size, file_stat.st_mtime_ns, file_stat.st_ino
+
+
+def write_atomically(file_path, data):
+    # Readers only ever see a complete file
+    temp_path = file_path + '.' + uuid.uuid4().hex
+    try:
+        with open(temp_path, 'wb') as this_file:
+            this_file.write(data)
+        os.replace(temp_path, file_path)
+    except OSError:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
+
+
+def touch(file_path):
+    # Marks an entry as recently used for the sake of eviction
+    try:
+        os.utime(file_path)
+    except OSError:
+        pass
+
+
+def evict_least_recent(entries, size_limit, remove):
+    # entries are (key, size, last used)
+    # remove(key) is called for the least recently used ones
+    # until whatever is left fits into size_limit
+    total_size = sum(i[1] for i in entries)
+    for key, entry_size, _ in sorted(entries, key=lambda x: x[2]):
+        if total_size <= size_limit:
+            break
+        remove(key)
+        total_size -= entry_size
+
+
+def link_or_copy(source, destination):
+    # Hard links make restoring an entry nearly free
+    # Entries are always written with copies of their own so that
+    # parsers rewriting a file in the temp dir never reach into the cache
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copy2(source, destination)
+
+
+class BookCache:
+    def __init__(self, size_limit_mb=500, location=None):
+        self.location = location or cache_location()
+        self.size_limit = size_limit_mb * 1024 * 1024
+
+    def entry_path(self, file_md5):
+        return os.path.join(self.location, file_md5)
+
+    def read_meta(self, file_md5):
+        try:
+            with open(os.path.join(self.entry_path(file_md5), 'meta.pickle'), 'rb') as meta_file:
+                meta = pickle.load(meta_file)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+
+        if meta.get('format') != CACHE_FORMAT:
+            return None
+        return meta
+
+    def write_meta(self, entry_path, meta):
+        write_atomically(
+            os.path.join(entry_path, 'meta.pickle'),
+            pickle.dumps(meta, pickle.HIGHEST_PROTOCOL))
+
+    def is_current(self, meta, filename=None):
+        filename = filename or meta['path']
+        try:
+            return tuple(meta['fingerprint']) == stat_fingerprint(filename)
+        except OSError:
+            return False
+
+    def load(self, file_md5, filename, parser, temp_dir):
+        # Returns (toc, content, images_only, block_counts) or None
+        meta = self.read_meta(file_md5)
+        if not meta:
+            return None
+
+        if (meta['parser'] != parser_version(parser)
+                or not self.is_current(meta, filename)):
+            self.remove(file_md5)
+            return None
+
+        entry_path = self.entry_path(file_md5)
+        try:
+            with open(os.path.join(entry_path, 'chapters.pickle'), 'rb') as chapters_file:
+                chapters = pickle.load(chapters_file)
+
+            resource_root = os.path.join(entry_path, 'resources')
+            for directory, _, files in os.walk(resource_root):
+                target_directory = os.path.join(
+                    temp_dir, os.path.relpath(directory, resource_root))
+                os.makedirs(target_directory, exist_ok=True)
+                for i in files:
+                    target_path = os.path.join(target_directory, i)
+                    if not os.path.exists(target_path):
+                        link_or_copy(os.path.join(directory, i), target_path)
+        except (OSError, EOFError, pickle.UnpicklingError, zlib.error):
+            logger.exception('Discarding unreadable cache entry: ' + filename)
+            self.remove(file_md5)
+            return None
+
+        content = []
+        for i in chapters:
+            if isinstance(i, bytes):
+                i = zlib.decompress(i).decode('utf-8').replace(
+                    TEMP_DIR_PLACEHOLDER, temp_dir)
+            content.append(i)
+
+        touch(os.path.join(entry_path, 'meta.pickle'))
+
+        return meta['toc'], content, meta['images_only'], meta['block_counts']
+
+    def store(self, this_book, parser, temp_dir):
+        # Anything that goes wrong here only means the
+        # book will be parsed again the next time
+        file_md5 = this_book['hash']
+        staging_path = None
+        try:
+            fingerprint = stat_fingerprint(this_book['path'])
+            entry_path = self.entry_path(file_md5)
+            staging_path = entry_path + '.' + uuid.uuid4().hex
+            os.makedirs(staging_path)
+
+            # Anything the chapters point to inside the temp dir is kept
+            # along with whatever was extracted for the book
+            temp_dir_path = re.compile(
+                re.escape(os.path.join(temp_dir, '')) + r'''([^"'<>]+)''')
+            resources = set()
+            chapters = []
+            for i in this_book['content']:
+                if isinstance(i, str):
+                    resources.update(temp_dir_path.findall(i))
+                    i = zlib.compress(
+                        i.replace(temp_dir, TEMP_DIR_PLACEHOLDER).encode('utf-8'))
+                chapters.append(i)
+
+            extract_path = os.path.join(temp_dir, file_md5)
+            for directory, _, files in os.walk(extract_path):
+                for i in files:
+                    if not i.lower().endswith(SKIPPED_RESOURCES):
+                        resources.add(os.path.relpath(
+                            os.path.join(directory, i), temp_dir))
+
+            size = 0
+            for i in resources:
+                source_path = os.path.join(temp_dir, i)
+                if not os.path.isfile(source_path):
+                    continue
+                target_path = os.path.join(staging_path, 'resources', i)
+                os.makedirs(os.path.dirname(target_path), exist_ok=True)
+                shutil.copyfile(source_path, target_path)
+                size += os.path.getsize(target_path)
+
+            with open(os.path.join(staging_path, 'chapters.pickle'), 'wb') as chapters_file:
+                pickle.dump(chapters, chapters_file, pickle.HIGHEST_PROTOCOL)
+            size += os.path.getsize(os.path.join(staging_path, 'chapters.pickle'))
+
+            self.write_meta(staging_path, {
+                'format': CACHE_FORMAT,
+                'parser': parser_version(parser),
+                'path': this_book['path'],
+                'fingerprint': fingerprint,
+                'size': size,
+                'toc': this_book['toc'],
+                'images_only': this_book['images_only'],
+                'block_counts': None})
+
+            with _cache_lock:
+                shutil.rmtree(entry_path, ignore_errors=True)
+                os.rename(staging_path, entry_path)
+
+        except Exception:
+            logger.exception('Unable to cache: ' + this_book['path'])
+            if staging_path:
+                shutil.rmtree(staging_path, ignore_errors=True)
+            return
+
+        self.evict()
+
+    def store_block_counts(self, file_md5, block_counts):
+        # These come from the reader once it has laid out every chapter
+        with _cache_lock:
+            meta = self.read_meta(file_md5)
+            if not meta:
+                return
+            meta['block_counts'] = block_counts
+            try:
+                self.write_meta(self.entry_path(file_md5), meta)
+            except OSError:
+                logger.error('Unable to cache block counts for: ' + meta['path'])
+
+    def remove(self, file_md5):
+        with _cache_lock:
+            shutil.rmtree(self.entry_path(file_md5), ignore_errors=True)
+
+    def entries(self):
+        # (file_md5, meta, last used) for everything in the cache
+        try:
+            entry_names = os.listdir(self.location)
+        except OSError:
+            return []
+
+        all_entries = []
+        for i in entry_names:
+            if '.' in i:  # Still being written
+                continue
+            meta = self.read_meta(i)
+            if not meta:
+                self.remove(i)
+                continue
+            try:
+                last_used = os.stat(
+                    os.path.join(self.entry_path(i), 'meta.pickle')).st_mtime
+            except OSError:
+                continue
+            all_entries.append((i, meta, last_used))
+
+        return all_entries
+
+    def evict(self, all_entries=None):
+        if all_entries is None:
+            all_entries = self.entries()
+
+        evict_least_recent(
+            [(i[0], i[1]['size'], i[2]) for i in all_entries],
+            self.size_limit, self.remove)
+
+    def invalidate_changed(self):
+        # Drops entries whose book has been modified, moved, or deleted
+        current_entries = []
+        for i in self.entries():
+            if self.is_current(i[1]):
+                current_entries.append(i)
+            else:
+                logger.info('Dropping cache for changed book: ' + i[1]['path'])
+                self.remove(i[0])
+
+        self.evict(current_entries)
+
+
+class RenderCache:
+    # Rendered markup keyed by a hash of whatever it was rendered from
+    # Books that change between readings then only have their changed
+    # parts rendered again. Every entry is one zlib compressed file.
+
+    def __init__(self, size_limit_mb=50, location=None):
+        self.location = location or cache_location('rendered')
+        self.size_limit = size_limit_mb * 1024 * 1024
+
+    def load(self, key):
+        entry_path = os.path.join(self.location, key)
+        try:
+            with open(entry_path, 'rb') as entry_file:
+                rendered = zlib.decompress(entry_file.read()).decode('utf-8')
+        except (OSError, zlib.error, UnicodeDecodeError):
+            return None
+
+        touch(entry_path)
+        return rendered
+
+    def store(self, key, rendered):
+        # Anything that goes wrong here only means
+        # rendering again the next time
+        try:
+            os.makedirs(self.location, exist_ok=True)
+            write_atomically(
+                os.path.join(self.location, key),
+                zlib.compress(rendered.encode('utf-8')))
+        except OSError:
+            logger.exception('Unable to cache rendered markup')
+
+    def remove(self, key):
+        try:
+            os.remove(os.path.join(self.location, key))
+        except OSError:
+            pass
+
+    def evict(self):
+        all_entries = []
+        try:
+            with os.scandir(self.location) as entry_files:
+                for i in entry_files:
+                    if '.' in i.name:  # Still being written
+                        continue
+                    entry_stat = i.stat()
+                    all_entries.append((i.name, entry_stat.st_size, entry_stat.st_mtime))
+        except OSError:
+            return
+
+        evict_least_recent(all_entries, self.size_limit, self.remove)
@@ -498,6 +498,22 @@ class PliantQTextBrowser(QtWidgets.QTextBrowser):
         self.page_cursors = []
         self.page_number = 0
 
+        # Set by the tab for books that are read without extraction
+        self.resources = None
+
+    def loadResource(self, resource_type, url):
+        # Stylesheets are never applied
+        if resource_type == QtGui.QTextDocument.StyleSheetResource:
+            return None
+
+        resource_path = url.path()
+        if (self.resources is None
+                or resource_type != QtGui.QTextDocument.ImageResource
+                or os.path.isabs(resource_path)):
+            return super(PliantQTextBrowser, self).loadResource(resource_type, url)
+
+        return self.resources.get_image(resource_path)
+
     def wheelEvent(self, event):
         if self.text_mode in ('singlePage', 'doublePage'):
             vertical_pdelta = event.pixelDelta().y()
@@ -1103,7 +1119,9 @@ class PliantWidgetsCommonFunctions:
             self.pw.parent.metadata['hash'],
             1, QtCore.Qt.MatchExactly)
 
-        if self.are_we_doing_images_only:
+        # Block counts for streamed books are only available once parsing is done
+        if (self.are_we_doing_images_only
+                or not self.pw.parent.metadata['position']['total_blocks']):
             position_percentage = (
                 self.pw.parent.metadata['position']['current_chapter'] /
                 self.pw.parent.metadata['position']['total_chapters'])
@@ -52,6 +52,30 @@ class DatabaseInit:
             'Tags': 'TEXT',
             'CheckState': 'INTEGER'}
 
+        # Tables that only speed things up and can be added to an
+        # existing database without touching anything else
+        self.index_tables = {
+            # Path -> Hash index keyed by the stat of the file
+            # This allows for unchanged files to never be opened again
+            'fingerprints': {
+                'Path': 'TEXT PRIMARY KEY',
+                'Size': 'INTEGER',
+                'MTime': 'INTEGER',
+                'Inode': 'INTEGER',
+                'Hash': 'TEXT'},
+            # Directory state as of the last library scan
+            # Subdirectories and Files are pickled lists of names
+            'scan_state': {
+                'Path': 'TEXT PRIMARY KEY',
+                'MTime': 'INTEGER',
+                'Subdirectories': 'BLOB',
+                'Files': 'BLOB'},
+            # Files still waiting to be processed by a library addition
+            # Anything left here at startup belongs to an interrupted run
+            'import_journal': {
+                'Path': 'TEXT PRIMARY KEY',
+                'Addition': 'TEXT'}}
+
         if os.path.exists(self.database_path):
             self.check_columns()
         else:
@@ -69,9 +93,18 @@ class DatabaseInit:
             [i[0] + ' ' + i[1] for i in self.directories_table_columns.items()])
         self.database.execute(f"CREATE TABLE directories ({column_string})")
 
+        for i in self.index_tables:
+            self.create_index_table(i)
+
         self.database.commit()
         self.database.close()
 
+    def create_index_table(self, table_name):
+        column_string = ', '.join(
+            [i[0] + ' ' + i[1] for i in self.index_tables[table_name].items()])
+        self.database.execute(
+            f"CREATE TABLE IF NOT EXISTS {table_name} ({column_string})")
+
     def check_columns(self):
         self.database = sqlite3.connect(self.database_path)
 
@@ -88,6 +121,15 @@ class DatabaseInit:
                 sql_command = f"ALTER TABLE books ADD COLUMN {i[0]} {i[1]}"
                 self.database.execute(sql_command)
 
+        # Databases created by earlier versions lack these tables
+        database_tables = self.database.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table'").fetchall()
+        for i in self.index_tables:
+            if (i,) not in database_tables:
+                commit_required = True
+                logger.info(f'Database: Adding table "{i}"')
+                self.create_index_table(i)
+
         if commit_required:
             self.database.commit()
 
@@ -117,18 +159,22 @@ class DatabaseFunctions:
         self.database.commit()
         self.database.close()
 
-    def add_to_database(self, data):
+    def add_to_database(self, data, journal_paths=None):
         # data is expected to be a dictionary
         # with keys corresponding to the book hash
         # and corresponding items containing
         # whatever else needs insertion
         # Haha I said insertion
 
+        # journal_paths are removed from the import journal
+        # in the same transaction as the books themselves
+
         # Add the current datetime value to each file's database entry
         # current_time = datetime.datetime.now()
         current_datetime = QtCore.QDateTime().currentDateTime()
         current_datetime_bin = sqlite3.Binary(pickle.dumps(current_datetime))
 
+        insert_data = []
         for i in data.items():
             book_hash = i[0]
             title = i[1]['title']
@@ -146,25 +192,53 @@ class DatabaseFunctions:
                 # Is still a list. Needs to be None.
                 tags = None
 
-            sql_command_add = (
-                "INSERT OR REPLACE INTO \
-                books (Title, Author, Year, DateAdded, Path, \
-                ISBN, Tags, Hash, CoverImage, Addition) \
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)")
-
             cover_insert = None
             if cover:
                 cover_insert = sqlite3.Binary(cover)
 
-            self.database.execute(
-                sql_command_add,
+            insert_data.append(
                 [title, author, year, current_datetime_bin,
                  path, isbn, tags, book_hash, cover_insert,
                  addition_mode])
 
+        sql_command_add = (
+            "INSERT OR REPLACE INTO \
+            books (Title, Author, Year, DateAdded, Path, \
+            ISBN, Tags, Hash, CoverImage, Addition) \
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)")
+        self.database.executemany(sql_command_add, insert_data)
+
+        if journal_paths:
+            self.database.executemany(
+                "DELETE FROM import_journal WHERE Path = ?",
+                [(i,) for i in journal_paths])
+
         self.database.commit()
         self.database.close()
 
+    def set_import_journal(self, file_list, addition_mode):
+        self.database.executemany(
+            "INSERT OR REPLACE INTO import_journal (Path, Addition) VALUES (?, ?)",
+            [(i, addition_mode) for i in file_list])
+        self.database.commit()
+        self.database.close()
+
+    def clear_import_journal(self):
+        self.database.execute("DELETE FROM import_journal")
+        self.database.commit()
+        self.database.close()
+
+    def fetch_import_journal(self):
+        # Returns a dictionary of {addition_mode: [paths]}
+        data = self.database.execute(
+            "SELECT Path, Addition FROM import_journal").fetchall()
+        self.database.close()
+
+        pending_imports = {}
+        for i in data:
+            pending_imports.setdefault(i[1], []).append(i[0])
+        return pending_imports
+
     def fetch_data(self, columns, table, selection_criteria, equivalence, fetch_one=False):
         # columns is a tuple that will be passed as a comma separated list
         # table is a string that will be used as is
@@ -214,6 +288,78 @@ class DatabaseFunctions:
             error_string = 'SQLite is in wretched rebellion @ data fetching handling'
             logger.critical(error_string + f' {type(e).__name__} Arguments: {e.args}')
 
+    def fetch_fingerprints(self, path_list=None):
+        # Returns a dictionary of the form
+        # {path: (size, mtime, inode, hash)}
+        # for either the paths specified, or the entire index
+        sql_command = "SELECT Path, Size, MTime, Inode, Hash FROM fingerprints"
+        if path_list is None:
+            data = self.database.execute(sql_command).fetchall()
+        else:
+            path_list = list(path_list)
+            data = []
+            # SQLite limits the number of host parameters per statement
+            for i in range(0, len(path_list), 500):
+                this_chunk = path_list[i:i + 500]
+                parameter_marks = ','.join(['?' for _ in this_chunk])
+                data.extend(self.database.execute(
+                    sql_command + f" WHERE Path IN ({parameter_marks})",
+                    this_chunk).fetchall())
+
+        self.database.close()
+        return {i[0]: i[1:] for i in data}
+
+    def add_fingerprints(self, fingerprints):
+        # fingerprints is expected to be an iterable of
+        # (path, size, mtime, inode, hash) tuples
+        sql_command = (
+            "INSERT OR REPLACE INTO fingerprints (Path, Size, MTime, Inode, Hash) \
+             VALUES (?, ?, ?, ?, ?)")
+        self.database.executemany(sql_command, fingerprints)
+        self.database.commit()
+        self.database.close()
+
+    def delete_fingerprints(self, path_list):
+        self.database.executemany(
+            "DELETE FROM fingerprints WHERE Path = ?",
+            [(i,) for i in path_list])
+        self.database.commit()
+        self.database.close()
+
+    def fetch_scan_state(self):
+        # Returns a dictionary of the form
+        # {directory: (mtime, subdirectories, files)}
+        data = self.database.execute(
+            "SELECT Path, MTime, Subdirectories, Files FROM scan_state").fetchall()
+        self.database.close()
+
+        return {
+            i[0]: (i[1], pickle.loads(i[2]), pickle.loads(i[3])) for i in data}
+
+    def set_scan_state(self, scan_state):
+        # The entire state is replaced since directories that
+        # weren't visited are no longer part of the library
+        self.database.execute("DELETE FROM scan_state")
+        self.database.executemany(
+            "INSERT INTO scan_state (Path, MTime, Subdirectories, Files) \
+             VALUES (?, ?, ?, ?)",
+            [(i[0], i[1][0],
+              sqlite3.Binary(pickle.dumps(i[1][1])),
+              sqlite3.Binary(pickle.dumps(i[1][2]))) for i in scan_state.items()])
+        self.database.commit()
+        self.database.close()
+
+    def modify_paths(self, moved_paths):
+        # moved_paths is expected to be a dictionary of {old: new}
+        # Both the books table and the fingerprint index are updated
+        move_pairs = [(i[1], i[0]) for i in moved_paths.items()]
+        self.database.executemany(
+            "UPDATE books SET Path = ? WHERE Path = ?", move_pairs)
+        self.database.executemany(
+            "UPDATE OR REPLACE fingerprints SET Path = ? WHERE Path = ?", move_pairs)
+        self.database.commit()
+        self.database.close()
+
     def fetch_covers_only(self, hash_list):
         parameter_marks = ','.join(['?' for i in hash_list])
         sql_command = f"SELECT Hash, CoverImage from books WHERE Hash IN ({parameter_marks})"
@@ -223,11 +223,18 @@ class Library:
             this_item.setData(directory_name, QtCore.Qt.UserRole + 10)
             this_item.setData(directory_tags, QtCore.Qt.UserRole + 11)
 
-    def prune_models(self, valid_paths):
+    def prune_models(self, valid_paths=None, removed_paths=None):
         # To be executed when the library is updated by folder
         # All files in unselected directories will have to be removed
         # from both of the models
         # They will also have to be deleted from the library
+        # Incremental scans already know which paths are gone
+        # and pass those as removed_paths instead
+        if removed_paths is not None:
+            removed_paths = set(removed_paths)
+        else:
+            valid_paths = set(valid_paths)
+
         invalid_paths = []
         deletable_persistent_indexes = []
 
@@ -242,7 +249,12 @@ class Library:
                 addition_mode = 'automatic'
                 logger.error('Libary: Error setting addition mode for prune')
 
-            if (book_path not in valid_paths and
+            if removed_paths is not None:
+                is_invalid = book_path in removed_paths
+            else:
+                is_invalid = book_path not in valid_paths
+
+            if (is_invalid and
                     (addition_mode != 'manual' or addition_mode is None)):
 
                 invalid_paths.append(book_path)
@@ -257,6 +269,23 @@ class Library:
         database.DatabaseFunctions(
             self.main_window.database_path).delete_from_database('Path', invalid_paths)
 
+    def update_model_paths(self, moved_paths):
+        # moved_paths is expected to be a dictionary of {old: new}
+        for i in range(self.libraryModel.rowCount()):
+            item = self.libraryModel.item(i)
+            item_metadata = item.data(QtCore.Qt.UserRole + 3)
+
+            try:
+                new_path = moved_paths[item_metadata['path']]
+            except KeyError:
+                continue
+
+            item_metadata['path'] = new_path
+            item_metadata['file_exists'] = True
+            item.setData(item_metadata, QtCore.Qt.UserRole + 3)
+            item.setData(True, QtCore.Qt.UserRole + 5)
+            item.setData(new_path, QtCore.Qt.UserRole + 13)
+
 
 def generate_position_percentage(position):
     if not position:
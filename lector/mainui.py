@@ -19,7 +19,6 @@
 import os
 import gc
 import sys
-import hashlib
 import pathlib
 
 # This allows for the program to be launched from the
@@ -44,6 +43,8 @@ from app.lector.lector.toolbars import LibraryToolBar, BookToolBar
 from app.lector.lector.widgets import Tab
 from app.lector.lector.delegates import LibraryDelegate
 from app.lector.lector.threaded import BackGroundTabUpdate, BackGroundBookAddition, BackGroundBookDeletion
+from app.lector.lector.threaded import BackGroundFingerprintVerification
+from app.lector.lector.threaded import BackGroundBookCacheCleanup
 from app.lector.lector.library import Library
 from app.lector.lector.guifunctions import QImageFactory, ViewProfileModification
 from app.lector.lector.settings import Settings
@@ -71,6 +72,7 @@ class MainUI(QtWidgets.QMainWindow, mainwindow.Ui_MainWindow):
         # Empty variables that will be infested soon
         self.settings = {}
         self.thread = None  # Background Thread
+        self.verification_thread = None  # Fingerprint verification
         self.current_contentView = None  # For fullscreening purposes
         self.display_profiles = None
         self.current_profile_index = None
@@ -261,6 +263,18 @@ class MainUI(QtWidgets.QMainWindow, mainwindow.Ui_MainWindow):
         self.ksCloseTab.activated.connect(self.tab_close)
 
         self.open_books_at_startup()
+        self.resume_interrupted_addition()
+
+        # Optional full pass over the fingerprint index
+        if self.settings['verify_fingerprints']:
+            self.verification_thread = BackGroundFingerprintVerification(
+                self.database_path)
+            self.verification_thread.start(QtCore.QThread.LowestPriority)
+
+        # Parsed book cache entries for books that have changed
+        self.cache_cleanup_thread = BackGroundBookCacheCleanup(
+            self.settings['book_cache_limit'])
+        self.cache_cleanup_thread.start(QtCore.QThread.LowestPriority)
 
     def open_books_at_startup(self):
         # Last open books and command line books aren't being opened together
@@ -274,6 +288,48 @@ class MainUI(QtWidgets.QMainWindow, mainwindow.Ui_MainWindow):
         else:
             self.settings['last_open_tab'] = None
 
+    def resume_interrupted_addition(self):
+        # Library additions commit books in batches and keep
+        # track of what's left in the import journal
+        # Anything still in there was interrupted and is picked up again
+        pending_imports = database.DatabaseFunctions(
+            self.database_path).fetch_import_journal()
+        if not pending_imports:
+            return
+
+        # The addition thread will journal whatever still exists
+        database.DatabaseFunctions(self.database_path).clear_import_journal()
+
+        addition_mode, file_list = pending_imports.popitem()
+        for i in pending_imports.items():  # These are resumed later
+            database.DatabaseFunctions(self.database_path).set_import_journal(
+                i[1], i[0])
+
+        logger.info(f'Resuming interrupted addition of {len(file_list)} files')
+
+        self.statusBar.setVisible(True)
+        self.sorterProgress.setVisible(True)
+        self.statusMessage.setText(
+            self._translate('Main_UI', 'Resuming addition'))
+
+        self.thread = BackGroundBookAddition(
+            file_list, self.database_path, addition_mode, self)
+        self.thread.prune_required = False  # This is not the whole library
+        self.thread.booksCommitted.connect(self.add_books_to_model)
+        self.thread.pathsMoved.connect(self.move_model_paths)
+        self.thread.finished.connect(self.resumed_addition_finished)
+        self.thread.start()
+
+    def add_books_to_model(self, parsed_books):
+        self.lib_ref.generate_model('addition', parsed_books, False)
+
+    def move_model_paths(self, moved_paths):
+        self.lib_ref.update_model_paths(moved_paths)
+
+    def resumed_addition_finished(self):
+        self.move_on(self.thread.errors)
+        self.resume_interrupted_addition()
+
     def process_post_hoc_files(self, file_list, open_files_after_processing):
         # Takes care of both dragged and dropped files
         # As well as files sent as command line arguments
@@ -312,11 +368,9 @@ class MainUI(QtWidgets.QMainWindow, mainwindow.Ui_MainWindow):
 
             file_md5 = filename[1]
             if not file_md5:
-                try:
-                    with open(filename[0], 'rb') as current_book:
-                        first_bytes = current_book.read(1024 * 32)  # First 32KB of the file
-                        file_md5 = hashlib.md5(first_bytes).hexdigest()
-                except FileNotFoundError:
+                file_md5 = sorter.get_file_hashes(
+                    [filename[0]], self.database_path).get(filename[0])
+                if not file_md5:
                     return
 
             # Remove any already open files
@@ -587,6 +641,9 @@ class MainUI(QtWidgets.QMainWindow, mainwindow.Ui_MainWindow):
         self.metadataDialog.hide()
         self.settingsDialog.hide()
         self.temp_dir.remove()
+        if self.verification_thread:
+            self.verification_thread.requestInterruption()
+            self.verification_thread.wait()
         for this_dock in self.active_docks:
             try:
                 this_dock.setVisible(False)
@@ -616,6 +673,7 @@ class MainUI(QtWidgets.QMainWindow, mainwindow.Ui_MainWindow):
             self.database_care()
 
     def database_care(self):
+        sorter.close_worker_pool()
         database.DatabaseFunctions(self.database_path).vacuum_database()
         QtWidgets.qApp.exit()
 
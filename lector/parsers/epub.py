@@ -18,7 +18,6 @@
 # Maybe also include book description
 
 import os
-import zipfile
 import logging
 
 from app.lector.lector.readers.read_epub import EPUB
@@ -41,8 +40,7 @@ class ParseEPUB:
         return self.book.metadata
 
     def generate_content(self):
-        zipfile.ZipFile(self.filename).extractall(self.extract_path)
-
+        # Nothing is extracted. The reader loads images from the archive
         self.book.generate_toc()
         self.book.generate_content()
 
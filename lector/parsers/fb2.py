@@ -17,19 +17,21 @@
 # TODO
 # Maybe also include book description
 
-import os
 import logging
 
-from app.lector.lector.readers.read_fb2 import FB2
+from app.lector.lector.streaming import stream_chapters
+from app.lector.lector.readers.read_fb2 import FB2, FB2Resources
 
 logger = logging.getLogger(__name__)
 
 
 class ParseFB2:
+    # Images are no longer extracted to the temp directory
+    cache_version = 2
+
     def __init__(self, filename, temp_dir, file_md5):
         self.book = None
         self.filename = filename
-        self.extract_path = os.path.join(temp_dir, file_md5)
 
     def read_book(self):
         self.book = FB2(self.filename)
@@ -39,14 +41,14 @@ class ParseFB2:
         return self.book.metadata
 
     def generate_content(self):
-        os.makedirs(self.extract_path, exist_ok=True)  # Manual creation is required here
-        self.book.generate_content(temp_dir=self.extract_path)
+        self.book.generate_references()
+        self.book.generate_toc()
+
+        toc = [(i[0], i[1], count + 1) for count, i in enumerate(self.book.content)]
 
-        toc = []
-        content = []
-        for count, i in enumerate(self.book.content):
-            toc.append((i[0], i[1], count + 1))
-            content.append(i[2])
+        # Chapters are generated in the background, the one being read first
+        return stream_chapters(toc, len(toc), False, self.book.generate_chapter)
 
-        # Return toc, content, images_only
-        return toc, content, False
+    def generate_resources(self):
+        # Images are found where the parser saw them
+        return FB2Resources(self.filename, self.book.binaries)
@@ -14,19 +14,57 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+# Documents are split into chapters at their headings. The book opens
+# once it is split, and sections are rendered in the background, the
+# one being read first. Rendered HTML is kept in the RenderCache by the
+# hash of the section's source, so reopening an edited document only
+# renders the sections that changed.
+
 import os
+import re
+import hashlib
 import logging
 import collections
 
 import markdown
 
+from app.lector.lector.streaming import stream_chapters
+from app.lector.lector.bookcache import RenderCache
+
 logger = logging.getLogger(__name__)
 
+atx_heading = re.compile(r' {0,3}(#{1,6})(?:[ \t]+(.*?))??(?:[ \t]+#+)?[ \t]*$')
+setext_underline = re.compile(r' {0,3}(=+|-+)[ \t]*$')
+code_fence = re.compile(r' {0,3}(`{3,}|~{3,})(.*)$')
+block_start = re.compile(r' {0,3}(?:[-+*>|]|\d+[.)])(?:[ \t]|$)')
+link_definition = re.compile(r' {0,3}\[[^\]]+\]:[ \t]*\S')
+inline_link = re.compile(r'!?\[([^\]]*)\]\([^)]*\)')
+
+Heading = collections.namedtuple('Heading', ['line', 'level', 'title'])
+
+
+def heading_title(text):
+    # Headings go into the ToC as plain text
+    title = inline_link.sub(r'\1', text or '')
+    title = re.sub(r'[*`]+', '', title).strip()
+    return title or '<No title>'
+
 
 class ParseMD:
+    # Headings at the top level and this many levels below it in all
+    # start chapters. Deeper ones stay inside their section.
+    # Each ToC entry has to be a chapter of its own to be navigable.
+    split_depth = 2
+
+    # Documents are no longer a single chapter
+    cache_version = 2
+
     def __init__(self, filename, *args):
         self.book = None
         self.filename = filename
+        self.sections = []  # [level, title, source]
+        self.link_definitions = ''
+        self.render_cache = None
 
     def read_book(self):
         self.book = None
@@ -43,12 +81,111 @@ class ParseMD:
             'Metadata', ['title', 'author', 'year', 'isbn', 'tags', 'cover'])
         return Metadata(title, author, year, isbn, tags, cover)
 
+    def find_headings(self, lines):
+        # Returns a list of Headings. Reference style link
+        # definitions are collected along the way, since every section
+        # has to be able to see them once the document is split up.
+        headings = []
+        link_definitions = []
+        fence = None
+        previous_is_text = False
+
+        for count, line in enumerate(lines):
+            fence_match = code_fence.match(line)
+            if fence:
+                # Fences close with at least as many of the same character
+                if (fence_match and fence_match.group(1).startswith(fence)
+                        and not fence_match.group(2).strip()):
+                    fence = None
+                previous_is_text = False
+                continue
+
+            if fence_match:
+                fence = fence_match.group(1)
+                previous_is_text = False
+                continue
+
+            atx_match = atx_heading.match(line)
+            setext_match = setext_underline.match(line)
+            if atx_match:
+                headings.append(Heading(
+                    count, len(atx_match.group(1)), heading_title(atx_match.group(2))))
+                previous_is_text = False
+            elif setext_match and previous_is_text:
+                headings.append(Heading(
+                    count - 1,
+                    1 if setext_match.group(1).startswith('=') else 2,
+                    heading_title(lines[count - 1].strip())))
+                previous_is_text = False
+            else:
+                if link_definition.match(line):
+                    link_definitions.append(line)
+                # Underlines only make headings out of paragraph text
+                previous_is_text = bool(line.strip()) and not (
+                    line.startswith(('    ', '\t')) or block_start.match(line))
+
+        self.link_definitions = ''.join(link_definitions)
+        return headings
+
+    def split_sections(self, lines):
+        headings = self.find_headings(lines)
+
+        top_level = min((i.level for i in headings), default=1)
+        split_headings = [
+            i for i in headings if i.level < top_level + self.split_depth]
+
+        # Anything before the first heading gets a chapter of its own
+        sections = []
+        first_line = split_headings[0].line if split_headings else len(lines)
+        preamble = ''.join(lines[:first_line])
+        if preamble.strip():
+            sections.append([
+                1, os.path.splitext(os.path.basename(self.filename))[0], preamble])
+
+        previous_level = 0
+        for count, i in enumerate(split_headings):
+            try:
+                end_line = split_headings[count + 1].line
+            except IndexError:
+                end_line = len(lines)
+
+            # Levels can only ever go one deeper at a time
+            this_level = min(i.level - top_level + 1, previous_level + 1)
+            previous_level = this_level
+
+            sections.append([
+                this_level, i.title, ''.join(lines[i.line:end_line])])
+
+        if not sections:
+            sections.append([1, 'Markdown', ''])
+
+        return sections
+
+    def generate_chapter(self, chapter_number):
+        source = self.sections[chapter_number - 1][2]
+        if self.link_definitions:
+            source += '\n\n' + self.link_definitions
+
+        # Rendering changes with the version of the library
+        hashed = hashlib.sha1(getattr(markdown, '__version__', '').encode())
+        hashed.update(source.encode('utf-8', 'surrogatepass'))
+        cache_key = 'markdown-' + hashed.hexdigest()
+
+        html = self.render_cache.load(cache_key)
+        if html is None:
+            html = markdown.markdown(source)
+            self.render_cache.store(cache_key, html)
+        return html
+
     def generate_content(self):
         with open(self.filename, 'r') as book:
-            text = book.read()
-            content = [markdown.markdown(text)]
+            lines = book.readlines()
+
+        self.sections = self.split_sections(lines)
+        toc = [(i[0], i[1], count + 1) for count, i in enumerate(self.sections)]
 
-        toc = [(1, 'Markdown', 1)]
+        # Trimmed down to size by the cache cleanup at startup
+        self.render_cache = RenderCache()
 
-        # Return toc, content, images_only
-        return toc, content, False
+        # Sections are rendered in the background, the one being read first
+        return stream_chapters(toc, len(toc), False, self.generate_chapter)
@@ -14,56 +14,98 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-# TODO
-# See if it's possible to just feed the
-# unzipped mobi7 file into the EPUB parser module
-
 import os
-import sys
-import shutil
-import zipfile
 import logging
+import functools
+import collections
 
 from app.lector.lector.readers.read_epub import EPUB
 import app.lector.lector.KindleUnpack.kindleunpack as KindleUnpack
 
 logger = logging.getLogger(__name__)
 
+# KindleUnpack reports every section it extracts
+logging.getLogger(KindleUnpack.__name__.rpartition('.')[0]).setLevel(logging.WARNING)
+
 
 class ParseMOBI:
     # This module parses Amazon ebooks using KindleUnpack to first create an
-    # epub and then read the usual way
+    # epub in memory and then read the usual way
+
+    # Only these are written out since QTextBrowser loads them from disk
+    image_extensions = ('.jpg', '.jpeg', '.png', '.gif', '.bmp', '.svg')
 
     def __init__(self, filename, temp_dir, file_md5):
         self.book = None
         self.filename = filename
-        self.epub_filepath = None
         self.temp_dir = temp_dir
         self.extract_path = os.path.join(temp_dir, file_md5)
 
     def read_book(self):
-        with HidePrinting():
-            KindleUnpack.unpackBook(self.filename, self.extract_path)
+        # The book is only unpacked once its content is required
+        # Metadata is read straight from the mobi header
+        pass
+
+    def unpack_book(self):
+        # Imported here since the sorter imports every parser
+        from app.lector.lector.sorter import get_worker_pool
+
+        # The mobi7 half of a combination file is never read
+        # Dictionaries are read like any other book, so their
+        # orthography and inflection indexes are left undecoded
+        # Large books are decompressed in the reading pool, which
+        # is only started once there is a large book
+        unpacked_files = KindleUnpack.unpackBook(
+            self.filename, self.extract_path,
+            processes=os.cpu_count() or 1, inmemory=True, k8only=True,
+            dodictionary=False,
+            getpool=functools.partial(get_worker_pool, 'reading'))
+
+        # The KF8 part is a complete epub. Older books only
+        # have the mobi7 html, opf and ncx to go on
+        book_dir = unpacked_files.k8dir or unpacked_files.mobi7dir
+        container = unpacked_files.getContainer(book_dir)
+
+        for name, data in container.items():
+            if os.path.splitext(name)[1].lower() in self.image_extensions:
+                image_path = os.path.join(self.extract_path, name)
+                os.makedirs(os.path.dirname(image_path), exist_ok=True)
+                with open(image_path, 'wb') as image_file:
+                    image_file.write(data)
+
+        self.book = EPUB(self.filename, self.temp_dir, container)
 
-        epub_filename = os.path.splitext(
-            os.path.basename(self.filename))[0] + '.epub'
-        self.epub_filepath = os.path.join(
-            self.extract_path, 'mobi8', epub_filename)
+    def generate_metadata(self):
+        book_metadata, cover = KindleUnpack.unpackMetadata(self.filename)
 
-        if not os.path.exists(self.epub_filepath):
-            zip_dir = os.path.join(self.extract_path, 'mobi7')
-            zip_file = os.path.join(
-                self.extract_path, epub_filename)
-            self.epub_filepath = shutil.make_archive(zip_file, 'zip', zip_dir)
+        def first_value(key):
+            try:
+                return book_metadata[key][0].strip()
+            except (KeyError, IndexError, AttributeError):
+                return None
 
-        self.book = EPUB(self.epub_filepath, self.temp_dir)
+        title = first_value('Updated_Title') or first_value('Title')
+        if not title:
+            title = os.path.splitext(os.path.basename(self.filename))[0]
 
-    def generate_metadata(self):
-        self.book.generate_metadata()
-        return self.book.metadata
+        author = first_value('Creator')
+        if not author:
+            author = 'Unknown'
+
+        try:
+            year = int(first_value('Published')[:4])
+        except (TypeError, ValueError):
+            year = 9999
+
+        isbn = first_value('ISBN')
+        tags = book_metadata.get('Subject', [])
+
+        Metadata = collections.namedtuple(
+            'Metadata', ['title', 'author', 'year', 'isbn', 'tags', 'cover'])
+        return Metadata(title, author, year, isbn, tags, cover)
 
     def generate_content(self):
-        zipfile.ZipFile(self.epub_filepath).extractall(self.extract_path)
+        self.unpack_book()
 
         self.book.generate_toc()
         self.book.generate_content()
@@ -77,11 +119,3 @@ class ParseMOBI:
         # Return toc, content, images_only
         return toc, content, False
 
-
-class HidePrinting:
-    def __enter__(self):
-        self._original_stdout = sys.stdout
-        sys.stdout = None
-
-    def __exit__(self, exc_type, exc_val, exc_tb):
-        sys.stdout = self._original_stdout
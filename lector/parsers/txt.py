@@ -14,18 +14,58 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import collections
 import os
+import re
+import codecs
+import logging
+import collections
 
 import textile
 
+from app.lector.lector.streaming import stream_chapters
+
+logger = logging.getLogger(__name__)
+
 
 class ParseTXT:
-    """Parser for TXT files."""
+    """Parser for TXT files.
+
+    The file is read a line at a time and split into chapters at
+    lines that look like chapter headings. Chapters that grow past
+    max_chapter_length are split further so that no single document
+    gets too big to lay out. The book opens as soon as it is split.
+    Chapters go through textile in the background afterwards, with
+    the one being read converted first.
+    """
+
+    # Lines matching any of these (ignoring case) start a new chapter
+    # That's a keyword, maybe a number, and maybe a separated title
+    chapter_patterns = [
+        r'(?:chapter|part|book|volume|prologue|epilogue|interlude|afterword)'
+        r'(?:\s+\w+)?(?:\s*[.:\-–—]\s*.*)?',
+        r'(?:глава|часть|том|пролог|эпилог|послесловие)'
+        r'(?:\s+\w+)?(?:\s*[.:\-–—]\s*.*)?',
+        r'第[0-9０-９零〇一二三四五六七八九十百千]+[章回节節卷部].*']
+    # Encodings tried for files that aren't Unicode. Each has the
+    # ranges of characters its text is expected to be made of, and
+    # whether those make up most of the text. See score_encoding.
+    legacy_encodings = (
+        ('gb18030', ((0x3000, 0x303f), (0x4e00, 0x9fff), (0xff00, 0xffef)), True),
+        ('cp1251', ((0x0400, 0x04ff), (0x2010, 0x2026), (0x00ab, 0x00bb)), True),
+        ('cp1252', ((0x00a0, 0x00ff), (0x2010, 0x2026)), False))
+
+    max_heading_length = 80
+    max_chapter_length = 100000  # Characters
+    sniff_length = 64 * 1024  # Bytes
+
+    # Chapters are no longer one big block of text
+    cache_version = 2
 
     def __init__(self, filename, *args):
         """Initialize new instance of the TXT parser."""
         self.filename = filename
+        self.encoding = None
+        self.chapters = []
 
     def read_book(self):
         """Prepare the parser to read book."""
@@ -44,12 +84,129 @@ class ParseTXT:
             'Metadata', ['title', 'author', 'year', 'isbn', 'tags', 'cover'])
         return Metadata(title, author, year, isbn, tags, cover)
 
+    def sniff_encoding(self):
+        """Guess the encoding of the file from its first few bytes."""
+        with open(self.filename, 'rb') as txt:
+            prefix = txt.read(self.sniff_length)
+
+        # UTF-32 goes first since its little endian BOM
+        # starts with that of UTF-16
+        byte_order_marks = (
+            (codecs.BOM_UTF8, 'utf-8-sig'),
+            (codecs.BOM_UTF32_LE, 'utf-32'),
+            (codecs.BOM_UTF32_BE, 'utf-32'),
+            (codecs.BOM_UTF16_LE, 'utf-16'),
+            (codecs.BOM_UTF16_BE, 'utf-16'))
+        for bom, encoding in byte_order_marks:
+            if prefix.startswith(bom):
+                return encoding
+
+        # The prefix may end in the middle of a character
+        try:
+            codecs.getincrementaldecoder('utf-8')().decode(prefix, final=False)
+            return 'utf-8'
+        except UnicodeDecodeError:
+            pass
+
+        # Legacy encodings are scored by how well the prefix reads in each
+        best_encoding = None
+        best_score = -1
+        for encoding, character_ranges, is_dense in self.legacy_encodings:
+            try:
+                text = codecs.getincrementaldecoder(encoding)().decode(prefix, final=False)
+            except UnicodeDecodeError:
+                continue
+
+            this_score = self.score_encoding(text, character_ranges, is_dense)
+            if this_score > best_score:
+                best_encoding = encoding
+                best_score = this_score
+
+        return best_encoding or 'cp1252'
+
+    @staticmethod
+    def score_encoding(text, character_ranges, is_dense):
+        """Score text decoded with an encoding. Higher is likelier.
+
+        Non ASCII characters should fall inside character_ranges.
+        Scripts that are dense make up most of the letters of a text
+        (Cyrillic, CJK). The others are accents sprinkled over
+        mostly ASCII words (Western European).
+        """
+        non_ascii = [i for i in text if ord(i) > 127]
+        if not non_ascii:
+            return 0
+
+        in_range = sum(
+            1 for i in non_ascii
+            if any(start <= ord(i) <= end for start, end in character_ranges))
+
+        letters = [i for i in text if i.isalpha()]
+        non_ascii_share = 0
+        if letters:
+            non_ascii_share = sum(1 for i in letters if ord(i) > 127) / len(letters)
+        if not is_dense:
+            non_ascii_share = 1 - non_ascii_share
+
+        return in_range / len(non_ascii) * non_ascii_share
+
+    def split_chapters(self, lines):
+        """Return a list of (title, text) for the lines of the book."""
+        heading = re.compile(
+            '|'.join(f'(?:{i})' for i in self.chapter_patterns), re.IGNORECASE)
+
+        chapters = []
+        title = 'Text'
+        part_number = 1
+        chapter_lines = []
+        chapter_length = 0
+
+        def finish_chapter():
+            chapter_text = ''.join(chapter_lines)
+            if chapter_text.strip():
+                this_title = title
+                if part_number > 1:
+                    this_title = f'{title} ({part_number})'
+                chapters.append((this_title, chapter_text))
+
+        for line in lines:
+            stripped_line = line.strip()
+            if (stripped_line and len(stripped_line) <= self.max_heading_length
+                    and heading.fullmatch(stripped_line)):
+                finish_chapter()
+                title = stripped_line
+                part_number = 1
+                chapter_lines = []
+                chapter_length = 0
+
+            # Long chapters are broken at a paragraph if possible
+            elif chapter_length > self.max_chapter_length and (
+                    not stripped_line or chapter_length > 2 * self.max_chapter_length):
+                finish_chapter()
+                part_number += 1
+                chapter_lines = []
+                chapter_length = 0
+
+            chapter_lines.append(line)
+            chapter_length += len(line)
+
+        finish_chapter()
+        return chapters
+
+    def generate_chapter(self, chapter_number):
+        """Convert a chapter to HTML."""
+        return textile.textile(self.chapters[chapter_number - 1][1])
+
     def generate_content(self):
         """Generate content of the book."""
-        with open(self.filename, 'rt') as txt:
-            text = txt.read()
-            content = [textile.textile(text)]
+        self.encoding = self.sniff_encoding()
+        with open(self.filename, 'rt', encoding=self.encoding, errors='replace') as txt:
+            self.chapters = self.split_chapters(txt)
+
+        if not self.chapters:
+            self.chapters = [('Text', '')]
 
-        toc = [(1, 'Text', 1)]
+        toc = [(1, i[0], count + 1) for count, i in enumerate(self.chapters)]
 
-        return toc, content, False
+        # Chapters are converted in the background, the one being read first
+        return stream_chapters(toc, len(toc), False, self.generate_chapter)
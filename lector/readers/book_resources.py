@@ -0,0 +1,65 @@
+# This file is a part of Lector, a Qt based ebook reader
+# Copyright (C) 2017-2019 BasioMeusPuga
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import abc
+import logging
+import collections
+
+from PyQt5 import QtGui
+
+logger = logging.getLogger(__name__)
+
+
+class BookResources(abc.ABC):
+    # Serves the images of a book to the text browser straight from
+    # the book file. Nothing is written to disk and decoded images
+    # are held in a size bounded LRU cache
+
+    def __init__(self, book_filename, cache_limit_mb=64):
+        self.book_filename = book_filename
+        self.cache_limit = cache_limit_mb * 1024 * 1024
+        self.cache_size = 0
+        self.image_cache = collections.OrderedDict()
+
+    @abc.abstractmethod
+    def read_image(self, name):
+        # Returns the bytes of the image called name, or None
+        pass
+
+    def get_image(self, name):
+        try:
+            image = self.image_cache[name]
+            self.image_cache.move_to_end(name)
+            return image
+        except KeyError:
+            pass
+
+        image_data = self.read_image(name)
+        if not image_data:
+            return None
+
+        image = QtGui.QImage()
+        if not image.loadFromData(image_data):
+            logger.warning(f'Unable to decode {name} in {self.book_filename}')
+            return None
+
+        self.image_cache[name] = image
+        self.cache_size += image.byteCount()
+        while self.cache_size > self.cache_limit and len(self.image_cache) > 1:
+            _, evicted_image = self.image_cache.popitem(last=False)
+            self.cache_size -= evicted_image.byteCount()
+
+        return image
@@ -0,0 +1,359 @@
+# This file is a part of Lector, a Qt based ebook reader
+# Copyright (C) 2017-2019 BasioMeusPuga
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# The package of an EPUB is made up of the container.xml, the .opf
+# it points to, and a navigation document that is either an NCX or
+# (in EPUB3) an XHTML nav. Each of these is parsed once with lxml.
+# Elements are matched by their local name only, since books
+# are none too careful about namespaces.
+# Every href is resolved to the name of a file in the archive,
+# so that the manifest, spine, and ToC can be compared directly.
+
+import os
+import logging
+import posixpath
+import collections
+from urllib.parse import unquote
+
+from lxml import etree
+
+logger = logging.getLogger(__name__)
+
+ManifestItem = collections.namedtuple(
+    'ManifestItem', ['id', 'href', 'path', 'media_type', 'properties'])
+
+NCX_MEDIA_TYPE = 'application/x-dtbncx+xml'
+EPUB_TYPE = '{http://www.idpf.org/2007/ops}type'
+
+
+def parse_xml(xml_data):
+    # Broken markup is recovered from instead of refused
+    xml_parser = etree.XMLParser(
+        recover=True, resolve_entities=False, no_network=True)
+    root = etree.fromstring(xml_data, parser=xml_parser)
+    if root is None:
+        raise ValueError('Unparseable XML')
+    return root
+
+
+def local_name(element):
+    # Comments and processing instructions have no name
+    if not isinstance(element.tag, str):
+        return None
+    return etree.QName(element).localname
+
+
+def children(element, name):
+    return [i for i in element if local_name(i) == name]
+
+
+def first_child(element, name):
+    for i in element:
+        if local_name(i) == name:
+            return i
+    return None
+
+
+def descendants(element, name):
+    return [i for i in element.iter() if local_name(i) == name]
+
+
+def element_text(element):
+    if element is None:
+        return None
+    text = ' '.join(''.join(element.itertext()).split())
+    return text or None
+
+
+class FileIndex:
+    # Looks up files in the archive by name
+    # Books refer to their files every which way, so names that
+    # don't match exactly fall back to matching on the basename
+
+    def __init__(self, file_list, book_filename):
+        self.book_filename = book_filename
+        self.file_set = set(file_list)
+        self.file_basenames = {}
+        for i in file_list:
+            self.file_basenames.setdefault(os.path.basename(i), i)
+
+    def find_file(self, filename):
+        if filename in self.file_set:
+            return filename
+
+        # Get rid of special characters
+        filename = unquote(filename)
+        if filename in self.file_set:
+            return filename
+
+        try:
+            return self.file_basenames[os.path.basename(filename)]
+        except KeyError:
+            logger.warning(filename + ' not found in ' + self.book_filename)
+            return False
+
+
+class EPUBPackage:
+    def __init__(self, zip_file, book_filename):
+        self.zip_file = zip_file
+        self.book_filename = book_filename
+        self.files = FileIndex(zip_file.namelist(), book_filename)
+
+        self.package_path = None
+        self.package_dir = None
+        self.metadata = collections.defaultdict(list)
+        self.cover_id = None
+
+        self.manifest = {}  # id: ManifestItem
+        self.manifest_by_path = {}  # path: ManifestItem
+        self.spine = []  # ManifestItems in reading order
+        self.toc_id = None
+
+        self.generate_package()
+
+    def resolve(self, href, base_dir):
+        # Returns the archive path of href as seen from base_dir
+        # with its fragment, if any, left in place
+        path, _, anchor = href.partition('#')
+        path = unquote(path)
+        if path:
+            path = posixpath.normpath(posixpath.join(base_dir, path))
+        if anchor:
+            return path + '#' + anchor
+        return path
+
+    def find_package_file(self):
+        # Book structure relies on parsing the .opf file
+        # in the book. Now that might be the usual content.opf
+        # or package.opf or it might be named after your favorite
+        # eldritch abomination. The point is we have to check
+        # the container.xml
+        container = 'META-INF/container.xml'
+        if container not in self.files.file_set:
+            container = self.files.find_file('container.xml')
+
+        if container:
+            try:
+                rootfiles = descendants(
+                    parse_xml(self.zip_file.read(container)), 'rootfile')
+            except ValueError:
+                rootfiles = []
+
+            for i in rootfiles:
+                if i.get('media-type') in (None, 'application/oebps-package+xml'):
+                    packagefile = self.files.find_file(i.get('full-path', ''))
+                    if packagefile:
+                        return packagefile
+
+        presumptive_names = ('content.opf', 'package.opf', 'volume.opf')
+        for i in presumptive_names:
+            if i in self.files.file_basenames:
+                logger.info('Using presumptive package file: ' + self.book_filename)
+                return self.files.file_basenames[i]
+
+        for i in self.files.file_basenames.values():
+            if i.lower().endswith('.opf'):
+                logger.info('Using presumptive package file: ' + self.book_filename)
+                return i
+
+        raise FileNotFoundError('No package file in ' + self.book_filename)
+
+    def generate_package(self):
+        self.package_path = self.find_package_file()
+        self.package_dir = posixpath.dirname(self.package_path)
+        package_root = parse_xml(self.zip_file.read(self.package_path))
+
+        # Dublin Core elements are kept as lists of elements by name
+        metadata_element = first_child(package_root, 'metadata')
+        if metadata_element is not None:
+            for i in metadata_element.iter():
+                this_name = local_name(i)
+                if this_name == 'meta':
+                    if i.get('name') == 'cover':
+                        self.cover_id = i.get('content')
+                elif this_name and i is not metadata_element:
+                    self.metadata[this_name].append(i)
+
+        manifest_element = first_child(package_root, 'manifest')
+        if manifest_element is not None:
+            for i in children(manifest_element, 'item'):
+                item_id = i.get('id')
+                href = i.get('href')
+                if item_id is None or href is None:
+                    continue
+
+                item = ManifestItem(
+                    item_id, href,
+                    self.resolve(href, self.package_dir),
+                    i.get('media-type', ''),
+                    i.get('properties', '').split())
+                self.manifest[item_id] = item
+                self.manifest_by_path.setdefault(item.path, item)
+
+        spine_element = first_child(package_root, 'spine')
+        if spine_element is not None:
+            self.toc_id = spine_element.get('toc')
+            for i in children(spine_element, 'itemref'):
+                try:
+                    self.spine.append(self.manifest[i.get('idref')])
+                except KeyError:
+                    pass
+
+    def first_metadata(self, name):
+        for i in self.metadata[name]:
+            text = element_text(i)
+            if text:
+                return text
+        return None
+
+    def all_metadata(self, name):
+        return [i for i in (element_text(j) for j in self.metadata[name]) if i]
+
+    def find_isbn(self):
+        for i in self.metadata['identifier']:
+            text = element_text(i)
+            if not text:
+                continue
+
+            scheme = None
+            for attribute, value in i.attrib.items():
+                if etree.QName(attribute).localname == 'scheme':
+                    scheme = value.lower()
+            if scheme == 'isbn':
+                return text
+            if text.lower().startswith('urn:isbn:'):
+                return text[9:]
+
+        return None
+
+    def find_cover(self):
+        # The cover as declared by the book, or by convention
+        # Returns its path or None
+        for i in self.manifest.values():
+            if 'cover-image' in i.properties:
+                return i.path
+
+        if self.cover_id in self.manifest:
+            return self.manifest[self.cover_id].path
+
+        for i in self.manifest.values():
+            if i.media_type.split('/')[0] == 'image' and 'cover' in i.id:
+                return i.path
+
+        return None
+
+    def find_ncx(self):
+        if self.toc_id in self.manifest:
+            return self.manifest[self.toc_id].path
+
+        for i in self.manifest.values():
+            if i.media_type == NCX_MEDIA_TYPE:
+                return i.path
+
+        if 'toc.ncx' in self.files.file_basenames:
+            logger.info('Using alternate ToC for: ' + self.book_filename)
+            return self.files.file_basenames['toc.ncx']
+
+        return None
+
+    def find_nav(self):
+        for i in self.manifest.values():
+            if 'nav' in i.properties:
+                return i.path
+        return None
+
+    def generate_toc(self):
+        # Returns a flat list of [level, title, path#anchor]
+        # Titles that are missing are None
+        ncx_path = self.find_ncx()
+        if ncx_path:
+            ncx_file = self.files.find_file(ncx_path)
+            if ncx_file:
+                return self.parse_ncx(ncx_file)
+
+        nav_path = self.find_nav()
+        if nav_path:
+            nav_file = self.files.find_file(nav_path)
+            if nav_file:
+                return self.parse_nav(nav_file)
+
+        logger.warning('No ToC found for: ' + self.book_filename)
+        return []
+
+    def parse_ncx(self, ncx_file):
+        ncx_dir = posixpath.dirname(ncx_file)
+        toc = []
+
+        def recursor(level, element):
+            for nav_point in children(element, 'navPoint'):
+                nav_label = first_child(nav_point, 'navLabel')
+                if nav_label is not None:
+                    nav_label = first_child(nav_label, 'text')
+                content = first_child(nav_point, 'content')
+
+                if content is not None and content.get('src'):
+                    toc.append([
+                        level,
+                        element_text(nav_label),
+                        self.resolve(content.get('src'), ncx_dir)])
+                    recursor(level + 1, nav_point)
+                else:
+                    recursor(level, nav_point)
+
+        nav_map = descendants(parse_xml(self.zip_file.read(ncx_file)), 'navMap')
+        if nav_map:
+            recursor(1, nav_map[0])
+        return toc
+
+    def parse_nav(self, nav_file):
+        nav_dir = posixpath.dirname(nav_file)
+        toc = []
+
+        def recursor(level, ordered_list):
+            for list_item in children(ordered_list, 'li'):
+                heading = first_child(list_item, 'a')
+                if heading is None:
+                    heading = first_child(list_item, 'span')
+                nested_list = first_child(list_item, 'ol')
+
+                # Headings that aren't links don't get an entry
+                # Their children are moved up a level in their stead
+                next_level = level
+                if heading is not None and heading.get('href'):
+                    toc.append([
+                        level,
+                        element_text(heading),
+                        self.resolve(heading.get('href'), nav_dir)])
+                    next_level = level + 1
+
+                if nested_list is not None:
+                    recursor(next_level, nested_list)
+
+        nav_elements = descendants(
+            parse_xml(self.zip_file.read(nav_file)), 'nav')
+        if not nav_elements:
+            return toc
+
+        toc_nav = nav_elements[0]
+        for i in nav_elements:
+            if 'toc' in i.get(EPUB_TYPE, '').split():
+                toc_nav = i
+                break
+
+        ordered_list = first_child(toc_nav, 'ol')
+        if ordered_list is not None:
+            recursor(1, ordered_list)
+        return toc
@@ -22,23 +22,87 @@ import os
 import zipfile
 import logging
 import collections
-from urllib.parse import unquote
+from multiprocessing.pool import ThreadPool
 
-import xmltodict
-from PyQt5 import QtGui
-from bs4 import BeautifulSoup
+import lxml.html
+from lxml import etree
+
+from app.lector.lector.readers.book_resources import BookResources
+from app.lector.lector.readers.epub_package import EPUBPackage, FileIndex
 
 logger = logging.getLogger(__name__)
 
+VirtualFile = collections.namedtuple('VirtualFile', ['filename', 'file_size'])
+
+
+class VirtualContainer:
+    # Stands in for the ZipFile of a book whose files are
+    # already in memory, as a {name: bytes} dictionary
+
+    def __init__(self, files):
+        self.files = files
+        self.filelist = [
+            VirtualFile(name, len(data)) for name, data in files.items()]
+
+    def namelist(self):
+        return list(self.files)
+
+    def read(self, name):
+        return self.files[name]
+
+
+def split_tree(split_element):
+    # Moves split_element and everything that follows it in document
+    # order into a new tree. Ancestors are copied without their children
+    # and remain in the original tree with whatever preceded the split
+    # Nothing that was already moved is ever looked at again
+    moved_nodes = [split_element]
+    moved_nodes.extend(split_element.itersiblings())
+
+    this_element = split_element
+    while True:
+        parent = this_element.getparent()
+        parent_copy = parent.makeelement(parent.tag, parent.attrib)
+        for i in moved_nodes:
+            parent_copy.append(i)  # Tails are moved along with their element
+
+        grandparent = parent.getparent()
+        if grandparent is None:
+            return parent_copy
+
+        # Text after the end of the parent belongs to the new tree
+        parent_copy.tail = parent.tail
+        parent.tail = None
+
+        moved_nodes = [parent_copy]
+        moved_nodes.extend(parent.itersiblings())
+        this_element = parent
+
+
+class EPUBResources(BookResources):
+    # Images are read from the archive as they are displayed
+
+    def __init__(self, book_filename, cache_limit_mb=64):
+        super(EPUBResources, self).__init__(book_filename, cache_limit_mb)
+        self.zip_file = zipfile.ZipFile(
+            book_filename, mode='r', allowZip64=True)
+        self.files = FileIndex(self.zip_file.namelist(), book_filename)
+
+    def read_image(self, name):
+        this_file = self.files.find_file(name)
+        if not this_file:
+            return None
+        return self.zip_file.read(this_file)
+
 
 class EPUB:
-    def __init__(self, book_filename, temp_dir):
+    def __init__(self, book_filename, temp_dir, container=None):
         self.book_filename = book_filename
         self.temp_dir = temp_dir
+        self.container = container
 
         self.zip_file = None
-        self.file_list = None
-        self.opf_dict = None
+        self.package = None
         self.cover_image_name = None
         self.split_chapters = {}
 
@@ -48,289 +112,198 @@ class EPUB:
         self.generate_references()
 
     def generate_references(self):
-        self.zip_file = zipfile.ZipFile(
-            self.book_filename, mode='r', allowZip64=True)
-        self.file_list = self.zip_file.namelist()
-
-        # Book structure relies on parsing the .opf file
-        # in the book. Now that might be the usual content.opf
-        # or package.opf or it might be named after your favorite
-        # eldritch abomination. The point is we have to check
-        # the container.xml
-        container = self.find_file('container.xml')
-        if container:
-            container_xml = self.zip_file.read(container)
-            container_dict = xmltodict.parse(container_xml)
-            packagefile = container_dict['container']['rootfiles']['rootfile']['@full-path']
+        if self.container is not None:
+            self.zip_file = VirtualContainer(self.container)
         else:
-            presumptive_names = ('content.opf', 'package.opf', 'volume.opf')
-            for i in presumptive_names:
-                packagefile = self.find_file(i)
-                if packagefile:
-                    logger.info('Using presumptive package file: ' + self.book_filename)
-                    break
+            self.zip_file = zipfile.ZipFile(
+                self.book_filename, mode='r', allowZip64=True)
 
-        packagefile_data = self.zip_file.read(packagefile)
-        self.opf_dict = xmltodict.parse(packagefile_data)
+        # Book structure relies on parsing the .opf file
+        self.package = EPUBPackage(self.zip_file, self.book_filename)
 
     def find_file(self, filename):
-        # Get rid of special characters
-        filename = unquote(filename)
-
-        # First, look for the file in the root of the book
-        if filename in self.file_list:
-            return filename
-
-        # Then search for it elsewhere
-        else:
-            file_basename = os.path.basename(filename)
-            for i in self.file_list:
-                if os.path.basename(i) == file_basename:
-                    return i
-
-        # If the file isn't found
-        logger.warning(filename + ' not found in ' + self.book_filename)
-        return False
+        return self.package.files.find_file(filename)
 
     def generate_toc(self):
-        def find_alternative_toc():
-            toc_filename = None
-            toc_filename_alternative = None
-            manifest = self.opf_dict['package']['manifest']['item']
-
-            for i in manifest:
-                # Behold the burning hoops we're jumping through
-                if i['@id'] == 'ncx':
-                    toc_filename = i['@href']
-                if ('ncx' in i['@id']) or ('toc' in i['@id']):
-                    toc_filename_alternative = i['@href']
-                if toc_filename and toc_filename_alternative:
-                    break
-
-            if not toc_filename:
-                if not toc_filename_alternative:
-                    logger.warning('No ToC found for: ' + self.book_filename)
-                else:
-                    toc_filename = toc_filename_alternative
-
-            logger.info('Using alternate ToC for: ' + self.book_filename)
-            return toc_filename
-
-        # Find the toc.ncx file from the manifest
-        # EPUBs will name literally anything, anything so try
-        # a less stringent approach if the first one doesn't work
-        # The idea is to prioritize 'toc.ncx' since this should work
-        # for the vast majority of books
-        toc_filename = 'toc.ncx'
-        does_toc_exist = self.find_file(toc_filename)
-        if not does_toc_exist:
-            toc_filename = find_alternative_toc()
-
-        tocfile = self.find_file(toc_filename)
-        tocfile_data = self.zip_file.read(tocfile)
-        toc_dict = xmltodict.parse(tocfile_data)
-
-        def recursor(level, nav_node):
-            if isinstance(nav_node, list):
-                these_contents = [[
-                    level + 1,
-                    i['navLabel']['text'],
-                    i['content']['@src']] for i in nav_node]
-                self.content.extend(these_contents)
-                return
-
-            if 'navPoint' in nav_node.keys():
-                recursor(level, nav_node['navPoint'])
-
-            else:
-                self.content.append([
-                    level + 1,
-                    nav_node['navLabel']['text'],
-                    nav_node['content']['@src']])
-
-        navpoints = toc_dict['ncx']['navMap']['navPoint']
-        for top_level_nav in navpoints:
-            # Just one chapter
-            if isinstance(top_level_nav, str):
-                self.content.append([
-                    1,
-                    navpoints['navLabel']['text'],
-                    navpoints['content']['@src']])
-                break
-
-            # Multiple chapters
-            self.content.append([
-                1,
-                top_level_nav['navLabel']['text'],
-                top_level_nav['content']['@src']])
-
-            if 'navPoint' in top_level_nav.keys():
-                recursor(1, top_level_nav)
+        # Chapter files are archive paths with an optional #anchor
+        self.content = self.package.generate_toc()
 
     def get_chapter_content(self, chapter_file):
+        # Returns the markup of a chapter along with its lxml tree
+        # Blank chapters come back as None
+        # These will be removed from the contents later
         this_file = self.find_file(chapter_file)
-        if this_file:
-            chapter_content = self.zip_file.read(this_file).decode()
-
-            # Generate a None return for a blank chapter
-            # These will be removed from the contents later
-            contentDocument = QtGui.QTextDocument(None)
-            contentDocument.setHtml(chapter_content)
-            contentText = contentDocument.toPlainText().replace('\n', '')
-            if contentText == '':
-                chapter_content = None
-
-            return chapter_content
-        else:
-            return 'Possible parse error: ' + chapter_file
-
-    def parse_split_chapters(self, chapters_with_split_content):
-        # For split chapters, get the whole chapter first, then split
-        # between ids using their anchors, then "heal" the resultant text
-        # by creating a BeautifulSoup object. Write its str to the content
-        for i in chapters_with_split_content.items():
-            chapter_file = i[0]
-            self.split_chapters[chapter_file] = {}
-
-            chapter_content = self.get_chapter_content(chapter_file)
-            soup = BeautifulSoup(chapter_content, 'lxml')
+        if not this_file:
+            return 'Possible parse error: ' + chapter_file, None
 
-            split_anchors = i[1]
-            for this_anchor in reversed(split_anchors):
-                this_tag = soup.find(
-                    attrs={"id":lambda x: x == this_anchor})
+        chapter_data = self.zip_file.read(this_file)
+        if not chapter_data.strip():
+            return None, None
 
-                markup_split = str(soup).split(str(this_tag))
-                soup = BeautifulSoup(markup_split[0], 'lxml')
-
-                # If the tag is None, it probably means the content is overlapping
-                # Skipping the insert is the way forward
-                if this_tag:
-                    this_markup = BeautifulSoup(
-                        str(this_tag).strip() + markup_split[1], 'lxml')
-                    self.split_chapters[chapter_file][this_anchor] = str(this_markup)
+        # Markup that isn't UTF-8 is decoded by lxml
+        # on the basis of whatever the chapter declares
+        try:
+            chapter_content = chapter_data.decode('utf-8')
+            html_parser = lxml.html.HTMLParser(encoding='utf-8')
+        except UnicodeDecodeError:
+            chapter_content = None
+            html_parser = lxml.html.HTMLParser()
 
-            # Remaining markup is assigned here
-            self.split_chapters[chapter_file]['top_level'] = str(soup)
+        try:
+            root = lxml.html.document_fromstring(chapter_data, parser=html_parser)
+        except etree.ParserError:
+            return chapter_content, None
+
+        if chapter_content is None:
+            chapter_content = lxml.html.tostring(root, encoding='unicode')
+
+        # Blank as far as the text browser is concerned
+        # That is, no text and no images. Non breaking spaces count as text
+        body = root.find('body')
+        if body is None:
+            body = root
+        if (not body.text_content().strip(' \t\n\r\f')
+                and next(body.iter('img'), None) is None):
+            return None, None
+
+        return chapter_content, root
+
+    def split_chapter(self, chapter_file, split_anchors):
+        # For split chapters, parse the whole chapter once, then cut the
+        # tree at each anchor, going backwards through the document. Every
+        # cut takes the anchor and whatever follows it into a new tree
+        # that repeats the anchor's ancestors, so that each piece is
+        # well formed on its own. Whatever precedes the first anchor
+        # is the top level content
+        chapter_content, root = self.get_chapter_content(chapter_file)
+        if root is None:
+            # Nothing to split. Blank pieces are removed later
+            split_content = {i: chapter_content for i in split_anchors}
+            split_content['top_level'] = chapter_content
+            return split_content
+
+        # The first element with an id wins, and the
+        # position of every element is noted in the same pass
+        elements_by_id = {}
+        document_order = {}
+        for count, this_element in enumerate(root.iter()):
+            document_order[this_element] = count
+            element_id = this_element.get('id')
+            if element_id is not None and element_id not in elements_by_id:
+                elements_by_id[element_id] = this_element
+
+        # If an anchor isn't found, it probably means the content is overlapping
+        # Skipping the insert is the way forward
+        anchor_elements = []
+        for this_anchor in set(split_anchors):
+            try:
+                this_element = elements_by_id[this_anchor]
+            except KeyError:
+                continue
+            if this_element.getparent() is not None:
+                anchor_elements.append((this_anchor, this_element))
+        anchor_elements.sort(key=lambda x: document_order[x[1]], reverse=True)
+
+        split_content = {}
+        for this_anchor, this_element in anchor_elements:
+            split_content[this_anchor] = lxml.html.tostring(
+                split_tree(this_element), encoding='unicode')
+
+        # Remaining markup is assigned here
+        split_content['top_level'] = lxml.html.tostring(root, encoding='unicode')
+        return split_content
+
+    def process_chapter(self, chapter_task):
+        # Runs in the thread pool
+        # lxml lets go of the GIL while it parses
+        chapter_file, split_anchors = chapter_task
+        if split_anchors:
+            return self.split_chapter(chapter_file, split_anchors)
+        return {'top_level': self.get_chapter_content(chapter_file)[0]}
 
     def generate_content(self):
         # Find all the chapters mentioned in the opf spine
-        # These are simply ids that correspond to the actual item
-        # as mentioned in the manifest - which is a comprehensive
-        # list of files
-        try:
-            # Multiple chapters
-            chapters_in_spine = [
-                i['@idref']
-                for i in self.opf_dict['package']['spine']['itemref']]
-        except TypeError:
-            # Single chapter - Large xml
-            chapters_in_spine = [
-                self.opf_dict['package']['spine']['itemref']['@idref']]
-
-        # Next, find items and ids from the manifest
-        # This might error out in case there's only one item in
-        # the manifest. Remember that for later.
-        chapters_from_manifest = {
-            i['@id']: i['@href']
-            for i in self.opf_dict['package']['manifest']['item']}
-
-        # Finally, check which items are supposed to be in the spine
-        # on the basis of the id and change the toc accordingly
+        # A file is only read once, however often it appears there
         spine_final = []
-        for i in chapters_in_spine:
-            try:
-                spine_final.append(chapters_from_manifest.pop(i))
-            except KeyError:
-                pass
+        for i in self.package.spine:
+            if i.path not in spine_final:
+                spine_final.append(i.path)
 
-        toc_chapters = [
-            unquote(i[2].split('#')[0]) for i in self.content]
+        # Check which items are supposed to be in the spine
+        # and change the toc accordingly
+        toc_chapters = [i[2].split('#')[0] for i in self.content]
 
-        for i in spine_final:
+        for spine_index, i in enumerate(spine_final):
             if not i in toc_chapters:
-                spine_index = spine_final.index(i)
                 if spine_index == 0:  # Or chapter insertion circles back to the end
                     previous_chapter_toc_index = -1
                 else:
-                    previous_chapter = spine_final[spine_final.index(i) - 1]
-                    previous_chapter_toc_index = toc_chapters.index(previous_chapter)
+                    # After the last of the previous chapter's split parts
+                    previous_chapter = spine_final[spine_index - 1]
+                    previous_chapter_toc_index = (
+                        len(toc_chapters) - 1 - toc_chapters[::-1].index(previous_chapter))
 
                 toc_chapters.insert(
                     previous_chapter_toc_index + 1, i)
                 self.content.insert(
                     previous_chapter_toc_index + 1, [1, None, i])
 
-        # Parse split chapters as below
-        # They can be picked up during the iteration through the toc
-        chapters_with_split_content = {}
+        # Every file is read once, and split chapters are split
+        # in the same go. They can be picked up during the iteration
+        # through the toc
+        chapter_tasks = {}
         for i in self.content:
-            if '#' in i[2]:
-                this_split = i[2].split('#')
-                chapter = this_split[0]
-                anchor = this_split[1]
-
-                try:
-                    chapters_with_split_content[chapter].append(anchor)
-                except KeyError:
-                    chapters_with_split_content[chapter] = []
-                    chapters_with_split_content[chapter].append(anchor)
+            chapter, _, anchor = i[2].partition('#')
+            split_anchors = chapter_tasks.setdefault(chapter, [])
+            if anchor:
+                split_anchors.append(anchor)
+
+        if len(chapter_tasks) > 1:
+            with ThreadPool(min(len(chapter_tasks), os.cpu_count() or 1)) as _pool:
+                processed_chapters = _pool.map(self.process_chapter, chapter_tasks.items())
+        else:
+            processed_chapters = [self.process_chapter(i) for i in chapter_tasks.items()]
 
-        self.parse_split_chapters(chapters_with_split_content)
+        # Results come back in spine order
+        all_chapters = dict(zip(chapter_tasks, processed_chapters))
+        self.split_chapters = {
+            i: all_chapters[i] for i, j in chapter_tasks.items() if j}
 
         # Now we iterate over the ToC as presented in the toc.ncx
         # and add chapters to the content list
         # In case a split chapter is encountered, get its content
         # from the split_chapters dictionary
         # What could possibly go wrong?
-        toc_copy = self.content[:]
-
-        # Put the book into the book
-        for count, i in enumerate(toc_copy):
-            chapter_file = i[2]
+        for i in self.content:
+            chapter_file, _, this_anchor = i[2].partition('#')
 
             # Get split content according to its corresponding id attribute
-            if '#' in chapter_file:
-                this_split = chapter_file.split('#')
-                chapter_file_proper = this_split[0]
-                this_anchor = this_split[1]
-
-                try:
-                    chapter_content = (
-                        self.split_chapters[chapter_file_proper][this_anchor])
-                except KeyError:
-                    chapter_content = 'Parse Error'
-                    error_string = (
-                        f'Error parsing {self.book_filename}: {chapter_file_proper}')
-                    logger.error(error_string)
-
-            # Get content that remained at the end of the pillaging above
-            elif chapter_file in self.split_chapters.keys():
-                try:
-                    chapter_content = self.split_chapters[chapter_file]['top_level']
-                except KeyError:
-                    chapter_content = 'Parse Error'
-                    error_string = (
-                        f'Error parsing {self.book_filename}: {chapter_file}')
-                    logger.error(error_string)
-
-            # Vanilla non split chapters
-            else:
-                chapter_content = self.get_chapter_content(chapter_file)
-
-            self.content[count][2] = chapter_content
+            # Content that remained at the end of the pillaging above is
+            # at the top level, along with vanilla non split chapters
+            try:
+                i[2] = all_chapters[chapter_file][this_anchor or 'top_level']
+            except KeyError:
+                i[2] = 'Parse Error'
+                error_string = (
+                    f'Error parsing {self.book_filename}: {chapter_file}')
+                logger.error(error_string)
 
         # Cleanup content by removing null chapters
+        # Entries can't be nested deeper than one level below
+        # the entry before them once the null chapters are gone
+        # Chapters missing from the toc are numbered among themselves
         unnamed_chapter_title = 1
+        previous_level = 0
         content_copy = []
         for i in self.content:
             if i[2]:
                 chapter_title = i[1]
                 if not chapter_title:
                     chapter_title = unnamed_chapter_title
+                    unnamed_chapter_title += 1
+                previous_level = min(i[0], previous_level + 1)
                 content_copy.append((
-                    i[0], str(chapter_title), i[2]))
-            unnamed_chapter_title += 1
+                    previous_level, str(chapter_title), i[2]))
         self.content = content_copy
 
         # Get cover image and put it in its place
@@ -366,71 +339,33 @@ class EPUB:
                      f'<center><img src="{cover_path}" alt="Cover"></center>'))
 
     def generate_metadata(self):
-        book_metadata = self.opf_dict['package']['metadata']
-
-        def flattener(this_object):
-            if isinstance(this_object, collections.OrderedDict):
-                return this_object['#text']
-
-            if isinstance(this_object, list):
-                if isinstance(this_object[0], collections.OrderedDict):
-                    return this_object[0]['#text']
-                else:
-                    return this_object[0]
-
-            if isinstance(this_object, str):
-                return this_object
-
-        # There are no exception types specified below
-        # This is on purpose and makes me long for the days
-        # of simpler, happier things.
-
         # Book title
-        try:
-            title = flattener(book_metadata['dc:title'])
-        except:
+        title = self.package.first_metadata('title')
+        if not title:
             logger.warning('Title not found: ' + self.book_filename)
             title = os.path.splitext(
                 os.path.basename(self.book_filename))[0]
 
         # Book author
-        try:
-            author = flattener(book_metadata['dc:creator'])
-        except:
+        author = self.package.first_metadata('creator')
+        if not author:
             logger.warning('Author not found: ' + self.book_filename)
             author = 'Unknown'
 
         # Book year
         try:
-            year = int(flattener(book_metadata['dc:date'])[:4])
-        except:
+            year = int(self.package.first_metadata('date')[:4])
+        except (TypeError, ValueError):
             logger.warning('Year not found: ' + self.book_filename)
             year = 9999
 
         # Book isbn
-        # Both one and multiple schema
-        isbn = None
-        try:
-            scheme = book_metadata['dc:identifier']['@opf:scheme'].lower()
-            if scheme.lower() == 'isbn':
-                isbn = book_metadata['dc:identifier']['#text']
-
-        except (TypeError, KeyError):
-            try:
-                for i in book_metadata['dc:identifier']:
-                    if i['@opf:scheme'].lower() == 'isbn':
-                        isbn = i['#text']
-                    break
-            except:
-                logger.warning('ISBN not found: ' + self.book_filename)
+        isbn = self.package.find_isbn()
+        if not isbn:
+            logger.warning('ISBN not found: ' + self.book_filename)
 
         # Book tags
-        try:
-            tags = book_metadata['dc:subject']
-            if isinstance(tags, str):
-                tags = [tags]
-        except:
-            tags = []
+        tags = self.package.all_metadata('subject')
 
         # Book cover
         cover = self.generate_book_cover()
@@ -445,13 +380,12 @@ class EPUB:
         # be found and extracted both during addition / reading
         book_cover = None
 
-        try:
-            cover_image = [
-                i['@href'] for i in self.opf_dict['package']['manifest']['item']
-                if i['@media-type'].split('/')[0] == 'image' and
-                'cover' in i['@id']][0]
-            book_cover = self.zip_file.read(self.find_file(cover_image))
-        except:
+        cover_image = self.package.find_cover()
+        if cover_image:
+            cover_file = self.find_file(cover_image)
+            if cover_file:
+                book_cover = self.zip_file.read(cover_file)
+        else:
             logger.warning('Cover not found in opf: ' + self.book_filename)
 
         # Find book cover the hard way
@@ -459,14 +393,13 @@ class EPUB:
             biggest_image_size = 0
             cover_image = None
             for j in self.zip_file.filelist:
-                if os.path.splitext(j.filename)[1] in ['.jpg', '.jpeg', '.png', '.gif']:
+                if os.path.splitext(j.filename)[1].lower() in ('.jpg', '.jpeg', '.png', '.gif'):
                     if j.file_size > biggest_image_size:
                         cover_image = j.filename
                         biggest_image_size = j.file_size
 
             if cover_image:
-                book_cover = self.zip_file.read(
-                    self.find_file(cover_image))
+                book_cover = self.zip_file.read(cover_image)
 
         if not book_cover:
             self.cover_image_name = ''
@@ -14,163 +14,414 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+# FB2 files are streamed once through lxml's iterparse. The images,
+# which are the bulk of an illustrated book, are dropped from the tree
+# as soon as they're parsed. All that's kept is where their base64
+# lies in the file, noted down from the bytes as they go past the
+# parser, so that they can be decoded when they're displayed.
+# A .fb2.zip can't be seeked into cheaply, so its base64 is kept
+# instead, and decoded the same way.
+# Adding a book to the library only needs its <description> and
+# cover. That is read without parsing the rest of the file at all.
+
 import os
+import re
+import contextlib
 import base64
+import binascii
 import zipfile
 import logging
 import collections
+from urllib.parse import quote, unquote
+
+from lxml import etree
 
-from bs4 import BeautifulSoup
+from app.lector.lector.readers.book_resources import BookResources
 
 logger = logging.getLogger(__name__)
 
+binary_element = re.compile(rb'<(?:[\w-]+:)?binary\b([^>]*)>')
+binary_id = re.compile(rb'''\bid\s*=\s*["']([^"']*)["']''')
+xml_encoding = re.compile(rb'''<\?xml[^>]*encoding\s*=\s*["']([\w.:-]+)["']''')
+namespace_declaration = re.compile(r'\sxmlns(?::[\w-]+)?="[^"]*"')
+
+CHUNK_SIZE = 64 * 1024
+
+
+def local_name(element):
+    # Comments and processing instructions have no name
+    if not isinstance(element.tag, str):
+        return None
+    return etree.QName(element).localname
+
+
+def element_text(element):
+    if element is None:
+        return None
+    return ' '.join(' '.join(element.itertext()).split())
+
+
+@contextlib.contextmanager
+def open_book(filename):
+    # The .fb2 member of a .fb2.zip is decompressed as it is read
+    if filename.endswith('.fb2.zip'):
+        with zipfile.ZipFile(filename, mode='r', allowZip64=True) as this_book:
+            for i in this_book.filelist:
+                if os.path.splitext(i.filename)[1] == '.fb2':
+                    with this_book.open(i.filename) as book_file:
+                        yield book_file
+                    return
+        raise FileNotFoundError('No .fb2 file in ' + filename)
+
+    with open(filename, 'rb') as book_file:
+        yield book_file
+
+
+def keeps_payloads(filename):
+    # Seeking inside a .fb2.zip decompresses the member from its start,
+    # so the payloads of zipped books are held on to instead of spans
+    return filename.endswith('.fb2.zip')
+
+
+def sniff_encoding(book_data):
+    encoding_match = xml_encoding.search(book_data, 0, 256)
+    if encoding_match:
+        return encoding_match.group(1).decode('ascii')
+    return 'utf-8'
+
+
+def binary_name(binary_tag, encoding):
+    # binary_tag is a match of binary_element
+    id_match = binary_id.search(binary_tag.group(1))
+    if not id_match:
+        return None
+
+    try:
+        return id_match.group(1).decode(encoding, 'replace')
+    except LookupError:
+        return id_match.group(1).decode('utf-8', 'replace')
+
+
+class BinaryIndexer:
+    # Wraps a book file for whatever reads it, and maps the id of every
+    # <binary> to the span of its base64 payload as the bytes go past
+    # Spans are offsets into the (decompressed) .fb2
+    # With keep_payloads, ids map to the base64 payloads themselves
+
+    def __init__(self, book_file, keep_payloads=False):
+        self.book_file = book_file
+        self.keep_payloads = keep_payloads
+        self.binaries = {}
+        self.encoding = None
+
+        self.pending = b''  # Read, but not yet scanned to the end
+        self.pending_offset = 0
+        self.open_binary = None  # (name, payload start) until it ends
+        self.payload = []  # Of the open binary, with keep_payloads
+
+    def read(self, size=-1):
+        chunk = self.book_file.read(size)
+        self.scan(chunk)
+        return chunk
+
+    def scan(self, chunk):
+        if self.encoding is None:
+            self.encoding = sniff_encoding(chunk)
+
+        book_data = self.pending + chunk
+        position = 0
+        while True:
+            if self.open_binary:
+                # base64 has no use for a <, so the payload ends at the first one
+                payload_end = book_data.find(b'<', position)
+                if payload_end == -1 and chunk:
+                    if self.keep_payloads:
+                        self.payload.append(book_data[position:])
+                    self.pending = b''
+                    self.pending_offset += len(book_data)
+                    return
+
+                if payload_end == -1:  # End of file
+                    payload_end = len(book_data)
+                image_name, payload_start = self.open_binary
+                if self.keep_payloads:
+                    self.payload.append(book_data[position:payload_end])
+                    self.binaries.setdefault(image_name, b''.join(self.payload))
+                    self.payload = []
+                else:
+                    self.binaries.setdefault(
+                        image_name, (payload_start, self.pending_offset + payload_end))
+                self.open_binary = None
+                position = payload_end
+
+            binary_tag = binary_element.search(book_data, position)
+            if not binary_tag:
+                # Opening tags may straddle chunks
+                keep_from = max(position, len(book_data) - 1024)
+                self.pending = book_data[keep_from:]
+                self.pending_offset += keep_from
+                return
+
+            image_name = binary_name(binary_tag, self.encoding)
+            if image_name:
+                self.open_binary = (image_name, self.pending_offset + binary_tag.end())
+            position = binary_tag.end()
+
+
+def find_binaries(filename):
+    # For when the book isn't being parsed anyway
+    with open_book(filename) as book_file:
+        binary_indexer = BinaryIndexer(book_file, keeps_payloads(filename))
+        while binary_indexer.read(CHUNK_SIZE):
+            pass
+        return binary_indexer.binaries
+
+
+def scan_for_binary(book_file, image_name, encoding, book_data=b''):
+    # Reads forward through book_file until the <binary> named
+    # image_name turns up. Only the chunk being searched is held in
+    # memory. book_data is whatever was last read from book_file.
+    while True:
+        for i in binary_element.finditer(book_data):
+            if binary_name(i, encoding) != image_name:
+                continue
+
+            payload = [book_data[i.end():]]
+            while b'<' not in payload[-1]:
+                chunk = book_file.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                payload.append(chunk)
+
+            payload[-1] = payload[-1].split(b'<', 1)[0]
+            return decode_binary(b''.join(payload))
+
+        chunk = book_file.read(CHUNK_SIZE)
+        if not chunk:
+            return None
+
+        # Opening tags may straddle chunks
+        book_data = book_data[-1024:] + chunk
+
+
+def decode_binary(payload):
+    try:
+        return base64.b64decode(payload)
+    except (binascii.Error, ValueError):
+        return None
+
+
+class FB2Resources(BookResources):
+    # Images are decoded from the book file as they are displayed
+    # binaries is as found by the parser. Books that didn't go
+    # through the parser are indexed here instead.
+    # Plain .fb2 files are read at the span of the image, while
+    # zipped books come with their payloads already in binaries
+
+    def __init__(self, book_filename, binaries=None, cache_limit_mb=64):
+        super(FB2Resources, self).__init__(book_filename, cache_limit_mb)
+        if binaries is None:
+            binaries = find_binaries(book_filename)
+        self.binaries = binaries
+
+    def read_image(self, name):
+        binary = self.binaries.get(name) or self.binaries.get(unquote(name))
+        if binary is None:
+            return None
+
+        if keeps_payloads(self.book_filename):
+            return decode_binary(binary)
+
+        start, end = binary
+        with open(self.book_filename, 'rb') as book_file:
+            book_file.seek(start)
+            payload = book_file.read(end - start)
+
+        return decode_binary(payload)
+
 
 class FB2:
     def __init__(self, filename):
         self.filename = filename
-        self.zip_file = None
-        self.xml = None
+        self.binaries = {}
+        self.root = None
+        self.description = None
 
         self.metadata = None
         self.content = []
 
-        self.generate_references()
-
     def generate_references(self):
-        if self.filename.endswith('.fb2.zip'):
-            this_book = zipfile.ZipFile(
-                self.filename, mode='r', allowZip64=True)
-            for i in this_book.filelist:
-                if os.path.splitext(i.filename)[1] == '.fb2':
-                    book_text = this_book.read(i.filename)
+        with open_book(self.filename) as book_file:
+            binary_indexer = BinaryIndexer(
+                book_file, keeps_payloads(self.filename))
+            for _, element in etree.iterparse(
+                    binary_indexer, events=('end',),
+                    recover=True, huge_tree=True, remove_comments=True):
+                this_name = local_name(element)
+                if this_name == 'binary':
+                    element.getparent().remove(element)
+                elif this_name == 'description' and self.description is None:
+                    self.description = element
+                self.root = element
+
+            self.binaries = binary_indexer.binaries
+
+    def find(self, element, name):
+        # Recursive, and in any namespace
+        if element is None:
+            return None
+        return next(element.iter('{*}' + name), None)
+
+    def read_description(self, book_file):
+        # Feeds book_file to the parser only until the end of the
+        # <description>. Returns the last chunk read, along with the
+        # encoding declared in the first one.
+        xml_parser = etree.XMLPullParser(
+            events=('end',), recover=True, huge_tree=True, remove_comments=True)
+
+        chunk = b''
+        encoding = None
+        while self.description is None:
+            chunk = book_file.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            if encoding is None:
+                encoding = sniff_encoding(chunk)
+
+            xml_parser.feed(chunk)
+            for _, element in xml_parser.read_events():
+                if local_name(element) == 'description':
+                    self.description = element
                     break
 
-        else:
-            with open(self.filename, 'r') as book_file:
-                book_text = book_file.read()
-
-        self.xml = BeautifulSoup(book_text, 'lxml')
+        return chunk, encoding or 'utf-8'
 
     def generate_metadata(self):
-        # All metadata can be parsed in one pass
-        all_tags = self.xml.find('description')
-
-        title = all_tags.find('book-title').text
-        if title == '' or title is None:
+        # Parsing stops at the end of the <description>. The cover
+        # binary is then found by scanning the rest of the file.
+        with open_book(self.filename) as book_file:
+            book_data, encoding = self.read_description(book_file)
+
+            cover = None
+            cover_image_name = self.find_cover_name()
+            if cover_image_name:
+                cover = scan_for_binary(
+                    book_file, cover_image_name, encoding, book_data)
+            if not cover:
+                logger.warning('Cover not found: ' + self.filename)
+
+        all_tags = self.description
+
+        title = element_text(self.find(all_tags, 'book-title'))
+        if not title:
             title = os.path.splitext(
                 os.path.basename(self.filename))[0]
 
-        author = all_tags.find(
-            'author').getText(separator=' ').replace('\n', ' ')
-        if author == '' or author is None:
+        author = element_text(self.find(all_tags, 'author'))
+        if not author:
             author = '<Unknown>'
-        else:
-            author = author.strip()
 
         # TODO
         # Account for other date formats
         try:
-            year = int(all_tags.find('date').text)
-        except ValueError:
+            year = int(element_text(self.find(all_tags, 'date'))[:4])
+        except (TypeError, ValueError):
             year = 9999
 
         isbn = None
         tags = None
 
-        cover = self.generate_book_cover()
-
         Metadata = collections.namedtuple(
             'Metadata', ['title', 'author', 'year', 'isbn', 'tags', 'cover'])
         self.metadata = Metadata(title, author, year, isbn, tags, cover)
 
-    def generate_content(self, temp_dir):
-        # TODO
-        # Check what's up with recursion levels
-        # Why is the TypeError happening in get_title
-
+    def generate_toc(self):
+        # Only the structure of the book is worked out here
+        # The markup of each chapter is put together by generate_chapter
         def get_title(element):
-            this_title = '<No title>'
-            title_xml = '<No title xml>'
-            try:
-                for i in element:
-                    if i.name == 'title':
-                        this_title = i.getText(separator=' ')
-                        this_title = this_title.replace('\n', '').strip()
-                        title_xml = str(i.unwrap())
-                        break
-            except TypeError:
-                return None, None
-            return this_title, title_xml
+            for i in element:
+                if local_name(i) == 'title':
+                    return element_text(i)
+            return '<No title>'
 
         def recursor(level, element):
-            children = element.findChildren('section', recursive=False)
+            children = list(element.iterchildren('{*}section'))
             if not children and level != 1:
-                this_title, title_xml = get_title(element)
                 self.content.append(
-                    [level, this_title, title_xml + str(element)])
+                    [level, get_title(element), [element]])
             else:
                 for i in children:
                     recursor(level + 1, i)
 
-        first_element = self.xml.find('section')  # Recursive find
-        siblings = list(first_element.findNextSiblings('section', recursive=False))
-        siblings.insert(0, first_element)
+        first_element = self.find(self.root, 'section')  # Recursive find
+        if first_element is None:
+            logger.warning('No sections in: ' + self.filename)
+            siblings = [self.find(self.root, 'body')]
+        else:
+            siblings = [first_element] + list(
+                first_element.itersiblings('{*}section'))
 
         for this_element in siblings:
-            this_title, title_xml = get_title(this_element)
+            this_title = get_title(this_element)
             # Do not add chapter content in case it has sections
             # inside it. This prevents having large Book sections that
             # have duplicated content
-            section_children = this_element.findChildren('section')
-            chapter_text = str(this_element)
-            if section_children:
-                chapter_text = this_title
+            chapter_parts = [this_element]
+            if next(this_element.iterdescendants('{*}section'), None) is not None:
+                chapter_parts = [this_title]
 
-            self.content.append([1, this_title, chapter_text])
+            self.content.append([1, this_title, chapter_parts])
             recursor(1, this_element)
 
-        # Extract all images to the temp_dir
-        for i in self.xml.find_all('binary'):
-            image_name = i.get('id')
-            image_path = os.path.join(temp_dir, image_name)
-            image_string = f'<image l:href="#{image_name}"'
-            replacement_string = f'<p></p><img src=\"{image_path}\"'
-
-            for j in self.content:
-                j[2] = j[2].replace(
-                    image_string, replacement_string)
-            try:
-                image_data = base64.decodebytes(i.text.encode())
-                with open(image_path, 'wb') as outimage:
-                    outimage.write(image_data)
-            except AttributeError:
-                pass
-
         # Insert the book cover at the beginning
-        cover_image = self.generate_book_cover()
-        if cover_image:
-            cover_path = os.path.join(
-                temp_dir, os.path.basename(self.filename)) + ' - cover'
-            with open(cover_path, 'wb') as cover_temp:
-                cover_temp.write(cover_image)
-
+        cover_image_name = self.find_cover_name()
+        if cover_image_name in self.binaries:
             self.content.insert(
-                0, (1, 'Cover', f'<center><img src="{cover_path}" alt="Cover"></center>'))
-
-    def generate_book_cover(self):
-        cover = None
-
-        try:
-            cover_image_xml = self.xml.find('coverpage')
-            for i in cover_image_xml:
-                cover_image_name = i.get('l:href')
-
-            cover_image_data = self.xml.find_all('binary')
-            for i in cover_image_data:
-                if cover_image_name.endswith(i.get('id')):
-                    cover = base64.decodebytes(i.text.encode())
-        except (AttributeError, TypeError):
-            # Catch TypeError in case no images exist in the book
-            logger.warning('Cover not found: ' + self.filename)
-
-        return cover
+                0, [1, 'Cover', [
+                    f'<center><img src="{quote(cover_image_name)}" alt="Cover"></center>']])
+
+    def generate_chapter(self, chapter_number):
+        chapter_markup = []
+        for i in self.content[chapter_number - 1][2]:
+            if isinstance(i, str):
+                chapter_markup.append(i)
+            else:
+                chapter_markup.append(self.section_markup(i))
+        return ''.join(chapter_markup)
+
+    def section_markup(self, section):
+        # FB2 markup goes to the text browser more or less as is
+        # Namespaces are dropped and titles are made visible
+        # Images are pointed at their binaries, in the same pass
+        for element in list(section.iter()):
+            if not isinstance(element.tag, str):
+                continue
+
+            this_name = local_name(element)
+            for attribute in [i for i in element.attrib if i.startswith('{')]:
+                element.set(etree.QName(attribute).localname, element.attrib.pop(attribute))
+
+            if this_name == 'title':
+                this_name = 'div'
+            elif this_name == 'image':
+                image_name = element.get('href', '').lstrip('#')
+                if image_name in self.binaries:
+                    this_name = 'img'
+                    element.attrib.clear()
+                    element.set('src', quote(image_name))
+                    element.addprevious(element.makeelement('p', {}))
+            element.tag = this_name
+
+        section_markup = etree.tostring(
+            section, encoding='unicode', method='html', with_tail=False)
+        opening_tag, _, remainder = section_markup.partition('>')
+        return namespace_declaration.sub('', opening_tag) + '>' + remainder
+
+    def find_cover_name(self):
+        cover_image_xml = self.find(self.description, 'coverpage')
+        cover_image = self.find(cover_image_xml, 'image')
+        if cover_image is not None:
+            for attribute, value in cover_image.attrib.items():
+                if attribute.endswith('href'):
+                    return value.lstrip('#')
+        return None
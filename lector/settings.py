@@ -120,6 +120,11 @@ class Settings:
             'mangaMode', 'False').capitalize())
         self.parent.settings['invert_colors'] = literal_eval(self.settings.value(
             'invertColors', 'False').capitalize())
+        self.parent.settings['verify_fingerprints'] = literal_eval(self.settings.value(
+            'verifyFingerprints', 'False').capitalize())
+        self.parent.settings['incremental_scan'] = literal_eval(self.settings.value(
+            'incrementalScan', 'True').capitalize())
+        self.parent.settings['book_cache_limit'] = int(self.settings.value('bookCacheLimit', 500))
         self.settings.endGroup()
 
         self.settings.beginGroup('dialogSettings')
@@ -191,6 +196,10 @@ class Settings:
         self.settings.setValue('doublePageMode', str(current_settings['double_page_mode']))
         self.settings.setValue('mangaMode', str(current_settings['manga_mode']))
         self.settings.setValue('invertColors', str(current_settings['invert_colors']))
+        self.settings.setValue(
+            'verifyFingerprints', str(current_settings['verify_fingerprints']))
+        self.settings.setValue('incrementalScan', str(current_settings['incremental_scan']))
+        self.settings.setValue('bookCacheLimit', current_settings['book_cache_limit'])
         self.settings.setValue('smallIncrement', current_settings['small_increment'])
         self.settings.setValue('largeIncrement', current_settings['large_increment'])
         self.settings.endGroup()
@@ -293,14 +293,23 @@ class SettingsUI(QtWidgets.QDialog, settingswindow.Ui_Dialog):
         # Traverse directories looking for files
         self.main_window.statusMessage.setText(
             self._translate('SettingsUI', 'Checking library folders'))
-        self.thread = BackGroundBookSearch(data_pairs)
+        incremental_path = None
+        if self.main_window.settings['incremental_scan']:
+            incremental_path = self.database_path
+        self.thread = BackGroundBookSearch(data_pairs, incremental_path)
         self.thread.finished.connect(self.finished_iterating)
         self.thread.start()
 
     def finished_iterating(self):
         # The books the search thread has found
         # are now in self.thread.valid_files
-        if not self.thread.valid_files:
+        # Incremental scans only require addition in case something changed
+        scan_diff = self.thread.scan_diff
+        if scan_diff:
+            if not (scan_diff['added'] or scan_diff['removed'] or scan_diff['moved']):
+                self.main_window.move_on()
+                return
+        elif not self.thread.valid_files:
             self.main_window.move_on()
             return
 
@@ -312,7 +321,10 @@ class SettingsUI(QtWidgets.QDialog, settingswindow.Ui_Dialog):
 
         # We now create a new thread to put those files into the database
         self.thread = BackGroundBookAddition(
-            self.thread.valid_files, self.database_path, 'automatic', self.main_window)
+            self.thread.valid_files, self.database_path, 'automatic',
+            self.main_window, scan_diff)
+        self.thread.booksCommitted.connect(self.main_window.add_books_to_model)
+        self.thread.pathsMoved.connect(self.main_window.move_model_paths)
         self.thread.finished.connect(
             lambda: self.main_window.move_on(self.thread.errors))
         self.thread.start()
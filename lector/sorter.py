@@ -19,7 +19,7 @@
 # Exceptions will be caught - but that's just bad practice
 # read_book() - Initialize book
 # generate_metadata() - For addition
-# generate_content() - For reading
+# generate_content() - For reading. May stream its chapters (see streaming.py)
 
 import io
 import os
@@ -29,20 +29,37 @@ import time
 import pickle
 import logging
 import hashlib
+import inspect
 import threading
 import importlib
+import functools
+import itertools
 import urllib.request
+from multiprocessing.pool import ThreadPool
 
 # The multiprocessing module does not work correctly on Windows
 if sys.platform.startswith('win'):
-    from multiprocessing.dummy import Pool, Manager
+    from multiprocessing.dummy import Pool
     thread_count = 4  # This is all on one CPU thread anyway
+    pool_context = None
 else:
-    from multiprocessing import Pool, Manager, cpu_count
-    thread_count = cpu_count()
+    import multiprocessing
+    thread_count = multiprocessing.cpu_count()
+
+    # Workers are not forked from the GUI process. They come from
+    # a clean interpreter that has only this module (and therefore
+    # the parsers) imported, and no QApplication / widgets
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        pool_context = multiprocessing.get_context('forkserver')
+        pool_context.set_forkserver_preload([__name__])
+    else:
+        pool_context = multiprocessing.get_context('spawn')
 
 from PyQt5 import QtCore, QtGui
 from app.lector.lector import database
+from app.lector.lector.bookcache import BookCache, stat_fingerprint
+from app.lector.lector.logger import init_logging
+from app.lector.lector.streaming import StreamedContent
 from app.lector.lector.parsers.comicbooks import ParseCOMIC
 
 logger = logging.getLogger(__name__)
@@ -84,8 +101,7 @@ else:
 
 # python-lxml - Required for everything except comics
 lxml_check = importlib.util.find_spec('lxml')
-xmltodict_check = importlib.util.find_spec('xmltodict')
-if lxml_check and xmltodict_check:
+if lxml_check:
     from app.lector.lector.parsers.epub import ParseEPUB
     from app.lector.lector.parsers.mobi import ParseMOBI
     from app.lector.lector.parsers.fb2 import ParseFB2
@@ -101,7 +117,7 @@ if lxml_check and xmltodict_check:
         'fb2.zip': ParseFB2}
     sorter.update(lxml_dependent)
 else:
-    critical_sting = 'lxml / xmltodict is not installed. Only comics will load.'
+    critical_sting = 'lxml is not installed. Only comics will load.'
     print(critical_sting)
     logger.critical(critical_sting)
 
@@ -119,6 +135,12 @@ available_parsers = [i for i in sorter]
 progressbar = None  # This is populated by __main__
 _progress_emitter = None  # This is to be made into a global variable
 
+# Worker pools are created on first use and kept for the session
+# Workers are replaced after this many tasks to cap memory growth
+worker_task_limit = 50
+_worker_pools = {}  # purpose: pool
+_worker_pool_lock = threading.Lock()
+
 
 class UpdateProgress(QtCore.QObject):
     # This is for thread safety
@@ -142,6 +164,7 @@ class BookSorter:
         self.file_list = [i for i in file_list if os.path.exists(i)]
         self.statistics = [0, (len(file_list))]
         self.hashes_and_paths = {}
+        self.file_hashes = {}
         self.work_mode = mode[0]
         self.addition_mode = mode[1]
         self.database_path = database_path
@@ -149,10 +172,13 @@ class BookSorter:
         if database_path:
             self.database_hashes()
 
-        self.threading_completed = []
-        self.queue = Manager().Queue()
-        self.errors = Manager().list()
-        self.processed_books = []
+        self.completed_number = 0
+        self.errors = []
+
+        # Books being read are served from the parsed book cache if possible
+        self.book_cache = None
+        if self.work_mode == 'reading':
+            self.book_cache = BookCache(settings['book_cache_limit'])
 
         if self.work_mode == 'addition':
             progress_object_generator()
@@ -191,19 +217,7 @@ class BookSorter:
 
         return book_data
 
-    def read_book(self, filename):
-        # filename is expected as a string containing the
-        # full path of the ebook file
-
-        with open(filename, 'rb') as current_book:
-            # This should speed up addition for larger files
-            # without compromising the integrity of the process
-            first_bytes = current_book.read(1024 * 32)  # First 32KB of the file
-            file_md5 = hashlib.md5(first_bytes).hexdigest()
-
-        # Update the progress queue
-        self.queue.put(filename)
-
+    def is_duplicate(self, filename, file_md5):
         # This should not get triggered in reading mode
         # IF the file is NOT being loaded into the reader
 
@@ -217,164 +231,353 @@ class BookSorter:
                     warning_string = (
                         f'{os.path.basename(filename)} is already in database')
                     logger.warning(warning_string)
-                return
+                return True
 
-        # This allows for eliminating issues with filenames that have
-        # a dot in them. All hail the roundabout fix.
-        valid_extension = False
-        for i in sorter:
-            if os.path.basename(filename).endswith(i):
-                file_extension = i
-                valid_extension = True
-                break
+        return False
 
-        if not valid_extension:
-            this_error = 'Unsupported extension: ' + filename
-            self.errors.append(this_error)
-            logger.error(this_error)
-            return
+    def complete_book(self, this_book):
+        # Adds whatever the database knows about a book
+        # that has been parsed for reading
+        file_md5 = this_book['hash']
 
-        book_ref = sorter[file_extension](filename, self.temp_dir, file_md5)
+        try:
+            book_data = self.database_entry_for_book(file_md5)
+        except TypeError:
+            logger.error(
+                f'Database error: {this_book["path"]}. Re-add book to program')
+            return None
 
-        # None of the following have an exception type specified
-        # This will keep everything from crashing, but will make
-        # troubleshooting difficult
+        this_book['title'] = book_data[0].replace('&', '&&')
+        this_book['author'] = book_data[1]
+        this_book['year'] = book_data[2]
+        this_book['isbn'] = book_data[3]
+        this_book['tags'] = book_data[4]
+        this_book['position'] = book_data[5]
+        this_book['bookmarks'] = book_data[6]
+        this_book['cover'] = book_data[7]
+        this_book['annotations'] = book_data[8]
 
-        try:
-            book_ref.read_book()
-        except Exception as e:
-            this_error = f'Error initializing: {filename}'
-            self.errors.append(this_error)
-            logger.exception(this_error + f' {type(e).__name__} Arguments: {e.args}')
-            return
+        return this_book
 
-        this_book = {}
-        this_book[file_md5] = {
-            'hash': file_md5,
-            'path': filename}
+    def load_cached_books(self, tasks):
+        # Returns results in the same form as read_book for every
+        # task that is in the cache, and the tasks that aren't
+        cached_results = []
+        remaining_tasks = []
+        for task in tasks:
+            filename, file_md5, _, temp_dir = task
+            file_extension = get_parser_extension(filename)
+            cached_book = None
+            if file_extension:
+                cached_book = self.book_cache.load(
+                    file_md5, filename, sorter[file_extension], temp_dir)
+
+            if not cached_book:
+                remaining_tasks.append(task)
+                continue
+
+            this_book = {
+                'hash': file_md5,
+                'path': filename,
+                'toc': cached_book[0],
+                'content': cached_book[1],
+                'images_only': cached_book[2],
+                'block_counts': cached_book[3]}
+            cached_results.append((filename, this_book, []))
+
+        if cached_results:
+            logger.info(f'{len(cached_results)} book(s) loaded from cache')
+        return cached_results, remaining_tasks
+
+    def update_progress(self):
+        self.completed_number += 1
+
+        # Just for the record, this slows down book searching by about 20%
+        if _progress_emitter:  # Skip update in reading mode
+            _progress_emitter.update_progress(
+                self.completed_number * 100 // len(self.file_list))
+
+    def initiate_threads(self, batch_callback=None, batch_size=100):
+        # In case a batch_callback is specified, it is called
+        # with every batch_size processed books as
+        # batch_callback(parsed_books, processed_filenames)
+        # as soon as they are available. Nothing is accumulated in this case.
+        if not self.file_list:
+            return None
 
-        # Different modes require different values
-        if self.work_mode == 'addition':
+        # Files that haven't changed since they were last seen
+        # are not opened again to find their hash
+        self.file_hashes = get_file_hashes(self.file_list, self.database_path)
+
+        # Duplicates are weeded out here instead of in the workers
+        # Each task is only the path and what's needed to parse it
+        tasks = []
+        skipped_filenames = []
+        for filename in self.file_list:
             try:
-                metadata = book_ref.generate_metadata()
-            except Exception as e:
-                this_error = f'Metadata generation error: {filename}'
-                self.errors.append(this_error)
-                logger.exception(this_error + f' {type(e).__name__} Arguments: {e.args}')
-                return
+                file_md5 = self.file_hashes[filename]
+            except KeyError:  # Could not be read
+                skipped_filenames.append(filename)
+                continue
 
-            title = metadata.title
-            author = metadata.author
-            year = metadata.year
-            isbn = metadata.isbn
+            if self.is_duplicate(filename, file_md5):
+                skipped_filenames.append(filename)
+                continue
 
-            tags = None
+            tasks.append((filename, file_md5, self.work_mode, self.temp_dir))
 
-            cover_image_raw = metadata.cover
-            if cover_image_raw:
-                cover_image = resize_image(cover_image_raw)
-            else:
-                cover_image = None
+        cached_results = []
+        if self.work_mode == 'reading':
+            cached_results, tasks = self.load_cached_books(tasks)
 
-            this_book[file_md5]['cover_image'] = cover_image
-            this_book[file_md5]['addition_mode'] = self.addition_mode
+        start_time = time.time()
+        return_books = {}
+        parsed_batch = {}
+        processed_filenames = []
 
-        if self.work_mode == 'reading':
-            try:
-                book_breakdown = book_ref.generate_content()
-            except Exception as e:
-                this_error = f'Content generation error: {filename}'
-                self.errors.append(this_error)
-                logger.exception(this_error + f' {type(e).__name__} Arguments: {e.args}')
-                return
+        for filename in skipped_filenames:
+            processed_filenames.append(filename)
+            self.update_progress()
 
-            toc = book_breakdown[0]
-            content = book_breakdown[1]
-            images_only = book_breakdown[2]
+        # Chunks keep the per task overhead down without
+        # holding too many finished books in the pool at once
+        chunk_size = max(1, min(16, len(tasks) // (thread_count * 4)))
 
-            try:
-                book_data = self.database_entry_for_book(file_md5)
-            except TypeError:
-                logger.error(
-                    f'Database error: {filename}. Re-add book to program')
-                return
-
-            title = book_data[0].replace('&', '&&')
-            author = book_data[1]
-            year = book_data[2]
-            isbn = book_data[3]
-            tags = book_data[4]
-            position = book_data[5]
-            bookmarks = book_data[6]
-            cover = book_data[7]
-            annotations = book_data[8]
-
-            this_book[file_md5]['position'] = position
-            this_book[file_md5]['bookmarks'] = bookmarks
-            this_book[file_md5]['toc'] = toc
-            this_book[file_md5]['content'] = content
-            this_book[file_md5]['images_only'] = images_only
-            this_book[file_md5]['cover'] = cover
-            this_book[file_md5]['annotations'] = annotations
-
-        this_book[file_md5]['title'] = title
-        this_book[file_md5]['author'] = author
-        this_book[file_md5]['year'] = year
-        this_book[file_md5]['isbn'] = isbn
-        this_book[file_md5]['tags'] = tags
+        # Books that are being opened are parsed in threads in this process
+        # Their content is never pickled across from a worker process
+        # Addition only returns metadata and uses the worker pool
+        # Freshly parsed books are cached from within those threads
+        if self.work_mode == 'reading':
+            _pool = ThreadPool(max(1, min(len(tasks), thread_count)))
+            worker_function = functools.partial(read_and_cache_book, self.book_cache)
+        else:
+            _pool = get_worker_pool()
+            worker_function = read_book
+
+        # Progress is updated as each result comes in
+        for filename, this_book, these_errors in itertools.chain(
+                cached_results,
+                _pool.imap_unordered(worker_function, tasks, chunk_size)):
+            self.errors.extend(these_errors)
+            if this_book and self.work_mode == 'reading':
+                this_book = self.complete_book(this_book)
+            if this_book:
+                if self.work_mode == 'addition':
+                    this_book['addition_mode'] = self.addition_mode
+                parsed_batch[this_book['hash']] = this_book
+
+            processed_filenames.append(filename)
+            self.update_progress()
+
+            if batch_callback and len(processed_filenames) >= batch_size:
+                batch_callback(parsed_batch, processed_filenames)
+                parsed_batch = {}
+                processed_filenames = []
 
-        return this_book
+        if self.work_mode == 'reading':
+            _pool.close()
+            _pool.join()
 
-    def read_progress(self):
-        while True:
-            processed_file = self.queue.get()
-            self.threading_completed.append(processed_file)
+        if batch_callback:
+            if processed_filenames:
+                batch_callback(parsed_batch, processed_filenames)
+        else:
+            return_books.update(parsed_batch)
 
-            total_number = len(self.file_list)
-            completed_number = len(self.threading_completed)
+        processing_time = str(time.time() - start_time)
+        logger.info('Finished processing in ' + processing_time)
 
-            # Just for the record, this slows down book searching by about 20%
-            if _progress_emitter:  # Skip update in reading mode
-                _progress_emitter.update_progress(
-                    completed_number * 100 // total_number)
+        return return_books, self.errors
 
-            if total_number == completed_number:
-                break
 
-    def initiate_threads(self):
-        if not self.file_list:
-            return None
+def get_worker_pool(purpose='addition'):
+    # Process startup is only paid for once per session and purpose
+    # Parsers decoding a book that's being opened use the 'reading'
+    # pool so that they never wait behind a library addition
+    with _worker_pool_lock:
+        if purpose not in _worker_pools:
+            if pool_context:
+                _worker_pools[purpose] = pool_context.Pool(
+                    thread_count,
+                    initializer=init_logging,
+                    initargs=([],),
+                    maxtasksperchild=worker_task_limit)
+            else:
+                _worker_pools[purpose] = Pool(thread_count)
+
+        return _worker_pools[purpose]
+
+
+def close_worker_pool():
+    with _worker_pool_lock:
+        for i in _worker_pools.values():
+            i.terminate()
+            i.join()
+        _worker_pools.clear()
+
+
+def read_book(task):
+    # This is the worker entry point and runs in the pool
+    # task is (filename, file_md5, work_mode, temp_dir)
+    # Returns (filename, book dictionary or None, errors)
+    filename, file_md5, work_mode, temp_dir = task
+    errors = []
+
+    file_extension = get_parser_extension(filename)
+    if not file_extension:
+        this_error = 'Unsupported extension: ' + filename
+        errors.append(this_error)
+        logger.error(this_error)
+        return filename, None, errors
+
+    book_ref = sorter[file_extension](filename, temp_dir, file_md5)
+
+    # None of the following have an exception type specified
+    # This will keep everything from crashing, but will make
+    # troubleshooting difficult
+
+    try:
+        book_ref.read_book()
+    except Exception as e:
+        this_error = f'Error initializing: {filename}'
+        errors.append(this_error)
+        logger.exception(this_error + f' {type(e).__name__} Arguments: {e.args}')
+        return filename, None, errors
+
+    this_book = {
+        'hash': file_md5,
+        'path': filename}
+
+    # Different modes require different values
+    # Anything that comes from the database is added by the BookSorter
+    if work_mode == 'addition':
+        try:
+            metadata = book_ref.generate_metadata()
+        except Exception as e:
+            this_error = f'Metadata generation error: {filename}'
+            errors.append(this_error)
+            logger.exception(this_error + f' {type(e).__name__} Arguments: {e.args}')
+            return filename, None, errors
+
+        cover_image_raw = metadata.cover
+        if cover_image_raw:
+            cover_image = resize_image(cover_image_raw)
+        else:
+            cover_image = None
+
+        this_book['cover_image'] = cover_image
+        this_book['title'] = metadata.title
+        this_book['author'] = metadata.author
+        this_book['year'] = metadata.year
+        this_book['isbn'] = metadata.isbn
+        this_book['tags'] = None
+
+    if work_mode == 'reading':
+        try:
+            book_breakdown = book_ref.generate_content()
+        except Exception as e:
+            this_error = f'Content generation error: {filename}'
+            errors.append(this_error)
+            logger.exception(this_error + f' {type(e).__name__} Arguments: {e.args}')
+            return filename, None, errors
 
-        def pool_creator():
-            _pool = Pool(thread_count)
-            self.processed_books = _pool.map(
-                self.read_book, self.file_list)
+        # Streaming parsers only have their ToC ready at this point
+        # See streaming.py for both ways of returning content
+        if inspect.isgenerator(book_breakdown):
+            try:
+                toc, chapter_count, images_only = next(book_breakdown)
+            except Exception as e:
+                this_error = f'Content generation error: {filename}'
+                errors.append(this_error)
+                logger.exception(this_error + f' {type(e).__name__} Arguments: {e.args}')
+                return filename, None, errors
+
+            book_breakdown = (
+                toc, StreamedContent(book_breakdown, chapter_count, filename), images_only)
+
+        this_book['toc'] = book_breakdown[0]
+        this_book['content'] = book_breakdown[1]
+        this_book['images_only'] = book_breakdown[2]
+
+        # Parsers that serve images from the book file themselves
+        # hand over what they found while parsing
+        if hasattr(book_ref, 'generate_resources'):
+            this_book['resources'] = book_ref.generate_resources()
+
+    return filename, this_book, errors
+
+
+def read_and_cache_book(book_cache, task):
+    # Reading mode counterpart of read_book
+    # This runs in a thread of the GUI process
+    filename, this_book, errors = read_book(task)
+    if this_book:
+        this_book['block_counts'] = None
+        if not this_book['images_only']:
+            parser = sorter[get_parser_extension(filename)]
+            if isinstance(this_book['content'], StreamedContent):
+                # Cached once the parser is done with every chapter
+                # Books with chapters that failed are parsed again next time
+                def store_if_parsed(succeeded):
+                    if succeeded:
+                        book_cache.store(this_book, parser, task[3])
+                    else:
+                        logger.warning('Not caching incompletely parsed book: ' + filename)
+
+                this_book['content'].when_complete(store_if_parsed)
+            else:
+                book_cache.store(this_book, parser, task[3])
 
-            _pool.close()
-            _pool.join()
+    return filename, this_book, errors
 
-        start_time = time.time()
 
-        worker_thread = threading.Thread(target=pool_creator)
-        progress_thread = threading.Thread(target=self.read_progress)
-        worker_thread.start()
-        progress_thread.start()
+def get_parser_extension(filename):
+    # This allows for eliminating issues with filenames that have
+    # a dot in them. All hail the roundabout fix.
+    for i in sorter:
+        if os.path.basename(filename).endswith(i):
+            return i
+    return None
 
-        worker_thread.join()
-        progress_thread.join(timeout=.5)
 
-        return_books = {}
-        # Exclude None returns generated in case of duplication / parse errors
-        self.processed_books = [i for i in self.processed_books if i]
-        for i in self.processed_books:
-            for j in i:
-                return_books[j] = i[j]
+def hash_file(filename):
+    with open(filename, 'rb') as current_book:
+        # This should speed up addition for larger files
+        # without compromising the integrity of the process
+        first_bytes = current_book.read(1024 * 32)  # First 32KB of the file
+        return hashlib.md5(first_bytes).hexdigest()
 
-        del self.processed_books
-        processing_time = str(time.time() - start_time)
-        logger.info('Finished processing in ' + processing_time)
 
-        return return_books, self.errors
+def get_file_hashes(file_list, database_path):
+    # Returns a {path: hash} dictionary for every file that exists
+    # Hashes are looked up in the fingerprint index first and
+    # files are only read in case they are new or have been modified
+    fingerprints = {}
+    if database_path:
+        fingerprints = database.DatabaseFunctions(
+            database_path).fetch_fingerprints(file_list)
+
+    file_hashes = {}
+    new_fingerprints = []
+    for filename in file_list:
+        try:
+            stat_key = stat_fingerprint(filename)
+            try:
+                indexed = fingerprints[filename]
+                if tuple(indexed[:3]) != stat_key:
+                    raise KeyError
+                file_hashes[filename] = indexed[3]
+            except KeyError:
+                file_md5 = hash_file(filename)
+                file_hashes[filename] = file_md5
+                new_fingerprints.append((filename, *stat_key, file_md5))
+        except OSError:
+            logger.error('Unable to fingerprint: ' + filename)
+
+    if database_path and new_fingerprints:
+        database.DatabaseFunctions(database_path).add_fingerprints(new_fingerprints)
+
+    return file_hashes
 
 
 def progress_object_generator():
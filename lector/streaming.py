@@ -0,0 +1,154 @@
+# This file is a part of Lector, a Qt based ebook reader
+# Copyright (C) 2017-2019 BasioMeusPuga
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Parsers hand over their content in one of two ways
+# 1. generate_content() returns (toc, content, images_only)
+#    Every chapter is ready by the time the book is opened
+# 2. generate_content() returns a generator
+#    The first item it yields is (toc, chapter_count, images_only)
+#    Every item after that is (chapter_number, chapter_content),
+#    chapter numbers starting at 1, in any order, until each chapter
+#    has been yielded once. The value sent into the generator is the
+#    chapter the reader is waiting on, or None. Parsers are free to
+#    produce that chapter next.
+# The reader opens a book as soon as its ToC is known and
+# only ever waits on the chapter it is showing.
+# The content list of the first kind already behaves the same way.
+
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+def stream_chapters(toc, chapter_count, images_only, generate_chapter):
+    # Implements the second protocol for parsers that can produce any
+    # chapter by itself with generate_chapter(chapter_number)
+    pending = set(range(1, chapter_count + 1))
+    next_chapter = 1
+
+    wanted_chapter = yield toc, chapter_count, images_only
+    while pending:
+        if wanted_chapter in pending:
+            this_chapter = wanted_chapter
+        else:
+            while next_chapter not in pending:
+                next_chapter += 1
+            this_chapter = next_chapter
+
+        pending.remove(this_chapter)
+        wanted_chapter = yield this_chapter, generate_chapter(this_chapter)
+
+
+class StreamedContent:
+    # Stands in for the content list of a book whose parser uses
+    # the second protocol. Chapters are pulled from the parser in a
+    # background thread. Asking for one that isn't ready yet moves it
+    # to the front of the queue and blocks until it is available.
+
+    def __init__(self, chapter_stream, chapter_count, filename):
+        self.chapter_stream = chapter_stream
+        self.filename = filename
+
+        self.chapters = [None] * chapter_count
+        self.ready = [False] * chapter_count
+        self.remaining = chapter_count
+        self.wanted_chapter = None
+        self.succeeded = True  # False once any chapter is a Parse Error
+
+        self.condition = threading.Condition()
+        self.callbacks = []
+
+        self.thread = threading.Thread(target=self.fill_chapters, daemon=True)
+        self.thread.start()
+
+    def __len__(self):
+        return len(self.chapters)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('Chapter index out of range')
+
+        with self.condition:
+            if not self.ready[index]:
+                self.wanted_chapter = index + 1
+                self.condition.wait_for(lambda: self.ready[index])
+            return self.chapters[index]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    @property
+    def is_complete(self):
+        return not self.remaining
+
+    def when_complete(self, callback):
+        # callback(succeeded) is run in the parsing thread once every
+        # chapter is in. Right away if that has already happened.
+        # succeeded is False if the parser failed to produce a chapter
+        with self.condition:
+            if self.remaining:
+                self.callbacks.append(callback)
+                return
+        callback(self.succeeded)
+
+    def fill_chapters(self):
+        try:
+            while self.remaining:
+                with self.condition:
+                    wanted_chapter = self.wanted_chapter
+                    self.wanted_chapter = None
+
+                chapter_number, chapter_content = self.chapter_stream.send(wanted_chapter)
+                with self.condition:
+                    if not self.ready[chapter_number - 1]:
+                        self.remaining -= 1
+                    self.chapters[chapter_number - 1] = chapter_content
+                    self.ready[chapter_number - 1] = True
+                    self.condition.notify_all()
+
+        except StopIteration:
+            if self.remaining:
+                logger.error(f'Parser stopped {self.remaining} chapters short: {self.filename}')
+        except Exception:
+            logger.exception('Content generation error: ' + self.filename)
+
+        with self.condition:
+            for count, i in enumerate(self.ready):
+                if not i:
+                    self.chapters[count] = 'Parse Error'
+                    self.ready[count] = True
+                    self.succeeded = False
+            self.remaining = 0
+            self.condition.notify_all()
+
+            callbacks = self.callbacks
+            self.callbacks = []
+
+        # Drop the parser along with everything it is holding on to
+        self.chapter_stream = None
+
+        for callback in callbacks:
+            try:
+                callback(self.succeeded)
+            except Exception:
+                logger.exception('Error finishing up: ' + self.filename)
@@ -24,6 +24,7 @@ from PyQt5 import QtCore, QtGui
 
 from app.lector.lector import sorter
 from app.lector.lector import database
+from app.lector.lector.bookcache import BookCache, RenderCache, stat_fingerprint
 
 # The following have to be separate
 try:
@@ -59,12 +60,21 @@ class BackGroundTabUpdate(QtCore.QThread):
 
 
 class BackGroundBookAddition(QtCore.QThread):
-    def __init__(self, file_list, database_path, addition_mode, main_window, parent=None):
+    # Changes to the library model are carried to the GUI thread
+    # since that's the only place models can be touched from
+    # booksCommitted: every batch of committed books
+    # pathsMoved: {old path: new path} found by an incremental scan
+    booksCommitted = QtCore.pyqtSignal(object)
+    pathsMoved = QtCore.pyqtSignal(object)
+
+    def __init__(self, file_list, database_path, addition_mode, main_window,
+                 scan_diff=None, parent=None):
         super(BackGroundBookAddition, self).__init__(parent)
         self.file_list = file_list
         self.database_path = database_path
         self.addition_mode = addition_mode
         self.main_window = main_window
+        self.scan_diff = scan_diff  # Generated by an incremental scan
         self.errors = []
 
         self.prune_required = True
@@ -72,19 +82,43 @@ class BackGroundBookAddition(QtCore.QThread):
             self.prune_required = False
 
     def run(self):
-        books = sorter.BookSorter(
-            self.file_list,
-            ('addition', self.addition_mode),
-            self.database_path,
-            self.main_window.settings,
-            self.main_window.temp_dir.path())
-
-        parsed_books, self.errors = books.initiate_threads()
-        self.main_window.lib_ref.generate_model('addition', parsed_books, False)
-        database.DatabaseFunctions(self.database_path).add_to_database(parsed_books)
+        file_list = self.file_list
+        if self.scan_diff:
+            file_list = self.scan_diff['added']
+
+            if self.scan_diff['moved']:
+                database.DatabaseFunctions(self.database_path).modify_paths(
+                    self.scan_diff['moved'])
+                self.pathsMoved.emit(self.scan_diff['moved'])
+
+        if file_list:
+            books = sorter.BookSorter(
+                file_list,
+                ('addition', self.addition_mode),
+                self.database_path,
+                self.main_window.settings,
+                self.main_window.temp_dir.path())
+
+        if file_list and books.file_list:
+            # Books are committed in batches as they are parsed
+            # Whatever hasn't been committed yet stays in the import
+            # journal so that an interrupted addition can be resumed
+            database.DatabaseFunctions(self.database_path).set_import_journal(
+                books.file_list, self.addition_mode)
+
+            _, self.errors = books.initiate_threads(self.commit_batch)
 
         if self.prune_required:
-            self.main_window.lib_ref.prune_models(self.file_list)
+            if self.scan_diff:
+                self.main_window.lib_ref.prune_models(
+                    removed_paths=self.scan_diff['removed'])
+            else:
+                self.main_window.lib_ref.prune_models(self.file_list)
+
+    def commit_batch(self, parsed_books, processed_files):
+        database.DatabaseFunctions(self.database_path).add_to_database(
+            parsed_books, processed_files)
+        self.booksCommitted.emit(parsed_books)
 
 
 class BackGroundBookDeletion(QtCore.QThread):
@@ -99,10 +133,18 @@ class BackGroundBookDeletion(QtCore.QThread):
 
 
 class BackGroundBookSearch(QtCore.QThread):
-    def __init__(self, data_list, parent=None):
+    def __init__(self, data_list, database_path=None, parent=None):
         super(BackGroundBookSearch, self).__init__(parent)
         self.valid_files = []
 
+        # A database path enables incremental scanning
+        # Directories are only listed again in case their mtime has changed
+        # and the difference from the last scan is put into scan_diff
+        self.database_path = database_path
+        self.previous_state = {}
+        self.scan_state = {}
+        self.scan_diff = None
+
         # Filter for checked directories
         self.valid_directories = [
             [i[0], i[1], i[2]] for i in data_list if i[
@@ -128,23 +170,178 @@ class BackGroundBookSearch(QtCore.QThread):
                     if os.path.splitext(filename)[1][1:] in sorter.available_parsers:
                         self.valid_files.append(os.path.join(directory, filename))
 
+        def traverse_directory_incremental(incoming_data):
+            pending_directories = [incoming_data[0]]
+            while pending_directories:
+                directory = pending_directories.pop()
+                if directory in self.scan_state:  # Overlapping library directories
+                    continue
+
+                try:
+                    directory_mtime = os.stat(directory).st_mtime_ns
+                except OSError:
+                    continue
+
+                # The mtime of a directory changes whenever an entry
+                # is added, removed, or renamed inside it
+                try:
+                    previous_mtime, subdirs, files = self.previous_state[directory]
+                    if previous_mtime != directory_mtime:
+                        raise KeyError
+                except KeyError:
+                    subdirs = []
+                    files = []
+                    try:
+                        with os.scandir(directory) as directory_entries:
+                            for entry in directory_entries:
+                                if entry.is_dir(follow_symlinks=False):
+                                    subdirs.append(entry.name)
+                                elif (os.path.splitext(entry.name)[1][1:]
+                                        in sorter.available_parsers):
+                                    files.append(entry.name)
+                    except OSError:
+                        continue
+
+                self.scan_state[directory] = (directory_mtime, subdirs, files)
+                pending_directories.extend(
+                    os.path.join(directory, d) for d in subdirs
+                    if is_wanted(os.path.join(directory, d)))
+
+        def generate_scan_diff():
+            current_files = set()
+            for directory, directory_state in self.scan_state.items():
+                current_files.update(
+                    os.path.join(directory, i) for i in directory_state[2])
+            self.valid_files = list(current_files)
+
+            previous_files = set()
+            for directory, directory_state in self.previous_state.items():
+                previous_files.update(
+                    os.path.join(directory, i) for i in directory_state[2])
+
+            book_paths = database.DatabaseFunctions(
+                self.database_path).fetch_data(
+                    ('Path',), 'books', {'Path': ''}, 'LIKE')
+            book_paths = {i[0] for i in book_paths} if book_paths else set()
+
+            # Files not in the database are retried even if
+            # they were seen during the last scan
+            added = {
+                i for i in current_files
+                if i not in previous_files or i not in book_paths}
+            removed = book_paths - current_files
+
+            # Files that were moved retain their inode, size, and mtime
+            # These keep their database entry and are not parsed again
+            moved = {}
+            if added and removed:
+                removed_fingerprints = database.DatabaseFunctions(
+                    self.database_path).fetch_fingerprints(removed)
+                removed_by_stat = {
+                    tuple(i[1][:3]): i[0] for i in removed_fingerprints.items()}
+                for i in added:
+                    try:
+                        old_path = removed_by_stat[stat_fingerprint(i)]
+                    except (KeyError, OSError):
+                        continue
+                    moved[old_path] = i
+
+                added.difference_update(moved.values())
+                removed.difference_update(moved.keys())
+
+            self.scan_diff = {
+                'added': list(added),
+                'removed': list(removed),
+                'moved': moved}
+
         def initiate_threads():
             _pool = Pool(5)
-            _pool.map(traverse_directory, self.valid_directories)
+            if self.database_path:
+                self.previous_state = database.DatabaseFunctions(
+                    self.database_path).fetch_scan_state()
+                _pool.map(traverse_directory_incremental, self.valid_directories)
+            else:
+                _pool.map(traverse_directory, self.valid_directories)
             _pool.close()
             _pool.join()
 
+            if self.database_path:
+                generate_scan_diff()
+                database.DatabaseFunctions(
+                    self.database_path).set_scan_state(self.scan_state)
+
         if self.valid_directories:
             initiate_threads()
             if self.valid_files:
                 info_string = str(len(self.valid_files)) + ' books found'
                 logger.info(info_string)
+                if self.scan_diff:
+                    logger.info(
+                        f"Scan: {len(self.scan_diff['added'])} added, "
+                        f"{len(self.scan_diff['removed'])} removed, "
+                        f"{len(self.scan_diff['moved'])} moved")
             else:
                 logger.error('No books found on scan')
         else:
             logger.error('No valid directories')
 
 
+class BackGroundFingerprintVerification(QtCore.QThread):
+    # The fingerprint index trusts the size, mtime, and inode of a file
+    # This goes over every indexed file and reads it anyway so that
+    # content changes that preserve the stat are caught eventually
+    # Meant to be started with QtCore.QThread.LowestPriority
+    def __init__(self, database_path, parent=None):
+        super(BackGroundFingerprintVerification, self).__init__(parent)
+        self.database_path = database_path
+
+    def run(self):
+        fingerprints = database.DatabaseFunctions(
+            self.database_path).fetch_fingerprints()
+
+        missing_paths = []
+        updated_fingerprints = []
+        for path, indexed in fingerprints.items():
+            if self.isInterruptionRequested():
+                break
+
+            try:
+                stat_key = stat_fingerprint(path)
+                file_md5 = sorter.hash_file(path)
+            except OSError:
+                missing_paths.append(path)
+                continue
+
+            if file_md5 != indexed[3]:
+                logger.warning('Fingerprint mismatch: ' + path)
+
+            if (*stat_key, file_md5) != tuple(indexed):
+                updated_fingerprints.append((path, *stat_key, file_md5))
+
+        if missing_paths:
+            database.DatabaseFunctions(
+                self.database_path).delete_fingerprints(missing_paths)
+        if updated_fingerprints:
+            database.DatabaseFunctions(
+                self.database_path).add_fingerprints(updated_fingerprints)
+
+        logger.info(
+            f'Fingerprints verified: {len(updated_fingerprints)} updated, '
+            f'{len(missing_paths)} removed')
+
+
+class BackGroundBookCacheCleanup(QtCore.QThread):
+    # Drops parsed books whose files have changed since they were
+    # cached and trims both caches down to their size limits
+    def __init__(self, size_limit_mb, parent=None):
+        super(BackGroundBookCacheCleanup, self).__init__(parent)
+        self.size_limit_mb = size_limit_mb
+
+    def run(self):
+        BookCache(self.size_limit_mb).invalidate_changed()
+        RenderCache().evict()
+
+
 class BackGroundCacheRefill(QtCore.QThread):
     def __init__(self, image_cache, remove_value, filetype, book, all_pages, parent=None):
         super(BackGroundCacheRefill, self).__init__(parent)
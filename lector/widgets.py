@@ -23,7 +23,10 @@ import logging
 
 from PyQt5 import QtWidgets, QtGui, QtCore
 
-from app.lector.lector.sorter import resize_image
+from app.lector.lector.sorter import resize_image, get_parser_extension
+from app.lector.lector.bookcache import BookCache
+from app.lector.lector.readers.read_epub import EPUBResources
+from app.lector.lector.readers.read_fb2 import FB2Resources
 from app.lector.lector.dockwidgets import PliantDockWidget
 from app.lector.lector.contentwidgets import PliantQGraphicsView, PliantQTextBrowser
 
@@ -31,6 +34,9 @@ logger = logging.getLogger(__name__)
 
 
 class Tab(QtWidgets.QWidget):
+    # Emitted from the parsing thread of a streamed book
+    contentComplete = QtCore.pyqtSignal()
+
     def __init__(self, metadata, main_window, parent=None):
         super(Tab, self).__init__(parent)
         self._translate = QtCore.QCoreApplication.translate
@@ -60,10 +66,14 @@ class Tab(QtWidgets.QWidget):
         self.generate_toc_model()
 
         # Get the current position of the book
+        self.contentComplete.connect(self.generate_block_counts)
         if self.metadata['position']:
             # A book might have been marked read without being opened
             if self.metadata['position']['is_read']:
                 self.generate_position(True)
+            # Or closed before its block counts were available
+            elif not self.metadata['position']['blocks_per_chapter']:
+                self.generate_block_counts()
             current_chapter = self.metadata['position']['current_chapter']
         else:
             self.generate_position()
@@ -89,21 +99,20 @@ class Tab(QtWidgets.QWidget):
             # Change this when HTML navigation works
             self.contentView.setOpenLinks(False)
 
-            # TODO
-            # Rename the .css files to something else here and keep
-            # a record of them .Currently, I'm just removing them
-            # for the sake of simplicity
-            relative_path_root = os.path.join(
-                self.main_window.temp_dir.path(), self.metadata['hash'])
-            relative_paths = []
-            for i in os.walk(relative_path_root):
-                for j in i[2]:
-                    file_extension = os.path.splitext(j)[1]
-                    if file_extension == '.css':
-                        file_path = os.path.join(i[0], j)
-                        os.remove(file_path)
-                relative_paths.append(os.path.join(relative_path_root, i[0]))
-            self.contentView.setSearchPaths(relative_paths)
+            # EPUBs and FB2s are read straight from the book file. Other
+            # formats extract their images into the temp directory
+            # Stylesheets are ignored by the text browser in either case
+            parser_extension = get_parser_extension(self.metadata['path'])
+            if parser_extension == 'epub':
+                self.contentView.resources = EPUBResources(self.metadata['path'])
+            elif parser_extension in ('fb2', 'fb2.zip'):
+                self.contentView.resources = (
+                    self.metadata.get('resources') or FB2Resources(self.metadata['path']))
+            else:
+                relative_path_root = os.path.join(
+                    self.main_window.temp_dir.path(), self.metadata['hash'])
+                relative_paths = [i[0] for i in os.walk(relative_path_root)]
+                self.contentView.setSearchPaths(relative_paths)
 
             self.hiddenButton = QtWidgets.QToolButton(self)
             self.hiddenButton.setVisible(False)
@@ -258,28 +267,55 @@ class Tab(QtWidgets.QWidget):
         if is_read:
             current_chapter = total_chapters
 
+        self.metadata['position'] = {
+            'current_chapter': current_chapter,
+            'total_chapters': total_chapters,
+            'blocks_per_chapter': [],
+            'total_blocks': 0,
+            'is_read': is_read,
+            'current_block': 0,
+            'cursor_position': 0}
+
+        self.generate_block_counts()
+
+    def generate_block_counts(self):
         # Generate block count @ time of first read
         # Blocks are indexed from 0 up
-        blocks_per_chapter = []
-        total_blocks = 0
+        content = self.metadata['content']
 
-        if not self.are_we_doing_images_only:
-            for i in self.metadata['content']:
+        # Laying out every chapter is slow, so the counts
+        # are kept in the parsed book cache once generated
+        cached_block_counts = self.metadata.get('block_counts')
+        if cached_block_counts and len(cached_block_counts) == len(content):
+            blocks_per_chapter = list(cached_block_counts)
+
+        elif self.are_we_doing_images_only:
+            return
+
+        # Books that are still being parsed are counted once they're done
+        # Progress is measured in chapters until then
+        elif not getattr(content, 'is_complete', True):
+            def on_content_complete(succeeded):
+                try:
+                    self.contentComplete.emit()
+                except RuntimeError:  # The tab was closed in the meantime
+                    pass
+            content.when_complete(on_content_complete)
+            return
+
+        else:
+            blocks_per_chapter = []
+            for i in content:
                 textDocument = QtGui.QTextDocument(None)
                 textDocument.setHtml(i)
-                block_count = textDocument.blockCount()
+                blocks_per_chapter.append(textDocument.blockCount())
 
-                blocks_per_chapter.append(block_count)
-                total_blocks += block_count
+            self.metadata['block_counts'] = blocks_per_chapter
+            BookCache(self.main_window.settings['book_cache_limit']).store_block_counts(
+                self.metadata['hash'], blocks_per_chapter)
 
-        self.metadata['position'] = {
-            'current_chapter': current_chapter,
-            'total_chapters': total_chapters,
-            'blocks_per_chapter': blocks_per_chapter,
-            'total_blocks': total_blocks,
-            'is_read': is_read,
-            'current_block': 0,
-            'cursor_position': 0}
+        self.metadata['position']['blocks_per_chapter'] = blocks_per_chapter
+        self.metadata['position']['total_blocks'] = sum(blocks_per_chapter)
 
     def generate_keyboard_shortcuts(self):
         ksNextChapter = QtWidgets.QShortcut(